@@ -0,0 +1,65 @@
+import argparse
+import base64
+import os
+import random
+import time
+from bs4 import BeautifulSoup
+from src.api.mime import BodyCache, decode_part, extract_bodies, html_to_text
+from .mailbox import synthetic_html
+
+'''
+Body extraction throughput in MB/s of decoded HTML.
+Compares the BeautifulSoup based stripping gmailApi used before with the
+regex stripper, cold and cached, serial and on a process pool.
+
+    python -m benchmarks.bench_body_extraction --messages 200 --size 50
+'''
+
+
+def payloads(count, size_kb, seed=0):
+    rng = random.Random(seed)
+    result = []
+    for _ in range(count):
+        data = base64.urlsafe_b64encode(synthetic_html(rng, size_kb).encode('utf-8')).decode('ascii')
+        result.append({'mimeType': 'multipart/alternative', 'parts': [
+            {'mimeType': 'text/html', 'filename': '', 'body': {'data': data}}]})
+    return result
+
+
+def beautifulsoup_extract(payload):
+    text, _ = decode_part(payload['parts'][0])
+    return BeautifulSoup(text, 'html.parser').get_text(separator='\n', strip=True)
+
+
+def measure(name, megabytes, func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f'{name:<28} {elapsed:8.3f}s {megabytes / elapsed:9.1f} MB/s')
+    return megabytes / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark body extraction')
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--size', type=int, default=50, help='HTML size per message in KB')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    messages = payloads(args.messages, args.size)
+    megabytes = sum(len(decode_part(message['parts'][0])[0]) for message in messages) / 1e6
+    print(f'{args.messages} messages, {megabytes:.1f} MB of HTML, {args.workers} worker(s)')
+
+    measure('beautifulsoup', megabytes, lambda: [beautifulsoup_extract(message) for message in messages])
+    measure('regex stripper', megabytes,
+            lambda: [html_to_text(decode_part(message['parts'][0])[0]) for message in messages])
+    cache = BodyCache(maxsize=len(messages))
+    measure('extract_bodies (cold cache)', megabytes, lambda: extract_bodies(messages, cache=cache))
+    measure('extract_bodies (cached)', megabytes, lambda: extract_bodies(messages, cache=cache))
+    if args.workers > 1:
+        measure(f'extract_bodies ({args.workers} processes)', megabytes,
+                lambda: extract_bodies(messages, workers=args.workers, cache=BodyCache(maxsize=len(messages))))
+
+
+if __name__ == '__main__':
+    main()
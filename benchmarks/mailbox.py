@@ -0,0 +1,178 @@
+import base64
+import bisect
+import itertools
+import random
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+'''
+Synthetic mailboxes for the benchmarks.
+Senders and subject words follow Zipf distributions, so a few newsletters
+and colleagues send most of the mail like in a real inbox. Emails come as
+the dicts gmailApi.parse_message returns and EmailDatabase.store_emails
+takes, messages as Gmail API resources with HTML or plain text payloads
+and attachment parts. Both are generated lazily and the same seed gives
+the same mailbox.
+'''
+
+DOMAINS = ['tcs.com', 'nptel.iitm.ac.in', 'gmail.com', 'github.com', 'linkedin.com', 'amazon.in', 'bank.example',
+           'university.edu', 'news.example.org', 'shop.example']
+NAMES = ['hr', 'noreply', 'alerts', 'newsletter', 'support', 'jobs', 'team', 'billing', 'info', 'admin']
+WORDS = ['invoice', 'offer', 'meeting', 'newsletter', 'placement', 'update', 'account', 'weekly', 'course',
+         'assignment', 'order', 'shipped', 'payment', 'reminder', 'security', 'alert', 'interview', 'report',
+         'Straße', 'café', 'letter', 'review', 'deadline', 'webinar', 'discount', 'receipt', 'project', 'team']
+FOLDERS = ['INBOX', 'INBOX', 'INBOX', 'TCS', 'NPTEL', 'Placement']
+ATTACHMENT_TYPES = ['application/pdf', 'image/png', 'image/jpeg', 'text/csv',
+                    'application/vnd.openxmlformats-officedocument.wordprocessingml.document']
+
+
+def zipf_weights(size, skew):
+    # cumulative weights of ranks 1..size, sampled by bisection
+    return list(itertools.accumulate(1 / rank ** skew for rank in range(1, size + 1)))
+
+
+def synthetic_html(rng, size_kb, words=WORDS):
+    # Newsletter shaped HTML: nested tables, inline styles, links and a style block
+    rows = ['<html><head><style>td { padding: 4px; } .x { color: #333; }</style></head><body><table>']
+    size = 0
+    while size < size_kb * 1024:
+        text = ' '.join(rng.choice(words) for _ in range(rng.randint(5, 30))).replace('&', '&amp;')
+        row = (f'<tr><td class="x" style="font-family: Arial"><a href="https://example.com/?id={rng.randint(0, 10**6)}">'
+               f'{text}</a></td><td><div><p>{text} &amp; more&nbsp;</p><br/></div></td></tr><!-- row -->')
+        rows.append(row)
+        size += len(row)
+    rows.append('</table></body></html>')
+    return ''.join(rows)
+
+
+def _encode(text):
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+
+class SyntheticMailbox:
+    '''
+    Generator of a mailbox of `count` emails spread over the last `days` days.
+    senders: distinct sender addresses, sender_skew and subject_skew: Zipf
+    exponents of the sender and subject word choice (0 is uniform),
+    html_ratio: share of HTML bodies, attachment_ratio: share of emails with
+    attachments, body_size: mean body size in KB
+    '''
+
+    def __init__(self, count=10000, seed=0, senders=500, sender_skew=1.1, subject_skew=1.0, html_ratio=0.6,
+                 attachment_ratio=0.1, body_size=2.0, days=365):
+        self.count = count
+        self.seed = seed
+        self.html_ratio = html_ratio
+        self.attachment_ratio = attachment_ratio
+        self.body_size = body_size
+        self.days = days
+        rng = random.Random(seed)
+        self.senders = [f'{rng.choice(NAMES)}{index}@{rng.choice(DOMAINS)}' for index in range(senders)]
+        self.sender_weights = zipf_weights(senders, sender_skew)
+        self.word_weights = zipf_weights(len(WORDS), subject_skew)
+        self.now = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+    def _sample(self, rng, items, weights, k=1):
+        return [items[bisect.bisect(weights, rng.random() * weights[-1])] for _ in range(k)]
+
+    def _fields(self, rng, index):
+        sender = self._sample(rng, self.senders, self.sender_weights)[0]
+        subject = ' '.join(self._sample(rng, WORDS, self.word_weights, rng.randint(2, 8))).capitalize()
+        date = self.now - timedelta(seconds=rng.randint(0, self.days * 86400))
+        size_kb = rng.expovariate(1 / self.body_size) if self.body_size else 0
+        is_html = rng.random() < self.html_ratio
+        attachments = rng.sample(ATTACHMENT_TYPES, rng.randint(1, 2)) if rng.random() < self.attachment_ratio else []
+        return {
+            'id': f'{index:012x}',
+            'subject': subject,
+            'from': f'{sender.split("@")[0].title()} <{sender}>',
+            'to': 'me@example.com',
+            'date': format_datetime(date),
+            'is_html': is_html,
+            'size_kb': size_kb,
+            'attachment_types': attachments,
+            'is_read': rng.random() < 0.7,
+            'folder_name': rng.choice(FOLDERS),
+        }
+
+    def _text(self, rng, fields):
+        words = max(1, int(fields['size_kb'] * 1024 / 8))
+        return ' '.join(self._sample(rng, WORDS, self.word_weights, words))
+
+    def emails(self):
+        # Email dicts as parsed by gmailApi, bodies as extracted text
+        rng = random.Random(self.seed)
+        for index in range(self.count):
+            fields = self._fields(rng, index)
+            body = self._text(rng, fields)
+            yield {
+                'id': fields['id'],
+                'subject': fields['subject'],
+                'snippet': body[:100],
+                'from': fields['from'],
+                'to': fields['to'],
+                'date': fields['date'],
+                'body': body,
+                'has_attachment': bool(fields['attachment_types']),
+                'attachment_types': fields['attachment_types'],
+                'is_read': fields['is_read'],
+                'folder_name': fields['folder_name'],
+            }
+
+    def messages(self):
+        # Gmail API message resources in format=full
+        rng = random.Random(self.seed)
+        for index in range(self.count):
+            fields = self._fields(rng, index)
+            body = synthetic_html(rng, fields['size_kb']) if fields['is_html'] else self._text(rng, fields)
+            mime_type = 'text/html' if fields['is_html'] else 'text/plain'
+            parts = [{'mimeType': 'multipart/alternative', 'filename': '', 'body': {'size': 0}, 'parts': [
+                {'mimeType': mime_type, 'filename': '', 'body': {'data': _encode(body)},
+                 'headers': [{'name': 'Content-Type', 'value': f'{mime_type}; charset="UTF-8"'}]}]}]
+            for number, attachment_type in enumerate(fields['attachment_types']):
+                parts.append({'mimeType': attachment_type, 'filename': f'file{number}',
+                              'body': {'attachmentId': f'a{index}-{number}', 'size': 1024}})
+            labels = [] if fields['is_read'] else ['UNREAD']
+            yield {
+                'id': fields['id'],
+                'threadId': fields['id'],
+                'labelIds': labels + [fields['folder_name']],
+                'snippet': '',
+                'payload': {
+                    'mimeType': 'multipart/mixed',
+                    'headers': [
+                        {'name': 'Subject', 'value': fields['subject']},
+                        {'name': 'From', 'value': fields['from']},
+                        {'name': 'To', 'value': fields['to']},
+                        {'name': 'Date', 'value': fields['date']},
+                    ],
+                    'parts': parts,
+                },
+            }
+
+
+def generate_rules(count, seed=0, mailbox=None):
+    # Rule sets shaped like config/rules.json, conditions drawn from the
+    # senders and words of the mailbox so rules do match
+    rng = random.Random(seed)
+    senders = mailbox.senders if mailbox else [f'{name}@{domain}' for name in NAMES for domain in DOMAINS]
+    rules = []
+    for index in range(count):
+        conditions = []
+        for _ in range(rng.randint(1, 3)):
+            kind = rng.random()
+            if kind < 0.5:
+                value = rng.choice([rng.choice(senders), rng.choice(DOMAINS), rng.choice(NAMES)])
+                conditions.append({'field': 'from', 'predicate': 'contains', 'value': value})
+            elif kind < 0.8:
+                conditions.append({'field': 'subject', 'predicate': rng.choice(['contains', 'does_not_contain']),
+                                   'value': rng.choice(WORDS)})
+            elif kind < 0.9:
+                conditions.append({'field': 'message', 'predicate': 'contains', 'value': rng.choice(WORDS)})
+            else:
+                conditions.append({'field': 'date_received', 'predicate': rng.choice(['less_than', 'greater_than']),
+                                   'value': str(rng.randint(1, 365))})
+        action = rng.choice([{'type': 'mark_as_read'}, {'type': 'move_message', 'folder': rng.choice(FOLDERS)}])
+        rules.append({'name': f'rule{index}', 'predicate_type': rng.choice(['any', 'all']),
+                      'conditions': conditions, 'actions': [action]})
+    return rules
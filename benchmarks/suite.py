@@ -0,0 +1,186 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+from src.api.mime import body_part, extract_body
+from src.database import EmailDatabase, configure_database
+from src.database.engine import dispose_engines
+from src.rules.compiler import CompiledRuleSet
+from src.rules.evaluation import iter_matches
+from .mailbox import SyntheticMailbox, generate_rules
+
+'''
+Offline benchmark suite over a synthetic mailbox, no Gmail account needed.
+Times ingest, get_all_emails, the stats queries, rule evaluation for rule
+sets of several sizes and body decoding, prints their throughput and
+compares it with a stored baseline. Exits with 1 when a result is more than
+--threshold below its baseline.
+
+    python -m benchmarks.suite --emails 10000 --rules 10 100 1000
+    python -m benchmarks.suite --save      # record the results as the baseline
+'''
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+# throughput may drop this much below the baseline before it is a regression
+THRESHOLD = 0.25
+INGEST_BATCH = 1000
+DECODE_MESSAGES = 2000
+
+
+def _timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def bench_ingest(db, mailbox):
+    # emails/s of store_emails, generating the emails is not timed
+    emails = mailbox.emails()
+    elapsed = 0.0
+    while True:
+        chunk = list(itertools.islice(emails, INGEST_BATCH))
+        if not chunk:
+            break
+        _, seconds = _timed(lambda: db.store_emails(chunk))
+        elapsed += seconds
+    return mailbox.count / elapsed
+
+
+def bench_get_all_emails(db):
+    loaded, elapsed = _timed(lambda: len(db.get_all_emails()))
+    db.session.expunge_all()
+    return loaded / elapsed
+
+
+def bench_stats(db, repeat=5):
+    # queries/s over the queries behind the dashboard charts
+    queries = [db.get_attachment_stats, db.get_folder_stats, lambda: db.get_folder_stats(count=100),
+               db.get_read_stats, lambda: db.get_receive_stats('hour')]
+    _, elapsed = _timed(lambda: [query() for _ in range(repeat) for query in queries])
+    return len(queries) * repeat / elapsed
+
+
+def bench_rules(db, mailbox, rule_count):
+    # stored emails evaluated per second, compiling the rules included
+    rules = generate_rules(rule_count, mailbox=mailbox)
+    now = datetime.utcnow()
+
+    def evaluate():
+        compiled = CompiledRuleSet(rules)
+        return sum(1 for _ in iter_matches(db, compiled, rules, now))
+
+    _, elapsed = _timed(evaluate)
+    db.session.expunge_all()
+    return mailbox.count / elapsed
+
+
+def bench_body_decoding(mailbox):
+    # MB/s of encoded body parts turned into text, uncached
+    messages = [message['payload'] for message in itertools.islice(mailbox.messages(), DECODE_MESSAGES)]
+    megabytes = sum(len(body_part(payload)['body']['data']) for payload in messages) / 1e6
+    _, elapsed = _timed(lambda: [extract_body(payload, cache=None) for payload in messages])
+    return megabytes / elapsed
+
+
+def run_suite(mailbox, rule_counts=(10, 100, 1000), db_path=None):
+    # {name: {'value': throughput, 'unit': unit}} for every benchmark
+    results = {}
+
+    def record(name, value, unit):
+        results[name] = {'value': round(value, 2), 'unit': unit}
+        print(f'{name:<16} {value:14.1f} {unit}')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        configure_database(db_path or os.path.join(tmp, 'bench.db'))
+        db = EmailDatabase()
+        try:
+            record('ingest', bench_ingest(db, mailbox), 'emails/s')
+            record('get_all_emails', bench_get_all_emails(db), 'emails/s')
+            record('stats', bench_stats(db), 'queries/s')
+            for rule_count in rule_counts:
+                record(f'rules_{rule_count}', bench_rules(db, mailbox, rule_count), 'emails/s')
+        finally:
+            db.close()
+            dispose_engines()
+            configure_database(None)
+    record('body_decoding', bench_body_decoding(mailbox), 'MB/s')
+    return results
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    # Names of the results more than threshold below their baseline
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]['value']
+        change = result['value'] / expected - 1 if expected else 0.0
+        flag = ''
+        if change < -threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:<16} {result["value"]:14.1f} vs {expected:14.1f} {result["unit"]:<10} {change:+7.1%}{flag}')
+    return regressions
+
+
+def load_baseline(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the offline benchmark suite')
+    parser.add_argument('--emails', type=int, default=10000, help='Emails in the synthetic mailbox')
+    parser.add_argument('--rules', type=int, nargs='+', default=[10, 100, 1000], help='Rule set sizes to evaluate')
+    parser.add_argument('--senders', type=int, default=500)
+    parser.add_argument('--sender-skew', type=float, default=1.1, help='Zipf exponent of the sender distribution')
+    parser.add_argument('--subject-skew', type=float, default=1.0, help='Zipf exponent of the subject words')
+    parser.add_argument('--html-ratio', type=float, default=0.6)
+    parser.add_argument('--attachment-ratio', type=float, default=0.1)
+    parser.add_argument('--body-size', type=float, default=2.0, help='Mean body size in KB')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help=f'Allowed throughput drop below the baseline (default: {THRESHOLD})')
+    parser.add_argument('--save', action='store_true', help='Store the results as the new baseline')
+    args = parser.parse_args()
+
+    config = {'emails': args.emails, 'rules': args.rules, 'senders': args.senders, 'sender_skew': args.sender_skew,
+              'subject_skew': args.subject_skew, 'html_ratio': args.html_ratio,
+              'attachment_ratio': args.attachment_ratio, 'body_size': args.body_size, 'seed': args.seed}
+    mailbox = SyntheticMailbox(count=args.emails, seed=args.seed, senders=args.senders, sender_skew=args.sender_skew,
+                               subject_skew=args.subject_skew, html_ratio=args.html_ratio,
+                               attachment_ratio=args.attachment_ratio, body_size=args.body_size)
+    print(f'{args.emails} emails, rule sets of {", ".join(map(str, args.rules))} rules')
+    results = run_suite(mailbox, args.rules)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'config': config, 'results': results}, f, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+        return 0
+
+    baseline = load_baseline(args.baseline)
+    if baseline is None:
+        print('No baseline to compare with, record one with --save')
+        return 0
+    if baseline['config'] != config:
+        print('The baseline was recorded with other settings, not comparing')
+        return 0
+    print(f'\nCompared with {args.baseline}:')
+    regressions = compare(results, baseline['results'], args.threshold)
+    if regressions:
+        print(f'{len(regressions)} regression(s): {", ".join(regressions)}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,17 @@
 import argparse
+import asyncio
+import signal
 from src.api.gmail_api import gmailApi
-from src.database import EmailDatabase
+from src.api.async_gmail_api import AsyncGmailApi
+from src.api.quota import default_limiter
+from src.database import EmailDatabase, configure_database
 from src.rules import RuleEngine
+from src.sync import MailboxSync, SyncPipeline, Watcher, WebhookServer
+from src.sync.pipeline import format_report, FETCH_WORKERS, PARSE_WORKERS, QUEUE_SIZE
+from src.utils.profiler import profiler
+
+# Number of emails written to the database per transaction
+STORE_BATCH_SIZE = 100
 
 def display_email(email):
     print("\nEmail Details:")
@@ -16,24 +26,140 @@ def display_email(email):
         print(f"Attachment Types: {', '.join(email['attachment_types'])}")
     print("-" * 50)
 
+def sync_emails(gmail, db, args, with_body=True, rule_engine=None):
+    # Stream emails from Gmail into the database in bounded chunks, headers
+    # only unless with_body
+    limit = None if args.all else args.count
+    if args.pipeline:
+        return sync_emails_pipeline(gmail, db, args, limit, with_body, rule_engine)
+    if args.concurrency > 1:
+        return asyncio.run(sync_emails_async(db, args.query, limit, args.concurrency, with_body, args.body_workers))
+    emails = gmail.iter_emails(query=args.query, limit=limit, with_body=with_body)
+    return sum(db.store_emails(emails, batch_size=STORE_BATCH_SIZE))
+
+def sync_emails_pipeline(gmail, db, args, limit, with_body=True, rule_engine=None):
+    # Same as sync_emails with the stages running concurrently, rules are
+    # applied to the new emails as they are stored when a rule engine is given
+    pipeline = SyncPipeline(gmail, db, rule_engine=rule_engine, fetch_workers=args.fetch_workers,
+                            parse_workers=args.parse_workers, queue_size=args.queue_size, with_body=with_body)
+    try:
+        result = pipeline.run(query=args.query, limit=limit)
+    except Exception:
+        # the stages up to the failure, the error itself is raised
+        print(format_report({'stages': pipeline.report()}))
+        raise
+    print(format_report(result))
+    return result['stored']
+
+async def sync_emails_async(db, query, limit, concurrency, with_body=True, body_workers=None):
+    # Same as sync_emails with up to `concurrency` Gmail requests in flight
+    stored = 0
+    chunk = []
+    async with AsyncGmailApi(concurrency=concurrency, body_workers=body_workers) as gmail:
+        async for email in gmail.iter_emails(query=query, limit=limit, with_body=with_body):
+            chunk.append(email)
+            if len(chunk) >= STORE_BATCH_SIZE:
+                stored += sum(db.store_emails(chunk, batch_size=STORE_BATCH_SIZE))
+                chunk = []
+    if chunk:
+        stored += sum(db.store_emails(chunk, batch_size=STORE_BATCH_SIZE))
+    return stored
+
+async def mark_emails_async(emails, read, concurrency):
+    async with AsyncGmailApi(concurrency=concurrency) as gmail:
+        mark = gmail.mark_as_read if read else gmail.mark_as_unread
+        return await asyncio.gather(*[mark(email['id']) for email in emails])
+
+def watch(gmail, db, rule_engine, args):
+    # Sync and apply rules on every change notification and every
+    # --poll-interval seconds until SIGINT/SIGTERM
+    sync = MailboxSync(gmail, db, with_body=rule_engine.needs_body)
+    watcher = Watcher(sync, rule_engine, poll_interval=args.poll_interval,
+                      limit=None if args.all else args.count, workers=args.workers, topic=args.watch_topic)
+    webhook = None
+    if args.webhook_port is not None:
+        webhook = WebhookServer(watcher, host=args.webhook_host, port=args.webhook_port,
+                                token=args.webhook_token).start()
+        print(f"Listening for push notifications on {webhook.url}, health on /health")
+
+    def shutdown(signum, frame):
+        print("Stopping after the current cycle...")
+        watcher.stop()
+
+    previous = {sig: signal.signal(sig, shutdown) for sig in (signal.SIGINT, signal.SIGTERM)}
+    print(f"Watching for new mail, polling every {args.poll_interval}s")
+    try:
+        watcher.run()
+    finally:
+        for sig, handler in previous.items():
+            signal.signal(sig, handler)
+        if webhook is not None:
+            webhook.stop()
+    health = watcher.health()
+    print(f"Stopped after {health['cycles']} cycle(s), {health['errors']} error(s)")
+
 def main():
     parser = argparse.ArgumentParser(description='Email Client CLI')
     parser.add_argument('-c', '--count', type=int, default=10,
                       help='Number of emails to fetch (default: 10)')
     parser.add_argument('--refresh', action='store_true',
                       help='Refresh database with new emails')
+    parser.add_argument('--sync', action='store_true',
+                      help='Incrementally sync changes since the last run (full resync when needed)')
+    parser.add_argument('--all', action='store_true',
+                      help='Sync the whole mailbox instead of the newest --count emails')
+    parser.add_argument('-q', '--query',
+                      help='Gmail search query to filter synced emails')
+    parser.add_argument('--rules', action='store_true',
+                      help='Apply rules to the stored emails')
+    parser.add_argument('--reapply', action='store_true',
+                      help='With --rules, evaluate every stored email again')
+    parser.add_argument('--db',
+                      help='Path of the SQLite database (default: src/database/emails.db or $ECLIENT_DB_PATH)')
     parser.add_argument('--display', action='store_true',
                       help='Display fetched emails')
     parser.add_argument('--mark-read', action='store_true',
                       help='Mark all fetched emails as read')
     parser.add_argument('--mark-unread', action='store_true',
                       help='Mark all fetched emails as unread')
+    parser.add_argument('--body-workers', type=int,
+                      help='Processes used to strip HTML bodies when fetching in bulk')
+    parser.add_argument('--concurrency', type=int, default=1,
+                      help='Gmail requests to run concurrently when fetching and marking (default: 1)')
+    parser.add_argument('--pipeline', action='store_true',
+                      help='Fetch through concurrent list/fetch/parse/store/evaluate/act stages and report each stage')
+    parser.add_argument('--fetch-workers', type=int, default=FETCH_WORKERS,
+                      help=f'With --pipeline, threads fetching messages (default: {FETCH_WORKERS})')
+    parser.add_argument('--parse-workers', type=int, default=PARSE_WORKERS,
+                      help=f'With --pipeline, threads parsing messages (default: {PARSE_WORKERS})')
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE,
+                      help=f'With --pipeline, chunks waiting between two stages at most (default: {QUEUE_SIZE})')
+    parser.add_argument('--workers', type=int,
+                      help='Processes used to evaluate rules over the stored emails')
+    parser.add_argument('--watch', action='store_true',
+                      help='Keep running, sync and apply rules whenever new mail arrives')
+    parser.add_argument('--poll-interval', type=float, default=30,
+                      help='With --watch, seconds between history polls (default: 30)')
+    parser.add_argument('--webhook-port', type=int,
+                      help='With --watch, serve Gmail push notifications and /health on this port')
+    parser.add_argument('--webhook-host', default='127.0.0.1',
+                      help='Address the --webhook-port server binds to (default: 127.0.0.1)')
+    parser.add_argument('--webhook-token',
+                      help='Secret push requests must carry as ?token=, required unless bound to a loopback address')
+    parser.add_argument('--watch-topic',
+                      help='With --watch, Pub/Sub topic Gmail publishes changes to (projects/<id>/topics/<name>)')
+    parser.add_argument('--profile', nargs='?', const='json', choices=['json', 'prometheus'],
+                      help='Time each stage and count API calls and rows, report at exit (default format: json)')
+    parser.add_argument('--profile-file',
+                      help='Write the --profile report to this file instead of printing it')
     
     args = parser.parse_args()
+    configure_database(args.db)
+    profiler.enable(bool(args.profile))
 
-    gmail = gmailApi()
+    gmail = gmailApi(body_workers=args.body_workers)
     db = EmailDatabase()
-    rule_engine = RuleEngine()
+    rule_engine = RuleEngine(gmail=gmail, db=db)
 
     try:
         if args.display:
@@ -45,7 +171,12 @@ def main():
 
         if args.mark_read or args.mark_unread:
             emails = gmail.fetch_emails(count=args.count)
-            if emails:
+            if emails and args.concurrency > 1:
+                for read in (True, False):
+                    if (args.mark_read if read else args.mark_unread):
+                        marked = asyncio.run(mark_emails_async(emails, read, args.concurrency))
+                        print(f"Marked {sum(marked)} email(s) as {'read' if read else 'unread'}")
+            elif emails:
                 for email in emails:
                     if args.mark_read:
                         gmail.mark_as_read(email['id'])
@@ -55,29 +186,31 @@ def main():
                         print(f"Marked as unread: {email['subject'][:50]}...")
             return
 
+        if args.watch:
+            watch(gmail, db, rule_engine, args)
+            return
+
         # Original functionality
         if args.refresh:
-            print(f"Fetching {args.count} emails...")
-            emails = gmail.fetch_emails(count=args.count)
-            if not emails:
+            print("Fetching all emails..." if args.all else f"Fetching {args.count} emails...")
+            stored = sync_emails(gmail, db, args, with_body=rule_engine.needs_body,
+                                 rule_engine=rule_engine if args.rules and not args.reapply else None)
+            if not stored:
                 print("No emails found")
                 return
+            print(f"Stored/Updated {stored} email(s)")
 
-            print("\nStoring emails in database...")
-            for email in emails:
-                success = db.store_email(email)
-                if success:
-                    print(f"Stored/Updated email: {email['subject'][:50]}...")
-                else:
-                    print(f"Failed to store email: {email['subject'][:50]}...")
+        if args.sync:
+            result = MailboxSync(gmail, db, with_body=rule_engine.needs_body).run(limit=None if args.all else args.count)
+            print(f"{result['mode'].capitalize()} sync: {result['added']} added, "
+                  f"{result['deleted']} deleted, {result['updated']} updated")
 
+        if args.rules:
+            rule_engine.process_emails(full=args.reapply, workers=args.workers)
 
-        if not args.refresh and not args.rules:
-            emails = gmail.fetch_emails(count=args.count)
-            if emails:
-                for email in emails:
-                    db.store_email(email)
-                rule_engine.process_emails()
+        if not args.refresh and not args.sync and not args.rules:
+            if sync_emails(gmail, db, args, with_body=rule_engine.needs_body, rule_engine=rule_engine):
+                rule_engine.process_emails(workers=args.workers)
 
     except Exception as e:
         print(f"Error: {e}")
@@ -85,6 +218,12 @@ def main():
     finally:
         db.close()
         rule_engine.close()
+        usage = default_limiter().usage()
+        if usage['units']:
+            print(f"Gmail quota used: {usage['units']} units, {usage['retries']} retries")
+        if args.profile:
+            profiler.dump(args.profile, args.profile_file)
+            profiler.enable(False)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
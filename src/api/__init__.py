@@ -1,4 +1,8 @@
-from .gmail_api import gmailApi
-from .oauth import create_service
+from .gmail_api import gmailApi, HistoryExpiredError
+from .async_gmail_api import AsyncGmailApi
+from .labels import LabelRegistry
+from .oauth import create_service, get_service
+from .quota import QuotaLimiter, default_limiter
 
-__all__ = ['gmailApi', 'create_service']
\ No newline at end of file
+__all__ = ['gmailApi', 'AsyncGmailApi', 'HistoryExpiredError', 'LabelRegistry', 'create_service',
+           'get_service', 'QuotaLimiter', 'default_limiter']
\ No newline at end of file
@@ -0,0 +1,138 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from googleapiclient.errors import HttpError
+from .gmail_api import gmailApi, new_service, PAGE_SIZE, MAX_BATCH_MODIFY_IDS, HISTORY_TYPES
+from .labels import LabelRegistry, LABEL_CACHE_FILE
+from .quota import default_limiter
+
+# requests in flight at once, Gmail allows a user roughly 50 message gets per second
+DEFAULT_CONCURRENCY = 8
+
+
+class AsyncGmailApi:
+    '''
+    asyncio variant of gmailApi with the same methods as coroutines.
+    Calls run on a pool of `concurrency` threads. Each thread keeps its own
+    gmailApi and HTTP connection, since httplib2 is not thread safe, and
+    reuses it for every call, so at most `concurrency` requests are in
+    flight and connections stay open between them. Label lookups go
+    through one shared LabelRegistry and every thread draws on the same
+    quota limiter.
+    '''
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, service_factory=None, label_cache=LABEL_CACHE_FILE,
+                 limiter=None, body_workers=None):
+        self.concurrency = max(1, concurrency)
+        # called once per pool thread to build that thread's service
+        self.service_factory = service_factory or new_service
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='gmail')
+        self.local = threading.local()
+        self.limiter = limiter or default_limiter()
+        self.body_workers = body_workers
+        self.labels = LabelRegistry(self.service_factory(), cache_file=label_cache, limiter=self.limiter)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def _client(self):
+        # gmailApi of the current pool thread
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = gmailApi(service=self.service_factory(), label_cache=None, limiter=self.limiter,
+                              body_workers=self.body_workers)
+            client.labels = self.labels
+            self.local.client = client
+        return client
+
+    async def _run(self, func):
+        # Run func(client) on a pool thread
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: func(self._client()))
+
+    async def _call(self, method, *args, **kwargs):
+        return await self._run(lambda client: getattr(client, method)(*args, **kwargs))
+
+    async def mark_as_read(self, email_id):
+        return await self._call('mark_as_read', email_id)
+
+    async def mark_as_unread(self, email_id):
+        return await self._call('mark_as_unread', email_id)
+
+    async def move_message(self, email_id, folder_name):
+        return await self._call('move_message', email_id, folder_name)
+
+    async def batch_modify(self, ids, add_label_ids=(), remove_label_ids=()):
+        # chunks of MAX_BATCH_MODIFY_IDS are sent concurrently
+        chunks = [list(ids[start:start + MAX_BATCH_MODIFY_IDS]) for start in range(0, len(ids), MAX_BATCH_MODIFY_IDS)]
+        modified = await asyncio.gather(*[
+            self._call('batch_modify', chunk, add_label_ids, remove_label_ids) for chunk in chunks
+        ])
+        return list(chain.from_iterable(modified))
+
+    async def get_profile(self):
+        return await self._call('get_profile')
+
+    async def list_history(self, start_history_id, history_types=HISTORY_TYPES):
+        return await self._call('list_history', start_history_id, history_types)
+
+    async def fetch_emails(self, count=10, batch_size=None, with_body=True):
+        emails = [email async for email in self.iter_emails(limit=count, batch_size=batch_size, with_body=with_body)]
+        if not emails: # if no messages found
+            print('No messages found')
+            return []
+        print(f'{len(emails)} message(s) found')
+        return emails
+
+    async def iter_emails(self, query=None, page_size=PAGE_SIZE, limit=None, label_ids=('INBOX',), batch_size=None,
+                          with_body=True):
+        # Async generator over the mailbox. The next page is listed while the
+        # messages of the current one are fetched. Listing and fetch errors are
+        # raised like gmailApi.iter_emails does
+        listed = 0
+        next_page = None
+        try:
+            size = page_size if limit is None else min(page_size, limit)
+            next_page = asyncio.ensure_future(self._call('list_messages', query, size, None, label_ids))
+            while next_page is not None:
+                ids, page_token = await next_page
+                listed += len(ids)
+                next_page = None
+                if page_token and (limit is None or listed < limit):
+                    size = page_size if limit is None else min(page_size, limit - listed)
+                    next_page = asyncio.ensure_future(self._call('list_messages', query, size, page_token, label_ids))
+
+                for email in await self.get_emails(ids, batch_size=batch_size, with_body=with_body):
+                    yield email
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    async def get_emails(self, ids, batch_size=None, with_body=True):
+        # Fetch and parse messages concurrently, keeping the order of ids. Without
+        # batch_size every message is its own request, otherwise batch requests
+        # of batch_size messages are sent concurrently
+        if batch_size:
+            chunks = [ids[start:start + batch_size] for start in range(0, len(ids), batch_size)]
+            pages = await asyncio.gather(*[self._call('get_emails', chunk, batch_size, with_body) for chunk in chunks])
+            return list(chain.from_iterable(pages))
+        messages = await asyncio.gather(*[self._get_message(msg_id, with_body) for msg_id in ids])
+        messages = [message for message in messages if message is not None]
+        # parsed together so bodies can be extracted in bulk
+        return await self._call('parse_messages', messages, with_body)
+
+    async def _get_message(self, msg_id, with_body=True):
+        # None for a message that no longer exists (404), other errors are raised
+        try:
+            return await self._run(lambda client: client.get_message(msg_id, **client.message_params(with_body)))
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            return None
@@ -0,0 +1,69 @@
+import hashlib
+import json
+import os
+import time
+from urllib.parse import parse_qs, urlparse
+from googleapiclient.discovery_cache.base import Cache
+
+DISCOVERY_CACHE_DIR = 'cache/discovery'
+# the document changes with new API revisions, refetch it once a day
+DISCOVERY_TTL = 24 * 60 * 60
+
+
+class DiscoveryCache(Cache):
+    '''
+    On disk cache of API discovery documents for googleapiclient's build().
+    A document is served while it is younger than `ttl` and is still the
+    document of the API name and version the url asks for, otherwise build()
+    downloads it again and stores the new one.
+    '''
+
+    def __init__(self, cache_dir=DISCOVERY_CACHE_DIR, ttl=DISCOVERY_TTL):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+
+    def _path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, url):
+        path = self._path(url)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path, encoding='utf-8') as f:
+                content = f.read()
+            document = json.loads(content)
+        except (OSError, ValueError):
+            return None
+        if not _matches(url, document):
+            return None
+        return content
+
+    def set(self, url, content):
+        path = self._path(url)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # written aside and renamed so a concurrent reader never sees half a document
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error caching discovery document: {e}")
+
+
+def _matches(url, document):
+    # The cached document has to describe the API name and version in the url,
+    # https://gmail.googleapis.com/$discovery/rest?version=v1 or
+    # https://www.googleapis.com/discovery/v1/apis/gmail/v1/rest
+    parsed = urlparse(url)
+    name = document.get('name')
+    version = document.get('version')
+    if not name or not version:
+        return False
+    if name not in parsed.netloc.split('.') and f'/{name}/' not in parsed.path:
+        return False
+    wanted = parse_qs(parsed.query).get('version')
+    if wanted:
+        return wanted[0] == version
+    return f'/{name}/{version}/' in parsed.path
@@ -1,25 +1,78 @@
-from .oauth import create_service
-import base64
-from bs4 import BeautifulSoup
+from .oauth import create_service, get_service
+from .labels import LabelRegistry, LABEL_CACHE_FILE
+from .quota import default_limiter, execute, call_with_retries, is_retryable, backoff_delay
+from .mime import decode_part, default_cache, extract_body, extract_bodies, html_to_text
+import time
+from googleapiclient.errors import HttpError
+from src.utils.profiler import span
+
+# Gmail accepts at most 100 calls per batch request, larger batches
+# are more likely to be rate limited so default to a smaller size
+MAX_BATCH_SIZE = 100
+BATCH_SIZE = 50
+BATCH_RETRIES = 2
+# messages.list returns at most 500 ids per page
+MAX_PAGE_SIZE = 500
+PAGE_SIZE = 100
+# messages.batchModify accepts at most 1000 ids per call
+MAX_BATCH_MODIFY_IDS = 1000
+HISTORY_TYPES = ('messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved')
+# headers kept when bodies are not needed, and the parts of the response read from them
+METADATA_HEADERS = ['From', 'To', 'Subject', 'Date']
+METADATA_FIELDS = 'id,threadId,labelIds,snippet,payload(mimeType,headers)'
+
+CRED_FILE = 'config/client_secret.json'
+API_SERVICE_NAME = 'gmail'
+API_VERSION = 'v1'
+SCOPES = ['https://mail.google.com/']
+
+
+def default_service():
+    # Authorized Gmail service from the stored token or the OAuth flow, one
+    # per process shared by every gmailApi
+    return get_service(CRED_FILE, API_SERVICE_NAME, API_VERSION, SCOPES)
+
+
+def new_service():
+    # A Gmail service of its own, for a thread of a pool. Shares the
+    # credentials and the cached discovery document of the process
+    return create_service(CRED_FILE, API_SERVICE_NAME, API_VERSION, SCOPES)
+
+
+class HistoryExpiredError(Exception):
+    # raised when a stored historyId is too old for users.history.list
+    pass
 
 
 class gmailApi:
 
-    def __init__(self):
-        self.CRED_FILE = 'config/client_secret.json'
-        self.API_SERVICE_NAME = 'gmail'
-        self.API_VERSION = 'v1'
-        self.SCOPES = ['https://mail.google.com/']
+    def __init__(self, service=None, label_cache=LABEL_CACHE_FILE, limiter=None, body_workers=None):
+        self.CRED_FILE = CRED_FILE
+        self.API_SERVICE_NAME = API_SERVICE_NAME
+        self.API_VERSION = API_VERSION
+        self.SCOPES = SCOPES
+
+        # Gmail service shared by the process, an already built service can be passed in
+        self.service = service or default_service()
+        # every call is paced by a quota limiter shared by the whole process
+        self.limiter = limiter or default_limiter()
+        self.labels = LabelRegistry(self.service, cache_file=label_cache, limiter=self.limiter)
+        # extracted bodies are cached process wide, HTML of bulk fetches is
+        # stripped on body_workers processes when set
+        self.body_cache = default_cache
+        self.body_workers = body_workers
+
+    def _execute(self, request):
+        # Execute a request within the quota, retrying rate limits and server errors
+        return execute(request, self.limiter)
 
-        # Create gmail service instance 
-        self.service = create_service(self.CRED_FILE,self.API_SERVICE_NAME,self.API_VERSION,self.SCOPES)
     def mark_as_read(self, email_id):
         try:
-            self.service.users().messages().modify(
+            self._execute(self.service.users().messages().modify(
                 userId='me',
                 id=email_id,
                 body={'removeLabelIds': ['UNREAD']}
-            ).execute()
+            ))
             return True
         except Exception as e:
             print(f"Error marking email as read: {e}")
@@ -27,128 +80,269 @@ class gmailApi:
 
     def mark_as_unread(self, email_id):
         try:
-            self.service.users().messages().modify(
+            self._execute(self.service.users().messages().modify(
                 userId='me',
                 id=email_id,
                 body={'addLabelIds': ['UNREAD']}
-            ).execute()
+            ))
             return True
         except Exception as e:
             print(f"Error marking email as unread: {e}")
             return False
 
-    def fetch_emails(self,count=10):
-        try:
-            results = self.service.users().messages().list(userId='me',labelIds=['INBOX'],maxResults=count).execute()
-            messages = results.get('messages',[])
-
-            if not messages: # if no messages found
-                print('No messages found')
-                return []
-            
-            print(f'{len(messages)} message(s) found')
-            
+    def batch_modify(self, ids, add_label_ids=(), remove_label_ids=()):
+        # Apply the same label change to many messages, returns the ids that were modified
+        modified = []
+        for start in range(0, len(ids), MAX_BATCH_MODIFY_IDS):
+            chunk = list(ids[start:start + MAX_BATCH_MODIFY_IDS])
+            try:
+                self._execute(self.service.users().messages().batchModify(
+                    userId='me',
+                    body={
+                        'ids': chunk,
+                        'addLabelIds': list(add_label_ids),
+                        'removeLabelIds': list(remove_label_ids)
+                    }
+                ))
+                modified.extend(chunk)
+            except Exception as e:
+                print(f"Error modifying {len(chunk)} email(s): {e}")
+        return modified
 
-            emails = []
-            for msg in messages:
-                message = self.service.users().messages().get(userId='me',id=msg['id']).execute() # fetch the message using service
-
-                # Extract the headers from the message and storing it as a dict
-                headers = {}
-                for header in message['payload']['headers']:
-                    headers[header['name']] = header['value']
-
-                # Extract the email data from the message and storing it as a dict
-                # Extracting body data
-                body = self.extract_body_content(message)
-                
-                # Check for attachments
-                has_attachment = False
-                attachment_types = []
-                
-                if 'parts' in message['payload']:
-                    for part in message['payload']['parts']:
-                        if 'filename' in part and part['filename']:
-                            has_attachment = True
-                            if 'mimeType' in part:
-                                attachment_types.append(part['mimeType'])
-
-                email_data = {
-                    'id':msg['id'],
-                    'subject':headers.get('Subject','No Subject'),
-                    'snippet':message.get('snippet',''),
-                    'from': headers.get('From','No Sender'),
-                    'to': headers.get('To','No Receipient'),
-                    'date': headers.get('Date','No Date'),
-                    'labels': message.get('labelIds',[]),
-                    'body': body,
-                    'has_attachment': has_attachment,
-                    'attachment_types': attachment_types,
-                    'is_read': 'UNREAD' not in message.get('labelIds', [])
-                }
-                emails.append(email_data)
-            return emails
-        except Exception as e:
-            print(e)
+    def fetch_emails(self,count=10,batch_size=BATCH_SIZE,with_body=True):
+        emails = list(self.iter_emails(limit=count, batch_size=batch_size, with_body=with_body))
+        if not emails: # if no messages found
+            print('No messages found')
             return []
+        print(f'{len(emails)} message(s) found')
+        return emails
+
+    def iter_emails(self, query=None, page_size=PAGE_SIZE, limit=None, label_ids=('INBOX',), batch_size=BATCH_SIZE,
+                    with_body=True):
+        # Generator over the mailbox, follows nextPageToken and yields parsed
+        # emails page by page so only one page is held in memory at a time.
+        # Without with_body only the headers are downloaded
+        # Listing and fetch errors that survive the retries are raised, a
+        # caller never mistakes a failed listing for a short mailbox
+        for ids, emails in self.iter_pages(query, page_size, limit, label_ids, batch_size, with_body):
+            yield from emails
+
+    def iter_pages(self, query=None, page_size=PAGE_SIZE, limit=None, label_ids=('INBOX',), batch_size=BATCH_SIZE,
+                   with_body=True):
+        # (listed ids, parsed emails) per page of the listing. Emails missing
+        # from a page were deleted between the listing and the fetch
+        params = self.message_params(with_body)
+        page_token = None
+        listed = 0
+        while limit is None or listed < limit:
+            size = page_size if limit is None else min(page_size, limit - listed)
+            ids, page_token = self.list_messages(query, size, page_token, label_ids)
+            listed += len(ids)
+
+            if batch_size:
+                fetched = self.get_messages_batch(ids, batch_size=batch_size, **params)
+            else:
+                # serial mode, one round trip per message
+                fetched = {}
+                for msg_id in ids:
+                    try:
+                        fetched[msg_id] = self.get_message(msg_id, **params)
+                    except HttpError as e:
+                        if e.resp.status != 404:
+                            raise
+
+            # keep the listing order, skipping messages that no longer exist
+            yield ids, self.parse_messages([fetched[msg_id] for msg_id in ids if msg_id in fetched], with_body)
+
+            if not page_token:
+                break
+
+    def list_messages(self, query=None, page_size=PAGE_SIZE, page_token=None, label_ids=('INBOX',)):
+        # One page of messages.list, returns (message ids, next page token)
+        params = {'userId': 'me', 'maxResults': min(page_size, MAX_PAGE_SIZE)}
+        if label_ids:
+            params['labelIds'] = list(label_ids)
+        if query:
+            params['q'] = query
+        if page_token:
+            params['pageToken'] = page_token
+        results = self._execute(self.service.users().messages().list(**params))
+        return [msg['id'] for msg in results.get('messages', [])], results.get('nextPageToken')
+
+    def get_message(self, msg_id, **params):
+        return self._execute(self.service.users().messages().get(userId='me', id=msg_id, **params))
+
+    def message_params(self, with_body=True):
+        # messages.get parameters, metadata format with a fields mask when the
+        # body and attachments are not needed
+        if with_body:
+            return {}
+        return {'format': 'metadata', 'metadataHeaders': METADATA_HEADERS, 'fields': METADATA_FIELDS}
+
+    def get_emails(self, ids, batch_size=BATCH_SIZE, with_body=True):
+        # Fetch and parse the given message ids, skipping ones that no longer exist
+        fetched = self.get_messages_batch(ids, batch_size=batch_size, **self.message_params(with_body))
+        return self.parse_messages([fetched[msg_id] for msg_id in ids if msg_id in fetched], with_body)
+
+    def get_profile(self):
+        return self._execute(self.service.users().getProfile(userId='me'))
+
+    def watch(self, topic_name, label_ids=('INBOX',)):
+        # Ask Gmail to publish mailbox changes to a Cloud Pub/Sub topic, returns
+        # {'historyId', 'expiration'}. The watch lapses after 7 days unless renewed
+        body = {'topicName': topic_name, 'labelIds': list(label_ids), 'labelFilterBehavior': 'include'}
+        return self._execute(self.service.users().watch(userId='me', body=body))
+
+    def stop_watch(self):
+        return self._execute(self.service.users().stop(userId='me'))
+
+    def list_history(self, start_history_id, history_types=HISTORY_TYPES):
+        # Return (history records, latest historyId) since start_history_id
+        records = []
+        page_token = None
+        while True:
+            params = {'userId': 'me', 'startHistoryId': start_history_id, 'historyTypes': list(history_types)}
+            if page_token:
+                params['pageToken'] = page_token
+            try:
+                results = self._execute(self.service.users().history().list(**params))
+            except HttpError as e:
+                # Gmail answers 404 once the start id falls out of its history window
+                if e.resp.status == 404:
+                    raise HistoryExpiredError(start_history_id) from e
+                raise
+            records.extend(results.get('history', []))
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return records, results.get('historyId', start_history_id)
+
+    def get_messages_batch(self, ids, batch_size=BATCH_SIZE, **params):
+        # Fetch messages through Gmail batch requests, returns {id: message}.
+        # Messages that no longer exist (404) are left out, any other failure
+        # that outlasts the retries is raised
+        batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+        fetched = {}
+        pending = list(ids)
+        errors = {}  # message id -> last error
+
+        for attempt in range(BATCH_RETRIES + 1):
+            failed = []
+
+            def callback(request_id, response, exception):
+                if exception is None:
+                    fetched[response['id']] = response
+                elif self._is_retryable(exception):
+                    failed.append(request_id)
+                    errors[request_id] = exception
+                elif isinstance(exception, HttpError) and exception.resp.status == 404:
+                    print(f"Message {request_id} no longer exists")
+                else:
+                    raise exception
+
+            for start in range(0, len(pending), batch_size):
+                chunk = pending[start:start + batch_size]
+
+                def send():
+                    # a new batch per attempt, a failed batch request runs none of its callbacks
+                    batch = self.service.new_batch_http_request(callback=callback)
+                    for msg_id in chunk:
+                        # request_id is the message id so failures can be retried by id
+                        batch.add(self.service.users().messages().get(userId='me', id=msg_id, **params),
+                                  request_id=msg_id)
+                    batch.execute()
+
+                # every call of a batch is charged like a separate request, the
+                # batch request itself is retried on rate limits and transport errors
+                call_with_retries(send, 'gmail.users.messages.get', len(chunk), limiter=self.limiter, name='api.batch')
+
+            if not failed:
+                break
+            pending = failed
+            if attempt < BATCH_RETRIES:
+                self.limiter.record_retry()
+                time.sleep(backoff_delay(attempt))
+        else:
+            print(f"Giving up on {len(pending)} message(s) after {BATCH_RETRIES} retries")
+            raise errors[pending[0]]
+
+        return fetched
+
+    def _is_retryable(self, exception):
+        return is_retryable(exception)
+
+    def parse_messages(self, messages, with_body=True):
+        # parse_message over a page of messages, their bodies extracted in bulk
+        with span('gmail.parse'):
+            if with_body and self.body_workers:
+                extract_bodies([message['payload'] for message in messages], self.body_workers, self.body_cache)
+            return [self.parse_message(message, with_body=with_body) for message in messages]
+
+    def parse_message(self, message, with_body=True):
+        # Extract the headers from the message and storing it as a dict
+        headers = {}
+        for header in message['payload']['headers']:
+            headers[header['name']] = header['value']
+
+        # Extract the email data from the message and storing it as a dict
+        # Extracting body data, None when only the metadata was fetched
+        body = self.extract_body_content(message) if with_body else None
+        
+        # Check for attachments, unknown without the body parts
+        has_attachment = False if with_body else None
+        attachment_types = [] if with_body else None
+        
+        if with_body and 'parts' in message['payload']:
+            for part in message['payload']['parts']:
+                if 'filename' in part and part['filename']:
+                    has_attachment = True
+                    if 'mimeType' in part:
+                        attachment_types.append(part['mimeType'])
+
+        return {
+            'id':message['id'],
+            'subject':headers.get('Subject','No Subject'),
+            'snippet':message.get('snippet',''),
+            'from': headers.get('From','No Sender'),
+            'to': headers.get('To','No Receipient'),
+            'date': headers.get('Date','No Date'),
+            'labels': message.get('labelIds',[]),
+            'body': body,
+            'has_attachment': has_attachment,
+            'attachment_types': attachment_types,
+            'is_read': 'UNREAD' not in message.get('labelIds', [])
+        }
+
     def decode_and_clean(self, data):
-        try:
-            decoded_bytes = base64.urlsafe_b64decode(data)
-            text = decoded_bytes.decode('utf-8')
-            
-            if '<html' in text.lower() or '<div' in text.lower():
-                soup = BeautifulSoup(text, 'html.parser')
-                return soup.get_text(separator='\n', strip=True)
-            return text
-        except:
-            return ''
+        text, is_html = decode_part({'body': {'data': data}})
+        return html_to_text(text) if is_html else text
+
     def extract_body_content(self, message):
-        if 'parts' in message['payload']:
-            for part in message['payload']['parts']:
-                if part['mimeType'] in ['text/plain', 'text/html']:
-                    data = part['body'].get('data', '')
-                    if data:
-                        return self.decode_and_clean(data)
-        
-        if 'body' in message['payload']:
-            data = message['payload']['body'].get('data', '')
-            if data:
-                return self.decode_and_clean(data)
-                
-        return ''
+        # Walks the whole MIME tree, see src/api/mime.py
+        return extract_body(message['payload'], self.body_cache)
     def move_message(self, email_id, folder_name):
         try:
-            # Get all labels
-            labels = self.service.users().labels().list(userId='me').execute()
-            
-            # Find or create the destination folder/label
-            label_id = None
-            for label in labels.get('labels', []):
-                if label['name'].lower() == folder_name.lower():
-                    label_id = label['id']
-                    break
-            
-            # If label doesn't exist, create it
-            if not label_id:
-                label = self.service.users().labels().create(
-                    userId='me',
-                    body={'name': folder_name}
-                ).execute()
-                label_id = label['id']
-            
-            # Move message by adding new label and removing from inbox
-            self.service.users().messages().modify(
-                userId='me',
-                id=email_id,
-                body={
-                    'addLabelIds': [label_id],
-                    'removeLabelIds': ['INBOX']
-                }
-            ).execute()
+            label_id = self.labels.resolve(folder_name)
+            try:
+                self._move(email_id, label_id)
+            except HttpError as e:
+                # the cached label may have been deleted in Gmail, resolve it again once
+                if e.resp.status not in (400, 404):
+                    raise
+                self.labels.invalidate(folder_name)
+                self._move(email_id, self.labels.resolve(folder_name))
             return True
             
         except Exception as e:
             print(f"Error moving message: {e}")
             return False
 
-           
\ No newline at end of file
+    def _move(self, email_id, label_id):
+        # Move message by adding new label and removing from inbox
+        self._execute(self.service.users().messages().modify(
+            userId='me',
+            id=email_id,
+            body={
+                'addLabelIds': [label_id],
+                'removeLabelIds': ['INBOX']
+            }
+        ))
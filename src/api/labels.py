@@ -0,0 +1,85 @@
+import json
+import os
+import threading
+from src.utils.profiler import incr
+from .quota import execute
+
+LABEL_CACHE_FILE = 'cache/labels.json'
+
+
+class LabelRegistry:
+    '''
+    Resolves Gmail label names to label ids.
+    Names are matched case-insensitively like Gmail does, the name -> id
+    mapping is kept in memory and in LABEL_CACHE_FILE so labels.list only
+    runs when a name is not known yet. One registry can be shared by
+    clients on several threads, lookups and creation are serialized so a
+    new label is only created once.
+    '''
+
+    def __init__(self, service, cache_file=LABEL_CACHE_FILE, limiter=None):
+        self.service = service
+        self.limiter = limiter
+        self.cache_file = cache_file
+        self.labels = self._load()
+        self.names = {}  # label id -> name as Gmail spells it, filled by labels.list
+        self.lock = threading.RLock()
+
+    def _load(self):
+        if self.cache_file and os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file, 'r') as f:
+                    return json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable label cache: {e}")
+        return {}
+
+    def _save(self):
+        if not self.cache_file:
+            return
+        cache_dir = os.path.dirname(self.cache_file)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        with open(self.cache_file, 'w') as f:
+            json.dump(self.labels, f, indent=4)
+
+    def refresh(self):
+        # Reload every label from Gmail
+        with self.lock:
+            self._refresh()
+
+    def _refresh(self):
+        labels = execute(self.service.users().labels().list(userId='me'), self.limiter)
+        self.labels = {label['name'].lower(): label['id'] for label in labels.get('labels', [])}
+        self.names = {label['id']: label['name'] for label in labels.get('labels', [])}
+        self._save()
+
+    def resolve(self, name, create=True):
+        incr('label_lookups')
+        key = name.lower()
+        with self.lock:
+            if key not in self.labels:
+                self._refresh()
+            if key not in self.labels:
+                if not create:
+                    return None
+                label = execute(self.service.users().labels().create(userId='me', body={'name': name}), self.limiter)
+                self.labels[key] = label['id']
+                self.names[label['id']] = name
+                self._save()
+            return self.labels[key]
+
+    def name(self, label_id):
+        # Name of a label id, None for an unknown id
+        with self.lock:
+            if label_id not in self.names:
+                self._refresh()
+                # a deleted label is not looked up again
+                self.names.setdefault(label_id, None)
+            return self.names[label_id]
+
+    def invalidate(self, name):
+        # Forget a cached id, e.g. after Gmail rejected it because the label was deleted
+        with self.lock:
+            if self.labels.pop(name.lower(), None) is not None:
+                self._save()
@@ -0,0 +1,224 @@
+import atexit
+import base64
+import hashlib
+import html
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from src.utils.profiler import incr
+
+'''
+Body extraction for Gmail message payloads.
+The whole MIME tree is walked and text/plain is preferred over text/html.
+HTML is reduced to text by a single regex pass instead of a parse tree.
+The output matches BeautifulSoup(html, 'html.parser').get_text('\n', strip=True)
+for the markup found in mail. Extracted text is cached by a hash of the
+encoded part, and bulk fetches can strip HTML on a process pool.
+'''
+
+# Everything that is not text: script, style and template elements (their
+# content is not text to get_text either), comments, CDATA sections (group 2
+# is their text) and tags
+MARKUP = re.compile(
+    r'<(script|style|template)\b(?:"[^"]*"|\'[^\']*\'|[^\'">])*>.*?</\1\s*>'
+    r'|<!--.*?(?:-->|$)'
+    r'|<!\[CDATA\[(.*?)\]\]>'
+    r'|</?[a-zA-Z!?](?:"[^"]*"|\'[^\']*\'|[^\'">])*>',
+    re.S | re.I
+)
+LOOKS_LIKE_HTML = re.compile(r'<(?:html|div)\b', re.I)
+
+CACHE_SIZE = 2048
+# bodies shorter than this are stripped in process, shipping them to a worker costs more
+POOL_MIN_SIZE = 16 * 1024
+
+
+def _text(piece):
+    if '&' in piece:
+        piece = html.unescape(piece)
+    return piece.strip()
+
+
+def html_to_text(markup):
+    # Text nodes of an HTML document, stripped, one per line
+    lines = []
+    start = 0
+    for match in MARKUP.finditer(markup):
+        if match.start() > start:
+            text = _text(markup[start:match.start()])
+            if text:
+                lines.append(text)
+        cdata = match.group(2)
+        if cdata and cdata.strip():
+            lines.append(cdata.strip())
+        start = match.end()
+    text = _text(markup[start:])
+    if text:
+        lines.append(text)
+    return '\n'.join(lines)
+
+
+def walk_parts(payload):
+    # Depth first over every part of a payload, the payload itself included
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        yield part
+        stack.extend(reversed(part.get('parts') or []))
+
+
+def _charset(part):
+    for header in part.get('headers') or []:
+        if header.get('name', '').lower() == 'content-type':
+            match = re.search(r'charset="?([\w.:-]+)"?', header.get('value', ''), re.I)
+            if match:
+                return match.group(1)
+    return 'utf-8'
+
+
+def body_part(payload):
+    # The inline text/plain part of the message, else its text/html part
+    found = {}
+    for part in walk_parts(payload):
+        mime_type = part.get('mimeType', '')
+        if part.get('filename') or mime_type not in ('text/plain', 'text/html'):
+            continue
+        if (part.get('body') or {}).get('data'):
+            found.setdefault(mime_type, part)
+            if mime_type == 'text/plain':
+                break
+    if 'text/plain' in found:
+        return found['text/plain']
+    if 'text/html' in found:
+        return found['text/html']
+    # single part messages of another type still carry their text in the payload body
+    if (payload.get('body') or {}).get('data') and not payload.get('parts'):
+        return payload
+    return None
+
+
+def decode_part(part):
+    # Decoded text of a part and whether it has to be stripped of HTML
+    data = part['body']['data']
+    try:
+        raw = base64.urlsafe_b64decode(data)
+    except (ValueError, TypeError):
+        return '', False
+    incr('bytes_decoded', len(raw))
+    try:
+        text = raw.decode(_charset(part), errors='replace')
+    except LookupError:
+        text = raw.decode('utf-8', errors='replace')
+    is_html = part.get('mimeType') == 'text/html' or LOOKS_LIKE_HTML.search(text) is not None
+    return text, is_html
+
+
+def _key(part):
+    return hashlib.sha1(part['body']['data'].encode('ascii', 'replace')).hexdigest()
+
+
+class BodyCache:
+    '''
+    LRU cache of extracted body text keyed by the hash of the encoded part,
+    so a message fetched again (a resync, the same newsletter to many
+    threads) is not decoded and stripped twice. Safe to share across threads
+    '''
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, text):
+        with self.lock:
+            self.entries[key] = text
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+
+default_cache = BodyCache()
+
+
+def extract_body(payload, cache=default_cache):
+    # Plain text body of a message payload, '' when it has none
+    part = body_part(payload)
+    if part is None:
+        return ''
+    key = _key(part)
+    text = cache.get(key) if cache is not None else None
+    if text is None:
+        text, is_html = decode_part(part)
+        if is_html:
+            text = html_to_text(text)
+        if cache is not None:
+            cache.put(key, text)
+    return text
+
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def get_pool(workers):
+    # Process pool shared by every client, recreated if more workers are asked for
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers < workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=workers)
+            _pool_workers = workers
+        return _pool
+
+
+@atexit.register
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True)
+            _pool = None
+
+
+def extract_bodies(payloads, workers=None, cache=default_cache):
+    # extract_body over many payloads. With workers, large HTML bodies that
+    # are not cached yet are stripped on a process pool in parallel
+    if workers and workers > 1 and cache is not None:
+        pending = {}  # cache key -> decoded html
+        for payload in payloads:
+            part = body_part(payload)
+            if part is None or len(part['body']['data']) < POOL_MIN_SIZE:
+                continue
+            key = _key(part)
+            if key in pending or cache.get(key) is not None:
+                continue
+            text, is_html = decode_part(part)
+            if is_html:
+                pending[key] = text
+            else:
+                cache.put(key, text)
+        if len(pending) > 1:
+            pool = get_pool(workers)
+            chunksize = max(1, len(pending) // (workers * 4))
+            for key, text in zip(pending, pool.map(html_to_text, pending.values(), chunksize=chunksize)):
+                cache.put(key, text)
+    return [extract_body(payload, cache) for payload in payloads]
@@ -1,55 +1,98 @@
 import os
+import threading
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
+from .discovery import DiscoveryCache
 
 # Import Necessary Libraries
 
+TOKEN_DIR = 'token_files'
+
+# Credentials and services are shared by the whole process: the token is read,
+# refreshed or authorized once per token file, and the discovery document is
+# read from disk instead of being downloaded for every service
+_lock = threading.RLock()
+_credentials = {}  # token file -> Credentials
+_services = {}  # (api name, api version, prefix) -> service
+discovery_cache = DiscoveryCache()
+
+
+def token_path(api_name, api_version, prefix=''):
+    return os.path.join(os.getcwd(), TOKEN_DIR, f'token_{api_name}_{api_version}{prefix}.json')
+
+
+def get_credentials(client_secret_file, api_name, api_version, scopes, prefix=''):
+    # Valid credentials for the token file, loaded and refreshed at most once
+    # for every service of the process
+    token_file = token_path(api_name, api_version, prefix)
+    with _lock:
+        creds = _credentials.get(token_file)
+        if creds is not None and creds.valid:
+            return creds
+
+        # token file validation
+        if creds is None and os.path.exists(token_file):
+            creds = Credentials.from_authorized_user_file(token_file, scopes)
+
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                creds.refresh(Request())
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file(client_secret_file, scopes)
+                creds = flow.run_local_server(port=0)
+
+            # check if the token directory exists or else create directory
+            os.makedirs(os.path.dirname(token_file), exist_ok=True)
+            with open(token_file, 'w') as token:
+                token.write(creds.to_json())
+
+        _credentials[token_file] = creds
+        return creds
+
+
 def create_service(client_secret_file,api_name,api_version,*scopes,prefix=''):
+    # A new service object. Services are not thread safe, use get_service()
+    # for the one shared by the process and this for one per thread
     # make the passing values constants
     CLIENT_SECRET_FILE = client_secret_file # directory of the client secret file
     API_SERVICE_NAME = api_name # name of the service we want to use
     API_VERSION = api_version
-    SCOPES = [scope for scope in scopes[0]] 
-
-    # token file validation
-
-    creds = None # credentials in token file
-    
-    working_dir = os.getcwd() # get the current directory
-    token_dir = 'token_files'
-    token_file = f'token_{API_SERVICE_NAME}_{API_VERSION}{prefix}.json' # name of the token file
-
-    # check if the token directory exists or else create directory
-    if not os.path.exists(os.path.join(working_dir,token_dir)):
-        os.mkdir(os.path.join(working_dir,token_dir))
-    
-    if os.path.exists(os.path.join(working_dir,token_dir,token_file)):
-        creds = Credentials.from_authorized_user_file(os.path.join(working_dir,token_dir,token_file),SCOPES)
-
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else :
-            flow = InstalledAppFlow.from_client_secrets_file(CLIENT_SECRET_FILE,SCOPES)
-            creds = flow.run_local_server(port=0)
-
-        with open(os.path.join(working_dir,token_dir,token_file),'w') as token:
-            token.write(creds.to_json())
-        
+    SCOPES = [scope for scope in scopes[0]]
+
+    creds = get_credentials(CLIENT_SECRET_FILE, API_SERVICE_NAME, API_VERSION, SCOPES, prefix)
+
     try:
-        service = build(API_SERVICE_NAME,API_VERSION,credentials=creds,static_discovery=False)
+        service = build(API_SERVICE_NAME,API_VERSION,credentials=creds,cache=discovery_cache,static_discovery=False)
         #print(API_SERVICE_NAME,API_VERSION,'service created successfully')
         return service
-        
+
     except Exception as e :
         print(e)
         print(f'failed to started create service instance for {API_SERVICE_NAME}')
-        os.remove(os.path.join(working_dir,token_dir,token_file))
+        token_file = token_path(API_SERVICE_NAME, API_VERSION, prefix)
+        with _lock:
+            _credentials.pop(token_file, None)
+        if os.path.exists(token_file):
+            os.remove(token_file)
         return None
-    
 
 
+def get_service(client_secret_file,api_name,api_version,*scopes,prefix=''):
+    # The service of the account (prefix) shared by the process, built on first use
+    key = (api_name, api_version, prefix)
+    with _lock:
+        service = _services.get(key)
+        if service is None:
+            service = create_service(client_secret_file, api_name, api_version, *scopes, prefix=prefix)
+            if service is not None:
+                _services[key] = service
+        return service
 
 
+def clear_services():
+    # Forget the shared services and credentials, e.g. after switching accounts
+    with _lock:
+        _services.clear()
+        _credentials.clear()
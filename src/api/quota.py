@@ -0,0 +1,150 @@
+import http.client
+import random
+import socket
+import threading
+import time
+from googleapiclient.errors import HttpError
+from src.utils.profiler import incr, span
+
+# Gmail quota units charged per call, by discovery method id
+QUOTA_UNITS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.history.list': 2,
+    'gmail.users.labels.list': 1,
+    'gmail.users.labels.get': 1,
+    'gmail.users.labels.create': 5,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.modify': 5,
+    'gmail.users.messages.batchModify': 50,
+    'gmail.users.messages.trash': 5,
+    'gmail.users.watch': 100,
+    'gmail.users.stop': 50,
+}
+DEFAULT_UNITS = 5
+# per user limit, Gmail allows short bursts above it
+UNITS_PER_SECOND = 250
+
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 32.0
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+# transport failures worth another attempt: resets, dropped and timed out connections
+TRANSIENT_ERRORS = (ConnectionError, TimeoutError, socket.timeout, http.client.IncompleteRead)
+
+
+def units(method_id, calls=1):
+    return QUOTA_UNITS.get(method_id, DEFAULT_UNITS) * calls
+
+
+def is_retryable(exception):
+    # rate limits, server side errors and transport failures are worth
+    # retrying, Gmail reports some rate limits as 403 with a rateLimitExceeded reason
+    if isinstance(exception, TRANSIENT_ERRORS):
+        return True
+    if not isinstance(exception, HttpError):
+        return False
+    status = exception.resp.status
+    if status == 403:
+        return b'ratelimitexceeded' in (exception.content or b'').lower()
+    return status in RETRYABLE_STATUS
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    # Exponential backoff with full jitter, so clients that failed together
+    # do not retry together
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class QuotaLimiter:
+    '''
+    Token bucket over Gmail quota units, shared by every client of the process.
+    acquire() takes the units a call costs and sleeps until the bucket can
+    pay for them, so calls run at `rate` units per second after a burst of
+    `burst`. It also meters the units spent, per method, since the last reset.
+    A rate of None only meters.
+    '''
+
+    def __init__(self, rate=UNITS_PER_SECOND, burst=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst or rate
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.updated = clock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.used = {}  # method id -> units
+            self.retries = 0
+            self.waited = 0.0
+
+    def acquire(self, method_id, calls=1):
+        cost = units(method_id, calls)
+        incr('api_calls', calls, method=method_id)
+        with self.lock:
+            self.used[method_id] = self.used.get(method_id, 0) + cost
+            if self.rate is None:
+                return cost
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # take the units now and wait for the debt to be paid back, callers
+            # are served in order and a cost above the burst still goes through
+            self.tokens -= cost
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.waited += wait
+        if wait:
+            with span('quota.wait'):
+                self.sleep(wait)
+        return cost
+
+    def record_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    @property
+    def total(self):
+        return sum(self.used.values())
+
+    def usage(self):
+        with self.lock:
+            return {'units': sum(self.used.values()), 'by_method': dict(self.used),
+                    'retries': self.retries, 'waited': round(self.waited, 3)}
+
+
+_default_limiter = None
+_default_lock = threading.Lock()
+
+
+def default_limiter():
+    # The process wide limiter used when a client is not given one
+    global _default_limiter
+    with _default_lock:
+        if _default_limiter is None:
+            _default_limiter = QuotaLimiter()
+        return _default_limiter
+
+
+def execute(request, limiter=None, retries=MAX_RETRIES):
+    # Execute a googleapiclient request within the quota, retrying retryable
+    # errors with backoff. The last error is raised once retries run out
+    return call_with_retries(request.execute, request.methodId, limiter=limiter, retries=retries)
+
+
+def call_with_retries(call, method_id, calls=1, limiter=None, retries=MAX_RETRIES, name=None):
+    # call() charged as `calls` calls of method_id, retried like execute().
+    # Used for batch requests, whose sub-requests are charged one by one
+    limiter = limiter or default_limiter()
+    for attempt in range(retries + 1):
+        limiter.acquire(method_id, calls)
+        try:
+            with span(name or f'api.{method_id}'):
+                return call()
+        except Exception as e:
+            if attempt == retries or not is_retryable(e):
+                raise
+            limiter.record_retry()
+            time.sleep(backoff_delay(attempt))
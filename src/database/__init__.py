@@ -1,3 +1,5 @@
-from .models import EmailDatabase, Email, Attachment
+from .models import EmailDatabase, Email, EmailBody, Attachment, SyncState, RuleSet, StatCounter, Base
+from .engine import configure_database, get_engine, get_session_factory
 
-__all__ = ['EmailDatabase', 'Email', 'Attachment','Base']
\ No newline at end of file
+__all__ = ['EmailDatabase', 'Email', 'EmailBody', 'Attachment', 'SyncState', 'RuleSet', 'StatCounter', 'Base',
+           'configure_database', 'get_engine', 'get_session_factory']
\ No newline at end of file
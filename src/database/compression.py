@@ -0,0 +1,28 @@
+import zlib
+
+'''
+Compressed storage for email bodies.
+Bodies are stored zlib compressed in the email_bodies table. The same
+decompression is registered on every SQLite connection as body_text(),
+so SQL (the search index, rule pushdown) can read the plain text too.
+'''
+
+COMPRESSION_LEVEL = 6
+SQL_FUNCTION = 'body_text'
+
+
+def compress_body(text):
+    if text is None:
+        return None
+    return zlib.compress(text.encode('utf-8'), COMPRESSION_LEVEL)
+
+
+def decompress_body(data):
+    if data is None:
+        return None
+    return zlib.decompress(data).decode('utf-8')
+
+
+def register_functions(dbapi_connection, connection_record):
+    # deterministic lets SQLite use the function in indexes and constant folding
+    dbapi_connection.create_function(SQL_FUNCTION, 1, decompress_body, deterministic=True)
@@ -0,0 +1,91 @@
+from sqlalchemy import text
+
+'''
+Materialized counters behind the dashboard statistics.
+stat_counters holds one row per (dimension, key) with the number of emails
+in it, for example ('folder', 'INBOX') or ('day', '2024-01-31'). Triggers on
+emails and attachments keep the counts in step with every insert, update and
+delete, inside the transaction that changes the row, so the stats queries
+read a few rows however large the mailbox is. Counts that drop to 0 are kept,
+readers skip them.
+'''
+
+COUNTER_TABLE = 'stat_counters'
+
+# dimension -> (key of an emails row as SQL over {row}, condition for the row to count)
+EMAIL_DIMENSIONS = {
+    'total': ("''", None),
+    'folder': ("coalesce({row}.folder_name, '')", None),
+    'read': ("CAST(coalesce({row}.is_read, 0) AS TEXT)", None),
+    'has_attachment': ("CAST({row}.has_attachment AS TEXT)", '{row}.has_attachment IS NOT NULL'),
+    'hour': ('substr({row}.received_at, 1, 13)', '{row}.received_at IS NOT NULL'),  # YYYY-MM-DD HH
+    'day': ('substr({row}.received_at, 1, 10)', '{row}.received_at IS NOT NULL'),  # YYYY-MM-DD
+}
+# emails columns the dimensions depend on
+EMAIL_COLUMNS = ('folder_name', 'is_read', 'has_attachment', 'received_at')
+ATTACHMENT_DIMENSIONS = {
+    'attachment': ("coalesce({row}.mime_type, '')", None),
+}
+
+TRIGGERS = ('emails_counters_insert', 'emails_counters_delete', 'emails_counters_update',
+            'attachments_counters_insert', 'attachments_counters_delete')
+
+
+def _increment(dimension, key, condition, row):
+    where = f' WHERE {condition.format(row=row)}' if condition else ' WHERE 1'
+    return (f"INSERT INTO {COUNTER_TABLE} (dimension, key, count) SELECT '{dimension}', {key.format(row=row)}, 1"
+            f"{where} ON CONFLICT (dimension, key) DO UPDATE SET count = count + 1;")
+
+
+def _decrement(dimension, key, condition, row):
+    return (f"UPDATE {COUNTER_TABLE} SET count = count - 1 "
+            f"WHERE dimension = '{dimension}' AND key = {key.format(row=row)};")
+
+
+def _statements(dimensions, step, row):
+    return ' '.join(step(dimension, key, condition, row) for dimension, (key, condition) in dimensions.items())
+
+
+def trigger_ddl():
+    changed = ' OR '.join(f'OLD.{column} IS NOT NEW.{column}' for column in EMAIL_COLUMNS)
+    moved = {dimension: spec for dimension, spec in EMAIL_DIMENSIONS.items() if dimension != 'total'}
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS emails_counters_insert AFTER INSERT ON emails BEGIN "
+        f"{_statements(EMAIL_DIMENSIONS, _increment, 'NEW')} END",
+        f"CREATE TRIGGER IF NOT EXISTS emails_counters_delete AFTER DELETE ON emails BEGIN "
+        f"{_statements(EMAIL_DIMENSIONS, _decrement, 'OLD')} END",
+        f"CREATE TRIGGER IF NOT EXISTS emails_counters_update AFTER UPDATE OF {', '.join(EMAIL_COLUMNS)} ON emails "
+        f"WHEN {changed} BEGIN "
+        f"{_statements(moved, _decrement, 'OLD')} {_statements(moved, _increment, 'NEW')} END",
+        f"CREATE TRIGGER IF NOT EXISTS attachments_counters_insert AFTER INSERT ON attachments BEGIN "
+        f"{_statements(ATTACHMENT_DIMENSIONS, _increment, 'NEW')} END",
+        f"CREATE TRIGGER IF NOT EXISTS attachments_counters_delete AFTER DELETE ON attachments BEGIN "
+        f"{_statements(ATTACHMENT_DIMENSIONS, _decrement, 'OLD')} END",
+    ]
+
+
+def counters_exist(conn):
+    found = conn.execute(text(
+        "SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name IN "
+        f"({', '.join(repr(name) for name in TRIGGERS)})"
+    )).scalar()
+    return found == len(TRIGGERS)
+
+
+def create_counters(conn):
+    for statement in trigger_ddl():
+        conn.execute(text(statement))
+
+
+def rebuild_counters(conn):
+    # Count every dimension from scratch, returns the number of counters
+    conn.execute(text(f'DELETE FROM {COUNTER_TABLE}'))
+    for table, dimensions in (('emails', EMAIL_DIMENSIONS), ('attachments', ATTACHMENT_DIMENSIONS)):
+        for dimension, (key, condition) in dimensions.items():
+            key = key.format(row=table)
+            where = f' WHERE {condition.format(row=table)}' if condition else ''
+            conn.execute(text(
+                f"INSERT INTO {COUNTER_TABLE} (dimension, key, count) "
+                f"SELECT '{dimension}', {key}, count(*) FROM {table}{where} GROUP BY {key}"
+            ))
+    return conn.execute(text(f'SELECT count(*) FROM {COUNTER_TABLE}')).scalar()
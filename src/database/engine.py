@@ -0,0 +1,90 @@
+import os
+import threading
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, scoped_session
+from .compression import register_functions
+
+'''
+Process wide SQLite engines.
+Every EmailDatabase in a process shares one engine and one thread-local
+session registry per database file, so the CLI, the rule engine and the
+dashboard reuse connections instead of opening their own. Connections run
+in WAL mode so readers do not block the writer.
+'''
+
+DEFAULT_DB_PATH = 'src/database/emails.db'
+DB_PATH_ENV = 'ECLIENT_DB_PATH'
+
+PRAGMAS = (
+    ('journal_mode', 'WAL'),  # readers and the writer no longer block each other
+    ('synchronous', 'NORMAL'),  # safe with WAL, fsync only at checkpoints
+    ('cache_size', -64000),  # 64MB page cache
+    ('mmap_size', 268435456),  # 256MB memory mapped reads
+    ('busy_timeout', 5000),  # wait for the write lock instead of failing
+    ('temp_store', 'MEMORY'),
+)
+
+_configured_path = None
+_engines = {}  # db path -> (engine, scoped session factory)
+_lock = threading.Lock()
+
+
+def configure_database(db_path):
+    # Set the database file used when EmailDatabase is not given a path
+    global _configured_path
+    _configured_path = db_path
+
+
+def get_db_path(db_path=None):
+    return db_path or _configured_path or os.environ.get(DB_PATH_ENV) or DEFAULT_DB_PATH
+
+
+def _set_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in PRAGMAS:
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+
+def _create(db_path):
+    from .models import Base
+    from .migrations import migrate
+
+    engine = create_engine(
+        f'sqlite:///{db_path}',
+        connect_args={'check_same_thread': False},  # the pool hands a connection to one thread at a time
+    )
+    event.listen(engine, 'connect', _set_pragmas)
+    event.listen(engine, 'connect', register_functions)
+    Base.metadata.create_all(engine)
+    migrate(engine)
+    return engine, scoped_session(sessionmaker(bind=engine))
+
+
+def _get(db_path=None):
+    db_path = get_db_path(db_path)
+    with _lock:
+        if db_path not in _engines:
+            _engines[db_path] = _create(db_path)
+        return _engines[db_path]
+
+
+def get_engine(db_path=None):
+    return _get(db_path)[0]
+
+
+def get_session_factory(db_path=None):
+    # Thread-local scoped sessions bound to the shared engine
+    return _get(db_path)[1]
+
+
+def dispose_engines(close=True):
+    # Close every pooled connection, e.g. before deleting the database file.
+    # A forked child passes close=False to drop the parent's connections
+    # without closing them under the parent
+    with _lock:
+        for engine, sessions in _engines.values():
+            if close:
+                sessions.remove()
+            engine.dispose(close=close)
+        _engines.clear()
@@ -0,0 +1,91 @@
+from sqlalchemy import bindparam, inspect, text, update
+from .search import create_search_index, rebuild_search_index, search_index_exists
+from .compression import compress_body
+from .counters import counters_exist, create_counters, rebuild_counters
+
+'''
+Schema migrations for databases created by older versions.
+create_all only creates missing tables, columns added to existing tables
+are handled here. Every step checks the live schema so migrate() can run
+on every start.
+'''
+
+
+def migrate(engine):
+    columns = {column['name'] for column in inspect(engine).get_columns('emails')}
+    if 'received_at' not in columns:
+        add_received_at(engine)
+    if 'rules_version' not in columns:
+        with engine.begin() as conn:
+            # existing emails count as never evaluated
+            conn.execute(text('ALTER TABLE emails ADD COLUMN rules_version VARCHAR'))
+            conn.execute(text('CREATE INDEX IF NOT EXISTS ix_emails_rules_version ON emails (rules_version)'))
+    if 'body' in columns:
+        move_bodies(engine)
+
+    with engine.begin() as conn:
+        if not search_index_exists(conn):
+            create_search_index(conn)
+            indexed = rebuild_search_index(conn)
+            if indexed:
+                print(f"Indexed {indexed} email(s) for full-text search")
+    if 'attachments' in inspect(engine).get_table_names():
+        add_counters(engine)
+
+
+def add_received_at(engine):
+    # Parse the stored Date headers once into an indexed UTC column
+    from .models import Email, parse_email_date
+
+    emails = Email.__table__
+    with engine.begin() as conn:
+        conn.execute(text('ALTER TABLE emails ADD COLUMN received_at DATETIME'))
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_emails_received_at ON emails (received_at)'))
+
+        rows = [{'email_id': email_id, 'received_at': parse_email_date(date)}
+                for email_id, date in conn.execute(text('SELECT id, date FROM emails'))]
+        if rows:
+            conn.execute(
+                update(emails).where(emails.c.id == bindparam('email_id')).values(received_at=bindparam('received_at')),
+                rows
+            )
+    print(f"Migrated {len(rows)} email(s) to the received_at column")
+
+
+def move_bodies(engine, chunk_size=1000):
+    # Move the inline bodies into the compressed email_bodies table and drop
+    # the column. The search index holds the same text so it is left as is
+    from .models import EmailBody
+
+    EmailBody.__table__.create(engine, checkfirst=True)
+    moved = 0
+    with engine.begin() as conn:
+        last = 0
+        while True:
+            rows = conn.execute(text(
+                'SELECT rowid, id, body FROM emails WHERE rowid > :last ORDER BY rowid LIMIT :size'
+            ), {'last': last, 'size': chunk_size}).fetchall()
+            if not rows:
+                break
+            last = rows[-1].rowid
+            bodies = [{'email_id': row.id, 'body': compress_body(row.body)} for row in rows if row.body is not None]
+            if bodies:
+                conn.execute(text('INSERT OR REPLACE INTO email_bodies (email_id, body) VALUES (:email_id, :body)'), bodies)
+            moved += len(bodies)
+        conn.execute(text('ALTER TABLE emails DROP COLUMN body'))
+
+    # give the space of the old column back to the file system
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute(text('VACUUM'))
+    print(f"Moved {moved} email bod{'y' if moved == 1 else 'ies'} to compressed storage")
+
+
+def add_counters(engine):
+    # Triggers maintaining the stats counters, counted once from the existing rows
+    from .models import StatCounter
+
+    StatCounter.__table__.create(engine, checkfirst=True)
+    with engine.begin() as conn:
+        if not counters_exist(conn):
+            create_counters(conn)
+            rebuild_counters(conn)
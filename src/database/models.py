@@ -1,10 +1,38 @@
-from sqlalchemy import create_engine, Column, String, Boolean, DateTime, Integer, ForeignKey
+from sqlalchemy import Column, String, Boolean, DateTime, Integer, ForeignKey, LargeBinary
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from datetime import datetime
-from sqlalchemy import func
+from sqlalchemy.orm import relationship, selectinload
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from sqlalchemy import func, and_, or_, text, insert, delete, update, case, null, select, bindparam
+import json
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from .engine import get_engine, get_session_factory
+from .search import FTS_TABLE, index_emails, unindex_emails, match_query
+from .compression import SQL_FUNCTION, compress_body, decompress_body
+from src.utils.profiler import incr, span
+
+# columns overwritten when an already stored email is stored again
+UPSERT_COLUMNS = ('subject', 'snippet', 'sender', 'recipient', 'date', 'received_at',
+                  'has_attachment', 'is_read', 'folder_name')
+
+# columns rules look at, besides the body
+RULE_COLUMNS = ('subject', 'sender', 'date')
+
+# rule field name -> searchable column
+SEARCH_FIELDS = {'subject': 'subject', 'from': 'sender', 'message': 'body'}
 Base = declarative_base()
 
+def parse_email_date(value):
+    # Parse an RFC 2822 Date header into a naive UTC datetime, None if unparseable
+    try:
+        parsed = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
 # Email Table
 class Email(Base):
     __tablename__ = 'emails'
@@ -16,12 +44,14 @@ class Email(Base):
     SNIPPET - STRING
     SENDER - STRING
     RECIPIENT - STRING
-    DATE - STRING
-    BODY - STRING
+    DATE - STRING (raw Date header)
+    RECEIVED_AT - DATETIME UTC, INDEXED (parsed Date header)
+    BODY - EMAIL_BODIES(BODY), COMPRESSED, LOADED ON ACCESS
     HAS_ATTACHMENT - BOOLEAN DEFAULT FALSE
     IS_READ - BOOLEAN DEFAULT FALSE
     FOLDER_NAME - STRING DEFAULT 'INBOX'
     CREATED_AT - DATETIME DEFAULT CURRENT_TIME
+    RULES_VERSION - STRING, INDEXED (rule set last applied, NULL when new or changed)
     ATTACHMENTS - ATTACHMENT FOREIGN KEY REFERENCES ATTACHMENTS(ID)
     '''
 
@@ -31,12 +61,36 @@ class Email(Base):
     sender = Column(String) # sender of the email
     recipient = Column(String) # recipient of the email
     date = Column(String) # date of the email
-    body = Column(String) # body of the email in text
+    received_at = Column(DateTime, index=True) # date of the email parsed to UTC
     has_attachment = Column(Boolean, default=False) # boolean value to check if the email has an attachment
     is_read = Column(Boolean, default=False)  # Track read/unread status
     folder_name = Column(String, default='INBOX')  # Track current folder/label
     created_at = Column(DateTime, default=datetime.utcnow)
+    rules_version = Column(String, index=True) # version of the rule set last applied
     attachments = relationship("Attachment", back_populates="email", cascade="all, delete-orphan")
+    content = relationship("EmailBody", back_populates="email", uselist=False, cascade="all, delete-orphan")
+
+    @hybrid_property
+    def body(self):
+        # body of the email in text, only read from email_bodies when accessed
+        return decompress_body(self.content.body) if self.content is not None else None
+
+    @body.expression
+    def body(cls):
+        return select(getattr(func, SQL_FUNCTION)(EmailBody.body)).where(
+            EmailBody.email_id == cls.id).scalar_subquery()
+
+# Email Body Table
+class EmailBody(Base):
+    __tablename__ = 'email_bodies'
+    '''
+    Structure of table :
+    EMAIL_ID - STRING PRIMARY KEY FOREIGN KEY REFERENCES EMAILS(ID)
+    BODY - BLOB (zlib compressed body of the email)
+    '''
+    email_id = Column(String, ForeignKey('emails.id'), primary_key=True)
+    body = Column(LargeBinary)
+    email = relationship("Email", back_populates="content")
 
 # Attachement Table
 class Attachment(Base):
@@ -53,35 +107,159 @@ class Attachment(Base):
     mime_type = Column(String) # type of attachement ('application/pdf', 'image/jpeg',...)
     email = relationship("Email", back_populates="attachments")
 
+# Sync State Table
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+    '''
+    Structure of table :
+    ACCOUNT - STRING PRIMARY KEY
+    HISTORY_ID - STRING (last seen gmail historyId)
+    UPDATED_AT - DATETIME DEFAULT CURRENT_TIME
+    '''
+    account = Column(String, primary_key=True)
+    history_id = Column(String)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# Rule Set Table
+class RuleSet(Base):
+    __tablename__ = 'rule_sets'
+    '''
+    Structure of table :
+    VERSION - STRING PRIMARY KEY (hash of the rule set)
+    RULE_HASHES - STRING (json list of the hashes of its rules)
+    CREATED_AT - DATETIME DEFAULT CURRENT_TIME
+    LAST_RUN_AT - DATETIME (last time this rule set was applied)
+    '''
+    version = Column(String, primary_key=True)
+    rule_hashes = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_run_at = Column(DateTime)
+
+# Statistics Counter Table
+class StatCounter(Base):
+    __tablename__ = 'stat_counters'
+    '''
+    Structure of table :
+    DIMENSION - STRING PRIMARY KEY (total, folder, read, has_attachment, attachment, hour, day)
+    KEY - STRING PRIMARY KEY (folder name, '0'/'1', mime type, 'YYYY-MM-DD HH', 'YYYY-MM-DD')
+    COUNT - INTEGER (emails in the bucket, kept by triggers, see counters.py)
+    '''
+    dimension = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
 # Database handler class
 class EmailDatabase:
-    def __init__(self):
-        self.engine = create_engine('sqlite:///src/database/emails.db')
-        Base.metadata.create_all(self.engine)
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
+    def __init__(self, db_path=None):
+        # The engine and session registry are shared by every EmailDatabase of the process
+        self.engine = get_engine(db_path)
+        self.Session = get_session_factory(db_path)
+
+    @property
+    def session(self):
+        # the calling thread's session, looked up in the scoped registry on every use
+        return self.Session()
+
+    def _email_row(self, email_data):
+        return {
+            'id': email_data['id'],
+            'subject': email_data['subject'],
+            'snippet': email_data['snippet'],
+            'sender': email_data['from'],
+            'recipient': email_data['to'],
+            'date': email_data['date'],
+            'received_at': parse_email_date(email_data['date']),
+            'has_attachment': email_data.get('has_attachment'),
+            'is_read': email_data.get('is_read', False),
+            'folder_name': email_data.get('folder_name', 'INBOX')  # Get folder name from email_data
+        }
+
+    def _write_emails(self, chunk):
+        # Upsert a chunk of emails in the current transaction: one executemany
+        # INSERT ... ON CONFLICT DO UPDATE for the emails, their attachments are
+        # replaced, and the search index is kept in step. No commit.
+        # Emails fetched without their body (body None) keep the stored body
+        # and attachments
+        chunk = list({email_data['id']: email_data for email_data in chunk}.values())
+        rows = [self._email_row(email_data) for email_data in chunk]
+        email_ids = [row['id'] for row in rows]
+
+        conn = self.session.connection()
+        unindex_emails(conn, email_ids)
+        statement = sqlite_insert(Email.__table__)
+        emails = Email.__table__.c
+        # an email whose rule-relevant content changed has to be evaluated again
+        changed = or_(*[emails[column].is_distinct_from(statement.excluded[column]) for column in RULE_COLUMNS])
+        updates = {column: statement.excluded[column] for column in UPSERT_COLUMNS}
+        updates['rules_version'] = case((changed, null()), else_=emails.rules_version)
+        updates['has_attachment'] = func.coalesce(statement.excluded.has_attachment, emails.has_attachment)
+        conn.execute(statement.on_conflict_do_update(
+            index_elements=[emails.id],
+            set_=updates
+        ), rows)
+        self._write_bodies(conn, chunk)
+        index_emails(conn, email_ids)
+        return len(rows)
+
+    def _write_bodies(self, conn, chunk, reset_rules=True):
+        # Upsert the bodies and attachments of the emails that carry a body. With
+        # reset_rules an email whose body changed is marked for evaluation again
+        full = [email_data for email_data in chunk if email_data.get('body') is not None]
+        if not full:
+            return
+        bodies = [{'email_id': email_data['id'], 'body': compress_body(email_data['body'])} for email_data in full]
+        attachments = [
+            {'email_id': email_data['id'], 'mime_type': mime_type}
+            for email_data in full if email_data['has_attachment']
+            for mime_type in email_data.get('attachment_types', [])
+        ]
+        emails = Email.__table__.c
+        email_bodies = EmailBody.__table__
+        if reset_rules:
+            stored_body = select(email_bodies.c.body).where(
+                email_bodies.c.email_id == bindparam('email_id')).scalar_subquery()
+            # compressed bodies of the same text are identical
+            conn.execute(update(Email.__table__).where(
+                emails.id == bindparam('email_id'), stored_body.is_distinct_from(bindparam('body'))
+            ).values(rules_version=None), bodies)
+        statement = sqlite_insert(email_bodies)
+        conn.execute(statement.on_conflict_do_update(
+            index_elements=[email_bodies.c.email_id],
+            set_={'body': statement.excluded.body}
+        ), bodies)
+        conn.execute(update(Email.__table__).where(emails.id == bindparam('email_id')).values(
+            has_attachment=bindparam('has_attachment')
+        ), [{'email_id': email_data['id'], 'has_attachment': email_data['has_attachment']} for email_data in full])
+        full_ids = [body['email_id'] for body in bodies]
+        conn.execute(delete(Attachment.__table__).where(Attachment.__table__.c.email_id.in_(full_ids)))
+        if attachments:
+            conn.execute(insert(Attachment.__table__), attachments)
+
+    def store_bodies(self, emails):
+        # Add the bodies and attachments of already stored emails fetched in
+        # full, leaving every other column as it is. Returns the number stored
+        try:
+            emails = [email_data for email_data in emails if email_data.get('body') is not None]
+            email_ids = [email_data['id'] for email_data in emails]
+            conn = self.session.connection()
+            unindex_emails(conn, email_ids)
+            # an email without a body was never evaluated against message rules
+            with span('db.write'):
+                self._write_bodies(conn, emails, reset_rules=False)
+                index_emails(conn, email_ids)
+            with span('db.commit'):
+                self.session.commit()
+            incr('rows_written', len(emails), table='email_bodies')
+            return len(emails)
+        except Exception as e:
+            print(f"Error storing email bodies: {e}")
+            self.session.rollback()
+            return 0
+
     def store_email(self, email_data):
         try:
             # try to store the email data
-            email = Email(
-                id=email_data['id'],
-                subject=email_data['subject'],
-                snippet=email_data['snippet'],
-                sender=email_data['from'],
-                recipient=email_data['to'],
-                date=email_data['date'],
-                body=email_data['body'],
-                has_attachment=email_data['has_attachment'],
-                is_read=email_data.get('is_read', False),  
-                folder_name=email_data.get('folder_name', 'INBOX')  # Get folder name from email_data
-            )
-
-            if email_data['has_attachment']:
-                for mime_type in email_data['attachment_types']:
-                    attachment = Attachment(mime_type=mime_type)
-                    email.attachments.append(attachment)
-
-            self.session.merge(email)
+            self._write_emails([email_data])
             self.session.commit()
             return True
 
@@ -90,9 +268,74 @@ class EmailDatabase:
             print(f"Error storing email: {e}") 
             self.session.rollback()
             return False
+
+    def store_emails(self, emails, batch_size=100):
+        # Store an iterable of emails, each chunk of batch_size emails is written
+        # in one transaction. Returns the number of emails stored per chunk.
+        counts = []
+        chunk = []
+        for email_data in emails:
+            chunk.append(email_data)
+            if len(chunk) >= batch_size:
+                counts.append(self._store_chunk(chunk))
+                chunk = []
+        if chunk:
+            counts.append(self._store_chunk(chunk))
+        return counts
+
+    def _store_chunk(self, chunk):
+        try:
+            with span('db.write'):
+                stored = self._write_emails(chunk)
+            with span('db.commit'):
+                self.session.commit()
+            incr('rows_written', stored, table='emails')
+            # drop loaded objects so the session does not grow with the mailbox
+            self.session.expunge_all()
+            return stored
+        except Exception as e:
+            print(f"Error storing emails: {e}")
+            self.session.rollback()
+            return 0
+
     def get_all_emails(self):
-        # return all emails in descending order by date
-        return self.session.query(Email).order_by(Email.date.desc()).all()
+        # return all emails, newest first
+        return self.session.query(Email).order_by(Email.received_at.desc()).all()
+    def get_emails(self, where=None, count=None, batch_size=500, with_body=False):
+        # Stream emails newest first, optionally filtered by a SQL clause and
+        # restricted to the newest `count` emails. Bodies are loaded per batch
+        # with with_body, otherwise only when an email's body is accessed
+        query = self.session.query(Email)
+        if with_body:
+            query = query.options(selectinload(Email.content))
+        if count:
+            newest = self.session.query(Email.id).order_by(Email.received_at.desc()).limit(count)
+            query = query.filter(Email.id.in_(newest.scalar_subquery()))
+        if where is not None:
+            query = query.filter(where)
+        return query.order_by(Email.received_at.desc()).yield_per(batch_size)
+
+    def search(self, query, fields=None, limit=50):
+        # Full-text search over subject, sender and body, best matches first.
+        # fields restricts the search to some of 'subject', 'from', 'message'
+        columns = [SEARCH_FIELDS[field] for field in fields] if fields else list(SEARCH_FIELDS.values())
+        terms = query.lower().split()
+        fts_query = match_query(terms, columns)
+        if fts_query is None:
+            # terms too short for the trigram index, scan instead
+            if not terms:
+                return []
+            return self.session.query(Email).filter(and_(*[
+                or_(*[getattr(Email, name).contains(term, autoescape=True) for name in columns])
+                for term in terms
+            ])).order_by(Email.received_at.desc()).limit(limit).all()
+
+        statement = text(
+            f"SELECT emails.* FROM emails JOIN {FTS_TABLE} ON emails.rowid = {FTS_TABLE}.rowid "
+            f"WHERE {FTS_TABLE} MATCH :query ORDER BY {FTS_TABLE}.rank LIMIT :limit"
+        )
+        return self.session.query(Email).from_statement(statement).params(query=fts_query, limit=limit).all()
+
     def close(self):
         self.session.close()
     def update_email_status(self, email_id, is_read=None, folder_name=None):
@@ -111,40 +354,158 @@ class EmailDatabase:
             self.session.rollback()
             return False
     
+    def update_emails_status(self, updates):
+        # Apply {email_id: {'is_read': ..., 'folder_name': ...}} in one transaction
+        try:
+            groups = {}
+            for email_id, values in updates.items():
+                if values:
+                    groups.setdefault(tuple(sorted(values.items())), []).append(email_id)
+            for values, email_ids in groups.items():
+                for start in range(0, len(email_ids), 500):
+                    self.session.query(Email).filter(Email.id.in_(email_ids[start:start + 500])).update(
+                        dict(values), synchronize_session=False)
+            self.session.commit()
+            return True
+        except Exception as e:
+            print(f"Error updating email status: {e}")
+            self.session.rollback()
+            return False
+
+    def delete_emails(self, email_ids):
+        try:
+            email_ids = list(email_ids)
+            unindex_emails(self.session.connection(), email_ids)
+            for start in range(0, len(email_ids), 500):
+                chunk = email_ids[start:start + 500]
+                self.session.query(Attachment).filter(Attachment.email_id.in_(chunk)).delete(synchronize_session=False)
+                self.session.query(EmailBody).filter(EmailBody.email_id.in_(chunk)).delete(synchronize_session=False)
+                self.session.query(Email).filter(Email.id.in_(chunk)).delete(synchronize_session=False)
+            self.session.commit()
+            return True
+        except Exception as e:
+            print(f"Error deleting emails: {e}")
+            self.session.rollback()
+            return False
+
+    def get_email_ids(self, where=None, count=None):
+        query = self.session.query(Email.id)
+        if count:
+            newest = self.session.query(Email.id).order_by(Email.received_at.desc()).limit(count)
+            query = query.filter(Email.id.in_(newest.scalar_subquery()))
+        if where is not None:
+            query = query.filter(where)
+        return {email_id for (email_id,) in query}
+
+    def get_ids_without_body(self, count=None):
+        # Emails stored from metadata only, whose body has not been fetched yet
+        return self.get_email_ids(where=~Email.content.has(), count=count)
+
+    def register_rule_set(self, version, rule_hashes):
+        try:
+            if self.session.get(RuleSet, version) is None:
+                self.session.add(RuleSet(version=version, rule_hashes=json.dumps(list(rule_hashes))))
+                self.session.commit()
+            return True
+        except Exception as e:
+            print(f"Error registering rule set: {e}")
+            self.session.rollback()
+            return False
+
+    def get_rule_sets(self):
+        # {version: (set of rule hashes, last run time)}
+        return {rule_set.version: (set(json.loads(rule_set.rule_hashes)), rule_set.last_run_at)
+                for rule_set in self.session.query(RuleSet)}
+
+    def set_rules_version(self, email_ids, version, run_at=None):
+        # Record that `version` was applied to the given emails
+        try:
+            email_ids = list(email_ids)
+            for start in range(0, len(email_ids), 500):
+                self.session.execute(
+                    update(Email.__table__).where(Email.__table__.c.id.in_(email_ids[start:start + 500]))
+                    .values(rules_version=version)
+                )
+            if run_at is not None:
+                self.session.get(RuleSet, version).last_run_at = run_at
+            self.session.commit()
+            return True
+        except Exception as e:
+            print(f"Error saving rules version: {e}")
+            self.session.rollback()
+            return False
+
+    def get_sync_cursor(self, account='me'):
+        state = self.session.get(SyncState, account)
+        return state.history_id if state else None
+
+    def set_sync_cursor(self, history_id, account='me'):
+        try:
+            state = self.session.get(SyncState, account)
+            if state is None:
+                state = SyncState(account=account)
+                self.session.add(state)
+            state.history_id = str(history_id)
+            self.session.commit()
+            return True
+        except Exception as e:
+            print(f"Error saving sync cursor: {e}")
+            self.session.rollback()
+            return False
+
+    def get_counters(self, dimension):
+        # [(key, count)] of a dimension of the materialized counters, by key
+        return self.session.query(StatCounter.key, StatCounter.count).filter(
+            StatCounter.dimension == dimension, StatCounter.count > 0
+        ).order_by(StatCounter.key).all()
+
     def get_attachment_stats(self):
         try:
-            # Query to count attachments by mime type
-            stats = self.session.query(
-                Attachment.mime_type,
-                func.count(Attachment.id).label('count')
-            ).group_by(Attachment.mime_type).all()
-            return stats
+            # attachments by mime type, from the counters
+            return self.get_counters('attachment')
         except Exception as e:
             print(f"Error getting attachment stats: {e}")
             return []
     def get_folder_stats(self, count=None):
         try:
             if count:
-                # Get limited number of emails and their folders
-                emails = self.session.query(Email).order_by(Email.date.desc()).limit(count).all()
-                folder_counts = {}
-                for email in emails:
-                    folder_counts[email.folder_name] = folder_counts.get(email.folder_name, 0) + 1
-                stats = [(folder, count) for folder, count in folder_counts.items()]
-            else:
-                # Original functionality for all emails
+                # Count folders of the newest emails only
+                newest = self.session.query(Email.folder_name).order_by(
+                    Email.received_at.desc()).limit(count).subquery()
                 stats = self.session.query(
-                    Email.folder_name,
-                    func.count(Email.id).label('count')
-                ).group_by(Email.folder_name).all()
+                    newest.c.folder_name,
+                    func.count().label('count')
+                ).group_by(newest.c.folder_name).all()
+            else:
+                # every email, from the counters
+                stats = self.get_counters('folder')
             return stats
         except Exception as e:
             print(f"Error getting folder stats: {e}")
             return []
     def get_email_timing(self):
         try:
-            # Query to get all email dates
-            return self.session.query(Email.date).all()
+            # [(hour as a UTC datetime, emails received in it)] in time order, from the counters
+            return [(datetime.strptime(hour, '%Y-%m-%d %H'), count) for hour, count in self.get_counters('hour')]
         except Exception as e:
             print(f"Error getting email timing: {e}")
-            return []
\ No newline at end of file
+            return []
+
+    def get_read_stats(self):
+        # Total, read and unread emails and emails with attachments, from the counters
+        try:
+            read = dict(self.get_counters('read'))
+            total = dict(self.get_counters('total')).get('', 0)
+            return {'total': total, 'read': read.get('1', 0), 'unread': read.get('0', 0),
+                    'attachments': dict(self.get_counters('has_attachment')).get('1', 0)}
+        except Exception as e:
+            print(f"Error getting read stats: {e}")
+            return {'total': 0, 'read': 0, 'unread': 0, 'attachments': 0}
+
+    def get_receive_stats(self, granularity='day'):
+        # [(bucket, count)] of emails received per 'hour' ('YYYY-MM-DD HH') or 'day' ('YYYY-MM-DD') in UTC
+        try:
+            return self.get_counters(granularity)
+        except Exception as e:
+            print(f"Error getting receive stats: {e}")
+            return []
@@ -0,0 +1,103 @@
+from sqlalchemy import column, literal_column, select, table, text
+from .compression import SQL_FUNCTION
+
+'''
+Full-text index over email subject, sender and body.
+emails_fts is a contentless FTS5 table using the trigram tokenizer, so a
+phrase query matches any case-insensitive substring of at least three
+characters, the same thing the rules' contains predicate checks.
+Rows are keyed by emails.rowid and kept in sync by EmailDatabase: the old
+values are removed before a row changes and the new ones indexed after.
+Bodies are read from email_bodies through the body_text() SQL function.
+'''
+
+FTS_TABLE = 'emails_fts'
+FTS_COLUMNS = ('subject', 'sender', 'body')
+# trigram queries need at least this many characters per term
+MIN_TERM_LENGTH = 3
+
+fts = table(FTS_TABLE, column('rowid'))
+
+# indexed values of each email, in FTS_COLUMNS order
+INDEXED_ROWS = (
+    f"SELECT emails.rowid AS rowid, emails.subject AS subject, emails.sender AS sender, "
+    f"{SQL_FUNCTION}(email_bodies.body) AS body "
+    "FROM emails LEFT JOIN email_bodies ON email_bodies.email_id = emails.id"
+)
+
+
+def search_index_exists(conn):
+    return conn.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': FTS_TABLE}
+    ).first() is not None
+
+
+def create_search_index(conn):
+    conn.execute(text(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+        f"{', '.join(FTS_COLUMNS)}, content='', tokenize='trigram')"
+    ))
+
+
+def rebuild_search_index(conn):
+    # Drop every indexed row and index the emails table from scratch
+    create_search_index(conn)
+    conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES('delete-all')"))
+    result = conn.execute(text(
+        f"INSERT INTO {FTS_TABLE}(rowid, {', '.join(FTS_COLUMNS)}) {INDEXED_ROWS}"
+    ))
+    return result.rowcount
+
+
+def _chunks(email_ids, size=500):
+    email_ids = list(email_ids)
+    for start in range(0, len(email_ids), size):
+        yield email_ids[start:start + size]
+
+
+def _select_rows(conn, email_ids):
+    params = {f'id{i}': email_id for i, email_id in enumerate(email_ids)}
+    placeholders = ', '.join(f':{name}' for name in params)
+    return conn.execute(text(f"{INDEXED_ROWS} WHERE emails.id IN ({placeholders})"), params).fetchall()
+
+
+def unindex_emails(conn, email_ids):
+    # Contentless tables need the exact indexed values to delete a row,
+    # so this has to run before the emails rows change
+    for chunk in _chunks(email_ids):
+        rows = _select_rows(conn, chunk)
+        if rows:
+            conn.execute(text(
+                f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {', '.join(FTS_COLUMNS)}) "
+                "VALUES('delete', :rowid, :subject, :sender, :body)"
+            ), [dict(row._mapping) for row in rows])
+
+
+def index_emails(conn, email_ids):
+    for chunk in _chunks(email_ids):
+        rows = _select_rows(conn, chunk)
+        if rows:
+            conn.execute(text(
+                f"INSERT INTO {FTS_TABLE}(rowid, {', '.join(FTS_COLUMNS)}) "
+                "VALUES(:rowid, :subject, :sender, :body)"
+            ), [dict(row._mapping) for row in rows])
+
+
+def phrase(value):
+    return '"' + value.replace('"', '""') + '"'
+
+
+def match_query(terms, columns=None):
+    # FTS5 query for rows containing every term, None if no term is long enough
+    terms = [term for term in terms if len(term) >= MIN_TERM_LENGTH]
+    if not terms:
+        return None
+    query = ' AND '.join(phrase(term) for term in terms)
+    if columns:
+        query = '{' + ' '.join(columns) + '} : (' + query + ')'
+    return query
+
+
+def matching_rowids(query):
+    # Subquery of the emails rowids matching an FTS5 query
+    return select(fts.c.rowid).where(literal_column(FTS_TABLE).op('MATCH')(query))
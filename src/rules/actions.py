@@ -0,0 +1,70 @@
+class ActionPlan:
+    '''
+    Collects the actions of matched rules for a whole run.
+    Actions on the same email are merged into one set of labels to add and
+    remove, emails that end up with the same sets are then modified together
+    through users.messages.batchModify
+    '''
+
+    def __init__(self):
+        self.changes = {}  # email id -> merged change
+
+    def __len__(self):
+        return len(self.changes)
+
+    def add(self, email_id, actions):
+        change = self.changes.setdefault(email_id, {'add': set(), 'remove': set(), 'folders': [], 'status': {}})
+        for action in actions:
+            action_type = action['type']
+
+            if action_type == 'mark_as_read':
+                change['add'].discard('UNREAD')
+                change['remove'].add('UNREAD')
+                change['status']['is_read'] = True
+
+            elif action_type == 'mark_as_unread':
+                change['remove'].discard('UNREAD')
+                change['add'].add('UNREAD')
+                change['status']['is_read'] = False
+
+            elif action_type == 'move_message':
+                # folders are label names, they are resolved to ids when flushing
+                if action['folder'] not in change['folders']:
+                    change['folders'].append(action['folder'])
+                change['remove'].add('INBOX')
+                change['status']['folder_name'] = action['folder']
+
+    def groups(self):
+        # Group email ids by identical (folders, add, remove) label sets
+        groups = {}
+        for email_id, change in self.changes.items():
+            key = (tuple(sorted(change['folders'])), frozenset(change['add']), frozenset(change['remove']))
+            groups.setdefault(key, []).append(email_id)
+        return groups
+
+    def flush(self, gmail, db):
+        # Send the planned changes to Gmail and record them in the database,
+        # returns the ids of the emails that were modified
+        applied = []
+        for (folders, add, remove), ids in self.groups().items():
+            if not (folders or add or remove):
+                continue
+            try:
+                add_ids = list(add) + [gmail.labels.resolve(folder) for folder in folders]
+            except Exception as e:
+                print(f"Error resolving labels {folders}: {e}")
+                continue
+
+            done = gmail.batch_modify(ids, add_label_ids=add_ids, remove_label_ids=list(remove))
+            if len(done) < len(ids) and folders:
+                # a cached label id may be stale, resolve the folders again and retry the rest
+                for folder in folders:
+                    gmail.labels.invalidate(folder)
+                remaining = [email_id for email_id in ids if email_id not in set(done)]
+                add_ids = list(add) + [gmail.labels.resolve(folder) for folder in folders]
+                done += gmail.batch_modify(remaining, add_label_ids=add_ids, remove_label_ids=list(remove))
+            applied.extend(done)
+
+        db.update_emails_status({email_id: self.changes[email_id]['status'] for email_id in applied})
+        self.changes = {}
+        return applied
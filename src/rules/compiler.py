@@ -0,0 +1,199 @@
+from collections import deque
+from datetime import datetime, timedelta
+from src.database.models import parse_email_date
+
+# Below this many distinct patterns on a field plain substring checks are
+# cheaper than walking the automaton character by character
+AC_MIN_PATTERNS = 8
+
+
+class AhoCorasick:
+    '''
+    Multi-pattern substring matcher.
+    search() scans the text once and returns the indexes of every pattern
+    that occurs in it, however many patterns were compiled in
+    '''
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [set()]
+
+        for index, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(set())
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.out[state].add(index)
+
+        # breadth first pass to build failure links
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.out[child] |= self.out[self.fail[child]]
+
+    def search(self, text):
+        found = set()
+        goto, fail, out = self.goto, self.fail, self.out
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found |= out[state]
+        return found
+
+
+class FieldMatcher:
+    '''
+    All contains/equals conditions on one email field.
+    hits() yields (condition id, result) for the conditions whose result
+    differs from their default
+    '''
+
+    def __init__(self):
+        self.contains = {}  # lowercased pattern -> [(condition id, result when found)]
+        self.equals = {}  # lowercased value -> [(condition id, result when equal)]
+        self.automaton = None
+
+    def add(self, cond_id, predicate, value):
+        if predicate in ('contains', 'does_not_contain'):
+            self.contains.setdefault(value, []).append((cond_id, predicate == 'contains'))
+        else:
+            self.equals.setdefault(value, []).append((cond_id, predicate == 'equals'))
+
+    def build(self):
+        patterns = [pattern for pattern in self.contains if pattern]
+        if len(patterns) >= AC_MIN_PATTERNS:
+            self.automaton = AhoCorasick(patterns)
+
+    def hits(self, text):
+        if self.automaton is not None:
+            patterns = self.automaton.patterns
+            found = [patterns[index] for index in self.automaton.search(text)]
+            if '' in self.contains:
+                found.append('')
+        else:
+            found = [pattern for pattern in self.contains if pattern in text]
+        for pattern in found:
+            yield from self.contains[pattern]
+        yield from self.equals.get(text, ())
+
+
+class CompiledRuleSet:
+    '''
+    Rules from rules.json compiled once into per-field matchers.
+    match() lowercases and scans each referenced field of an email once and
+    returns the same rules RuleEngine.evaluate_rule would match
+    '''
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.defaults = []  # result of each condition when its field has no hit
+        self.matchers = {}  # field -> FieldMatcher
+        self.date_conditions = []  # (condition id, predicate, days)
+        self.compiled = []  # (rule, predicate_type, condition ids)
+
+        for rule in rules:
+            cond_ids = []
+            for condition in rule['conditions']:
+                cond_id = len(self.defaults)
+                cond_ids.append(cond_id)
+                field = condition['field']
+                predicate = condition['predicate']
+                value = condition['value']
+
+                if field == 'date_received':
+                    self.defaults.append(False)
+                    if predicate in ('less_than', 'greater_than'):
+                        self.date_conditions.append((cond_id, predicate, int(value)))
+                elif predicate in ('contains', 'does_not_contain', 'equals', 'does_not_equal'):
+                    # negative predicates hold unless the field hits the value
+                    self.defaults.append(predicate in ('does_not_contain', 'does_not_equal'))
+                    self.matchers.setdefault(field, FieldMatcher()).add(cond_id, predicate, str(value).lower())
+                else:
+                    self.defaults.append(False)
+            self.compiled.append((rule, rule['predicate_type'], cond_ids))
+
+        for matcher in self.matchers.values():
+            matcher.build()
+
+        self.rules_by_condition = [[] for _ in self.defaults]
+        for index, (_, _, cond_ids) in enumerate(self.compiled):
+            for cond_id in cond_ids:
+                self.rules_by_condition[cond_id].append(index)
+        lookup = self.defaults.__getitem__
+        self.default_matches = {index for index in range(len(self.compiled)) if self._matches(index, lookup)}
+
+    @property
+    def fields(self):
+        # email fields referenced by at least one condition
+        fields = set(self.matchers)
+        if self.date_conditions:
+            fields.add('date_received')
+        return fields
+
+    def evaluate(self, email, now=None):
+        # Return the result of every condition for this email
+        return self._evaluate(email, now)[0]
+
+    def _evaluate(self, email, now=None):
+        # Returns (condition results, ids of the conditions that were evaluated)
+        results = list(self.defaults)
+        touched = []
+        for field, matcher in self.matchers.items():
+            text = str(email.get(field, '')).lower()
+            for cond_id, result in matcher.hits(text):
+                results[cond_id] = result
+                touched.append(cond_id)
+
+        if self.date_conditions:
+            email_date = self._email_date(email)
+            if email_date is not None:
+                now = now or datetime.utcnow()
+                for cond_id, predicate, days in self.date_conditions:
+                    threshold = now - timedelta(days=days)
+                    if predicate == 'less_than':
+                        results[cond_id] = email_date > threshold
+                    else:
+                        results[cond_id] = email_date < threshold
+                    touched.append(cond_id)
+        return results, touched
+
+    def _email_date(self, email):
+        # received_at is parsed at ingest, fall back to the raw header
+        if email.get('received_at') is not None:
+            return email['received_at']
+        return parse_email_date(email.get('date'))
+
+    def _matches(self, index, lookup):
+        _, predicate_type, cond_ids = self.compiled[index]
+        if predicate_type == 'all':
+            return all(map(lookup, cond_ids))
+        elif predicate_type == 'any':
+            return any(map(lookup, cond_ids))
+        return False
+
+    def match(self, email, now=None):
+        # Only rules with a condition that hit need evaluating, every other
+        # rule has the outcome it has under the default condition results
+        results, touched = self._evaluate(email, now)
+        lookup = results.__getitem__
+        affected = set()
+        for cond_id in touched:
+            affected.update(self.rules_by_condition[cond_id])
+        matched = self.default_matches - affected
+        matched.update(index for index in affected if self._matches(index, lookup))
+        return [self.compiled[index][0] for index in sorted(matched)]
@@ -0,0 +1,140 @@
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import and_, or_, func, literal_column
+from src.database import EmailDatabase
+from src.database.engine import dispose_engines
+from src.database.models import Email
+from src.utils.profiler import incr
+from .compiler import CompiledRuleSet
+from .sql import rules_clause, crossing_clause
+from .versioning import rule_hash, ruleset_version
+
+'''
+Evaluation of rules over the stored emails, serial or sharded.
+A run is split into steps of (rules, scope). A scope says which stored
+emails a step covers. It is plain data so it can be sent to worker
+processes, and step_clause() turns it into SQL:
+    None                          every email
+    ('pending', known versions)   new or changed emails, or emails of unknown rule sets
+    ('version', version)          emails last evaluated under `version`
+    ('crossing', rule, since)     emails aging past a greater_than date of `rule` since `since`
+'''
+
+# shards per worker, smaller shards even out uneven rowid ranges
+SHARDS_PER_WORKER = 4
+
+_compiled = {}  # rule set version -> CompiledRuleSet, per process
+
+
+def step_clause(scope, now):
+    if scope is None:
+        return None
+    kind = scope[0]
+    if kind == 'pending':
+        return or_(Email.rules_version.is_(None), Email.rules_version.not_in(list(scope[1])))
+    elif kind == 'version':
+        return Email.rules_version == scope[1]
+    elif kind == 'crossing':
+        return and_(Email.rules_version.is_not(None), crossing_clause(scope[1], scope[2], now))
+    raise ValueError(f'Unknown evaluation scope {kind}')
+
+
+def email_dict(email, with_body):
+    return {
+        'id': email.id,
+        'from': email.sender,
+        'subject': email.subject,
+        'message': email.body if with_body else None,
+        'date': email.date,
+        'received_at': email.received_at,
+        'is_read': email.is_read,
+        'folder_name': email.folder_name
+    }
+
+
+def iter_matches(db, compiled, rules, now, where=None, count=None):
+    # Yield (email dict, matched rules) for the stored emails that match a rule.
+    # The rule conditions are pushed down into SQL so only candidate rows are
+    # loaded, candidates are then checked exactly by the compiled rules
+    clause = rules_clause(rules, now)
+    if where is not None:
+        clause = and_(where, clause)
+    # bodies are only read when a rule looks at the message
+    with_body = 'message' in compiled.fields
+    for email in db.get_emails(where=clause, count=count, with_body=with_body):
+        email_data = email_dict(email, with_body)
+        incr('rules_evaluated', len(rules))
+        matched = compiled.match(email_data, now)
+        if matched:
+            yield email_data, matched
+
+
+def _compile(rules):
+    version = ruleset_version([rule_hash(rule) for rule in rules])
+    if version not in _compiled:
+        _compiled[version] = CompiledRuleSet(rules)
+    return _compiled[version]
+
+
+def _init_worker():
+    # A forked worker must not touch the parent's pooled SQLite connections
+    dispose_engines(close=False)
+
+
+def match_shard(db_path, rules, scope, count, now, low, high):
+    # Worker side: evaluate the emails with rowid in [low, high] and return
+    # [(email id, subject, indexes of the matched rules)]
+    db = EmailDatabase(db_path)
+    try:
+        compiled = _compile(rules)
+        index = {id(rule): position for position, rule in enumerate(compiled.rules)}
+        where = literal_column('emails.rowid').between(low, high)
+        clause = step_clause(scope, now)
+        if clause is not None:
+            where = and_(clause, where)
+        return [
+            (email_data['id'], email_data['subject'], [index[id(rule)] for rule in matched])
+            for email_data, matched in iter_matches(db, compiled, rules, now, where=where, count=count)
+        ]
+    finally:
+        db.close()
+
+
+def shards(db, workers):
+    # Split the rowids of the emails table into contiguous ranges
+    low, high = db.session.query(func.min(literal_column('rowid')), func.max(literal_column('rowid'))).select_from(
+        Email).one()
+    if low is None:
+        return []
+    parts = max(1, workers * SHARDS_PER_WORKER)
+    size = max(1, -(-(high - low + 1) // parts))
+    return [(start, min(start + size - 1, high)) for start in range(low, high + 1, size)]
+
+
+class ShardedEvaluator:
+    '''
+    Runs match_shard over rowid ranges of the database on a process pool.
+    Workers read their slice straight from SQLite and only send back ids
+    and rule indexes, the parent turns those into the same
+    (email dict, matched rules) pairs iter_matches yields
+    '''
+
+    def __init__(self, db, workers):
+        self.db = db
+        self.workers = workers
+        self.db_path = db.engine.url.database
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.pool.shutdown(wait=True)
+
+    def matches(self, rules, scope, count, now):
+        futures = [
+            self.pool.submit(match_shard, self.db_path, rules, scope, count, now, low, high)
+            for low, high in shards(self.db, self.workers)
+        ]
+        for future in futures:
+            for email_id, subject, indexes in future.result():
+                yield {'id': email_id, 'subject': subject}, [rules[index] for index in indexes]
@@ -1,7 +1,14 @@
 import json
+from contextlib import ExitStack
 from datetime import datetime, timedelta
 from src.database import EmailDatabase
+from src.database.models import parse_email_date
 from src.api import gmailApi
+from src.utils.profiler import incr, span
+from .actions import ActionPlan
+from .compiler import CompiledRuleSet
+from .evaluation import ShardedEvaluator, iter_matches, step_clause
+from .versioning import rule_hash, ruleset_version, is_time_dependent
 
 class RuleEngine:
     FIELD_PREDICATES = {
@@ -11,25 +18,55 @@ class RuleEngine:
         'date_received': ['less_than', 'greater_than']
     }
 
-    def __init__(self, rules_file='config/rules.json'):
-        self.rules = self._load_rules(rules_file)
-        self.gmail = gmailApi()
-        self.db = EmailDatabase()
+    def __init__(self, rules_file='config/rules.json', gmail=None, db=None):
+        self.set_rules(self._load_rules(rules_file))
+        # the caller's client and database can be shared instead of opening new ones
+        self.gmail = gmail or gmailApi()
+        self.db = db or EmailDatabase()
+        self.plan = ActionPlan()
 
     def _load_rules(self, rules_file):
         with open(rules_file, 'r') as f:
             return json.load(f)['rules']
 
+    def set_rules(self, rules):
+        self.rules = rules
+        self.compiled = CompiledRuleSet(rules)
+        self.rule_hashes = [rule_hash(rule) for rule in rules]
+        self.version = ruleset_version(self.rule_hashes)
+        self._rule_index = {id(rule): index for index, rule in enumerate(rules)}
+
+    @property
+    def fields(self):
+        # email fields the active rules look at
+        return self.compiled.fields
+
+    @property
+    def needs_body(self):
+        # Emails only have to be fetched with their body when a rule reads it
+        return 'message' in self.fields
+
+    def fetch_bodies(self, count=None, chunk_size=500):
+        # Download the bodies of stored emails that were fetched as metadata only
+        ids = list(self.db.get_ids_without_body(count))
+        stored = 0
+        for start in range(0, len(ids), chunk_size):
+            stored += self.db.store_bodies(self.gmail.get_emails(ids[start:start + chunk_size]))
+        if stored:
+            print(f"Fetched {stored} email bod{'y' if stored == 1 else 'ies'} for message rules")
+        return stored
+
     def check_condition(self, condition, email):
         field = condition['field']
         predicate = condition['predicate']
         value = condition['value']
 
         if field == 'date_received':
-            email_date = datetime.strptime(email['date'], '%a, %d %b %Y %H:%M:%S %z')
+            email_date = email.get('received_at') or parse_email_date(email['date'])
+            if email_date is None:
+                return False
             days = int(value)
-            threshold = datetime.now(email_date.tzinfo) - timedelta(days=days)
-            print(days,email_date,threshold)
+            threshold = datetime.utcnow() - timedelta(days=days)
             
             if predicate == 'less_than':
                 return email_date > threshold
@@ -63,42 +100,99 @@ class RuleEngine:
         return False
 
     def execute_actions(self, actions, email):
-        for action in actions:
-            action_type = action['type']
-            
-            if action_type == 'mark_as_read':
-                if self.gmail.mark_as_read(email['id']):
-                    self.db.update_email_status(email['id'], is_read=True)
-                    
-            elif action_type == 'mark_as_unread':
-                if self.gmail.mark_as_unread(email['id']):
-                    self.db.update_email_status(email['id'], is_read=False)
-                    
-            elif action_type == 'move_message':
-                if self.gmail.move_message(email['id'], action['folder']):
-                    self.db.update_email_status(email['id'], folder_name=action['folder'])
-                self.gmail.move_message(email['id'], action['folder'])
-
-    def process_emails(self, count=None):
-        emails = self.db.get_all_emails()
-        if count:
-            emails = emails[:count]
-        
-        for email in emails:
-            email_dict = {
-                'id': email.id,
-                'from': email.sender,
-                'subject': email.subject,
-                'message': email.body,
-                'date': email.date,
-                'is_read': email.is_read,
-                'folder_name': email.folder_name
-            }
-            
+        # Actions are queued and merged per email, apply_actions sends them
+        self.plan.add(email['id'], actions)
+
+    def apply_actions(self):
+        return self.plan.flush(self.gmail, self.db)
+
+    def match_emails(self, count=None, now=None, rules=None, where=None):
+        # Yield (email dict, matched rules) for the stored emails that match a rule
+        now = now or datetime.utcnow()
+        if rules is None:
+            rules, compiled = self.rules, self.compiled
+        else:
+            compiled = CompiledRuleSet(rules)
+        yield from iter_matches(self.db, compiled, rules, now, where=where, count=count)
+
+    def plan_evaluation(self, now):
+        # Split a run into (rules, scope, record version) steps so only what may
+        # have changed since the last run is evaluated, see evaluation.py
+        rule_sets = self.db.get_rule_sets()
+        steps = [
+            # new emails, changed emails and emails of unknown rule sets get every rule
+            (self.rules, ('pending', sorted(rule_sets)), True)
+        ]
+        for version, (hashes, _) in rule_sets.items():
+            if version != self.version:
+                # emails handled by an older rule set only need the rules added since
+                added = [rule for rule, digest in zip(self.rules, self.rule_hashes) if digest not in hashes]
+                steps.append((added, ('version', version), True))
+
+        last_run = max((run_at for _, run_at in rule_sets.values() if run_at), default=None)
+        if last_run:
             for rule in self.rules:
-                if self.evaluate_rule(rule, email_dict):
-                    print(f"Rule '{rule['name']}' matched for email: {email.subject}")
-                    self.execute_actions(rule['actions'], email_dict)
-        
+                if is_time_dependent(rule):
+                    # already evaluated emails that aged past a greater_than threshold
+                    steps.append(([rule], ('crossing', rule, last_run), False))
+        return steps
+
+    def process_emails(self, count=None, full=False, workers=None):
+        # Evaluate the rules and apply their actions. Unless full is set only new
+        # or changed emails and rules added since an email was last evaluated are
+        # looked at. With workers the evaluation is sharded over that many
+        # processes, actions are still applied from this one
+        now = datetime.utcnow()
+        if self.needs_body:
+            with span('rules.fetch_bodies'):
+                self.fetch_bodies(count)
+        self.db.register_rule_set(self.version, self.rule_hashes)
+        steps = [(self.rules, None, True)] if full else self.plan_evaluation(now)
+
+        with ExitStack() as stack:
+            sharded = stack.enter_context(ShardedEvaluator(self.db, workers)) if workers and workers > 1 else None
+            matches = {}  # email id -> (email dict, {rule index: rule})
+            evaluated = set()
+            for rules, scope, record in steps:
+                where = step_clause(scope, now)
+                if record:
+                    evaluated |= self.db.get_email_ids(where=where, count=count)
+                if not rules:
+                    continue
+                if sharded is not None:
+                    results = sharded.matches(rules, scope, count, now)
+                else:
+                    results = self.match_emails(count, now, rules=rules, where=where)
+                with span('rules.evaluate'):
+                    for email_dict, matched in results:
+                        incr('rule_matches', len(matched))
+                        _, found = matches.setdefault(email_dict['id'], (email_dict, {}))
+                        for rule in matched:
+                            found[self._rule_index[id(rule)]] = rule
+        incr('emails_evaluated', len(evaluated))
+
+        with span('rules.apply'):
+            applied = self.apply_matches([(email_dict, [found[index] for index in sorted(found)])
+                                          for email_dict, found in matches.values()], evaluated, now)
+        return {'evaluated': len(evaluated), 'matched': len(matches), 'applied': len(applied)}
+
+    def apply_matches(self, matches, evaluated, now, gmail=None, db=None):
+        # Apply the actions of (email dict, matched rules) pairs and record this
+        # rule set on the evaluated email ids, returns the ids that were modified.
+        # gmail and db default to the engine's, callers on other threads pass their own
+        gmail = gmail or self.gmail
+        db = db or self.db
+        plan = ActionPlan()
+        for email_dict, matched in matches:
+            for rule in matched:
+                print(f"Rule '{rule['name']}' matched for email: {email_dict['subject']}")
+                plan.add(email_dict['id'], rule['actions'])
+
+        planned = set(plan.changes)
+        applied = set(plan.flush(gmail, db)) if planned else set()
+        # emails whose actions failed stay pending and are retried next run
+        db.set_rules_version(set(evaluated) - (planned - applied), self.version, run_at=now)
+        return applied
+
     def close(self):
         self.db.close()
\ No newline at end of file
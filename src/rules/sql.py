@@ -0,0 +1,95 @@
+from datetime import timedelta
+from sqlalchemy import and_, or_, true, false, func, literal_column
+from src.database.models import Email, SEARCH_FIELDS
+from src.database.search import MIN_TERM_LENGTH, match_query, matching_rowids
+
+'''
+Translation of rule conditions into SQL WHERE clauses.
+The clauses only narrow down candidate rows, every candidate is still
+checked by the compiled rule set, so a condition that cannot be expressed
+exactly in SQLite is translated to TRUE rather than risk dropping a match
+'''
+
+FIELD_COLUMNS = {
+    'from': Email.sender,
+    'subject': Email.subject,
+    'message': Email.body,  # decompressed from email_bodies
+}
+# SQLite parses a chain of ORs into a tree as deep as the chain and refuses
+# trees deeper than 1000, larger rule sets are checked in Python only
+MAX_CONDITIONS = 500
+
+
+def _field_text(column):
+    # RuleEngine compares str(value).lower(), NULL becomes 'None'
+    return func.lower(func.coalesce(column, 'None'))
+
+
+def _indexable(value):
+    # The trigram index needs 3+ characters and does not see NULL columns,
+    # which the rules compare as 'None'
+    return len(value) >= MIN_TERM_LENGTH and value not in 'none'
+
+
+def condition_clause(condition, now):
+    field = condition['field']
+    predicate = condition['predicate']
+    value = condition['value']
+
+    if field == 'date_received':
+        threshold = now - timedelta(days=int(value))
+        if predicate == 'less_than':
+            return Email.received_at > threshold
+        elif predicate == 'greater_than':
+            return Email.received_at < threshold
+        return false()
+
+    if predicate not in ('contains', 'does_not_contain', 'equals', 'does_not_equal'):
+        return false()
+    column = FIELD_COLUMNS.get(field)
+    value = str(value).lower()
+    # SQLite only folds ASCII case, leave other values to the Python check
+    if column is None or not value.isascii():
+        return true()
+
+    if predicate in ('contains', 'does_not_contain') and _indexable(value):
+        # answered by the full-text index instead of a LIKE scan
+        rowids = matching_rowids(match_query([value], [SEARCH_FIELDS[field]]))
+        if predicate == 'contains':
+            return literal_column('emails.rowid').in_(rowids)
+        return literal_column('emails.rowid').not_in(rowids)
+
+    if predicate == 'contains':
+        return _field_text(column).contains(value, autoescape=True) if value else true()
+    elif predicate == 'does_not_contain':
+        return ~_field_text(column).contains(value, autoescape=True) if value else false()
+    elif predicate == 'equals':
+        return _field_text(column) == value
+    return _field_text(column) != value
+
+
+def rule_clause(rule, now):
+    clauses = [condition_clause(condition, now) for condition in rule['conditions']]
+    if rule['predicate_type'] == 'all':
+        return and_(true(), *clauses)
+    elif rule['predicate_type'] == 'any':
+        return or_(false(), *clauses)
+    return false()
+
+
+def rules_clause(rules, now):
+    # Rows that may match at least one rule
+    if sum(len(rule['conditions']) for rule in rules) > MAX_CONDITIONS:
+        return true()
+    return or_(false(), *[rule_clause(rule, now) for rule in rules])
+
+
+def crossing_clause(rule, since, now):
+    # Emails for which a greater_than date condition of the rule turned true
+    # between `since` and `now`
+    clauses = []
+    for condition in rule['conditions']:
+        if condition['field'] == 'date_received' and condition['predicate'] == 'greater_than':
+            days = timedelta(days=int(condition['value']))
+            clauses.append(and_(Email.received_at >= since - days, Email.received_at < now - days))
+    return or_(false(), *clauses)
@@ -0,0 +1,22 @@
+import hashlib
+import json
+
+
+def _digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def rule_hash(rule):
+    # The name is left out so renaming a rule does not re-evaluate it
+    return _digest({key: rule.get(key) for key in ('predicate_type', 'conditions', 'actions')})
+
+
+def ruleset_version(rule_hashes):
+    # Same rules in any order give the same version
+    return _digest(sorted(rule_hashes))
+
+
+def is_time_dependent(rule):
+    # greater_than date conditions turn true as time passes without the email changing
+    return any(condition['field'] == 'date_received' and condition['predicate'] == 'greater_than'
+               for condition in rule['conditions'])
@@ -0,0 +1,5 @@
+from .mailbox_sync import MailboxSync
+from .pipeline import SyncPipeline
+from .watch import Watcher, WebhookServer
+
+__all__ = ['MailboxSync', 'SyncPipeline', 'Watcher', 'WebhookServer']
@@ -0,0 +1,124 @@
+from src.api.gmail_api import HistoryExpiredError
+from src.database.models import Email
+
+# messages.get parameters for just the labels, enough to tell where a message is now
+LABEL_PARAMS = {'format': 'minimal', 'fields': 'id,labelIds'}
+
+
+class MailboxSync:
+    '''
+    Keeps the database in step with Gmail using history ids.
+    The first run (or a run after the cursor expired) lists the inbox,
+    later runs only apply the changes reported by users.history.list.
+    Both leave the same rows behind: inbox messages are stored, stored
+    messages that left the inbox keep their row with the folder they are in
+    now, and only messages Gmail no longer has are deleted.
+    Bodies are only downloaded with with_body
+    '''
+
+    def __init__(self, gmail, db, account='me', batch_size=100, with_body=True):
+        self.gmail = gmail
+        self.db = db
+        self.account = account
+        self.batch_size = batch_size
+        self.with_body = with_body
+
+    def run(self, limit=None, full=False):
+        cursor = self.db.get_sync_cursor(self.account)
+        if cursor and not full:
+            try:
+                return self.incremental_sync(cursor)
+            except HistoryExpiredError:
+                print("Sync cursor expired, falling back to a full resync")
+        return self.full_sync(limit=limit)
+
+    def folder_name(self, label_ids):
+        # The folder a message with these labels is shown in
+        if 'INBOX' in label_ids:
+            return 'INBOX'
+        for system in ('TRASH', 'SPAM'):
+            if system in label_ids:
+                return system
+        for label_id in label_ids:
+            if label_id.startswith('Label_'):
+                name = self.gmail.labels.name(label_id)
+                if name:
+                    return name
+        return 'ARCHIVE'
+
+    def apply_labels(self, labels):
+        # Record {message id: label ids} on the stored emails, returns how many were updated
+        if not labels:
+            return 0
+        self.db.update_emails_status({msg_id: {'is_read': 'UNREAD' not in label_ids,
+                                               'folder_name': self.folder_name(label_ids)}
+                                      for msg_id, label_ids in labels.items()})
+        return len(labels)
+
+    def full_sync(self, limit=None):
+        # Take the cursor before listing so changes made while listing are
+        # picked up by the next incremental run
+        history_id = self.gmail.get_profile()['historyId']
+        listed = set()
+        stored = 0
+        # listing and fetch errors are raised, nothing is pruned and the cursor
+        # stays where it was
+        for ids, emails in self.gmail.iter_pages(limit=limit, with_body=self.with_body):
+            listed.update(ids)
+            stored += sum(self.db.store_emails(emails, batch_size=self.batch_size))
+
+        deleted = updated = 0
+        if limit is None:
+            # the whole inbox was listed, ask Gmail about every other stored email:
+            # gone ones are deleted, the others moved out of the inbox
+            missing = list(self.db.get_email_ids() - listed)
+            if missing:
+                found = self.gmail.get_messages_batch(missing, **LABEL_PARAMS)
+                gone = [msg_id for msg_id in missing if msg_id not in found]
+                if gone and self.db.delete_emails(gone):
+                    deleted = len(gone)
+                updated = self.apply_labels({msg_id: message.get('labelIds', []) for msg_id, message in found.items()})
+
+        self.db.set_sync_cursor(history_id, self.account)
+        return {'mode': 'full', 'added': stored, 'deleted': deleted, 'updated': updated}
+
+    def incremental_sync(self, cursor):
+        records, history_id = self.gmail.list_history(cursor)
+
+        added = set()
+        deleted = set()
+        labels = {}  # message id -> latest label ids, insertion ordered
+        for record in records:
+            for item in record.get('messagesAdded', []):
+                message = item['message']
+                added.add(message['id'])
+                deleted.discard(message['id'])
+                labels[message['id']] = message.get('labelIds')
+            for item in record.get('messagesDeleted', []):
+                deleted.add(item['message']['id'])
+                labels.pop(item['message']['id'], None)
+            for item in record.get('labelsAdded', []) + record.get('labelsRemoved', []):
+                message = item['message']
+                if 'labelIds' in message:
+                    labels[message['id']] = message['labelIds']
+
+        known = self.db.get_email_ids(where=Email.id.in_(list(labels))) if labels else set()
+        # messages to store are the ones a full sync would list: in the inbox
+        # now and not stored yet, new ones and ones moved back into the inbox
+        fetch = [msg_id for msg_id, label_ids in labels.items()
+                 if msg_id not in known and (label_ids is None and msg_id in added or label_ids and 'INBOX' in label_ids)]
+        stored = 0
+        if fetch:
+            emails = [email for email in self.gmail.get_emails(fetch, with_body=self.with_body) if 'INBOX' in email['labels']]
+            stored = sum(self.db.store_emails(emails, batch_size=self.batch_size))
+
+        # stored messages keep their row wherever they went
+        updated = self.apply_labels({msg_id: label_ids for msg_id, label_ids in labels.items()
+                                     if msg_id in known and label_ids is not None})
+
+        deleted &= self.db.get_email_ids(where=Email.id.in_(list(deleted))) if deleted else set()
+        if deleted:
+            self.db.delete_emails(deleted)
+
+        self.db.set_sync_cursor(history_id, self.account)
+        return {'mode': 'incremental', 'added': stored, 'deleted': len(deleted), 'updated': updated}
@@ -0,0 +1,308 @@
+import queue
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import and_
+from src.api.gmail_api import gmailApi, new_service, BATCH_SIZE, PAGE_SIZE
+from src.api.labels import LABEL_CACHE_FILE
+from src.database import EmailDatabase
+from src.database.models import Email
+from src.rules.evaluation import iter_matches, step_clause
+
+'''
+Staged sync: list -> fetch -> parse -> store -> evaluate -> act.
+Every stage runs on its own threads and hands chunks of emails to the next
+one through a bounded queue, so listing, Gmail requests, body parsing, SQLite
+writes and rule evaluation overlap, and a slow stage blocks the ones before
+it instead of letting chunks pile up in memory (at most queue_size chunks
+wait between two stages).
+Fetch workers each get their own Gmail service, googleapiclient services are
+not thread safe. store, evaluate and act have one worker each, SQLite takes
+one writer at a time and the evaluate and act workers open their own session.
+'''
+
+FETCH_WORKERS = 4
+PARSE_WORKERS = 2
+QUEUE_SIZE = 8
+
+_DONE = object()
+
+
+class Stage:
+    '''
+    `workers` threads calling handler on the chunks of the stage's inbox and
+    putting what it returns (unless None) on the inbox of the next stage. A
+    source stage has no inbox, its handler is called once and yields chunks.
+    Records the chunk sizes handled, the time spent in the handler and the
+    inbox depth seen before every get.
+    A handler error is kept in `error` and sets `failed`, which every stage of
+    a pipeline shares: the source stops listing and the other stages drain
+    their inbox without handling it, so the run ends without blocking
+    '''
+
+    def __init__(self, name, handler, workers=1, queue_size=QUEUE_SIZE, source=False, failed=None):
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.source = source
+        self.inbox = None if source else queue.Queue(maxsize=queue_size)
+        self.queue_size = queue_size
+        self.next = None
+        self.lock = threading.Lock()
+        self.remaining = self.workers
+        self.items = 0
+        self.chunks = 0
+        self.busy = 0.0
+        self.errors = 0
+        self.error = None  # first handler error
+        self.failed = failed or threading.Event()
+        self.max_depth = 0
+        self.depth_total = 0
+        self.started = None
+        self.finished = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.threads = [threading.Thread(target=self._work, name=f'{self.name}-{i}', daemon=True)
+                        for i in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def _emit(self, chunk):
+        # blocks while the next stage's inbox is full
+        if chunk is not None and self.next is not None:
+            self.next.inbox.put(chunk)
+
+    def _record(self, size, seconds, depth=None):
+        with self.lock:
+            self.items += size
+            self.chunks += 1
+            self.busy += seconds
+            if depth is not None:
+                self.max_depth = max(self.max_depth, depth)
+                self.depth_total += depth
+
+    def _work(self):
+        try:
+            if self.source:
+                self._produce()
+            else:
+                self._consume()
+        finally:
+            with self.lock:
+                self.remaining -= 1
+                last = self.remaining == 0
+            if last:
+                self.finished = time.perf_counter()
+                if self.next is not None:
+                    for _ in range(self.next.workers):
+                        self.next.inbox.put(_DONE)
+
+    def _fail(self, error):
+        with self.lock:
+            self.errors += 1
+            if self.error is None:
+                self.error = error
+        self.failed.set()
+
+    def _produce(self):
+        chunks = self.handler()
+        while not self.failed.is_set():
+            start = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            except Exception as e:
+                self._fail(e)
+                return
+            self._record(len(chunk), time.perf_counter() - start)
+            self._emit(chunk)
+
+    def _consume(self):
+        while True:
+            depth = self.inbox.qsize()
+            chunk = self.inbox.get()
+            if chunk is _DONE:
+                return
+            if self.failed.is_set():
+                continue
+            start = time.perf_counter()
+            try:
+                output = self.handler(chunk)
+            except Exception as e:
+                self._fail(e)
+                output = None
+            self._record(len(chunk), time.perf_counter() - start, depth)
+            self._emit(output)
+
+    def report(self):
+        seconds = (self.finished or time.perf_counter()) - (self.started or time.perf_counter())
+        return {
+            'workers': self.workers,
+            'items': self.items,
+            'seconds': round(seconds, 6),
+            'busy': round(self.busy, 6),
+            'rate': round(self.items / seconds, 2) if seconds > 0 else 0.0,
+            'max_queue': self.max_depth if not self.source else None,
+            'mean_queue': round(self.depth_total / self.chunks, 2) if self.chunks and not self.source else None,
+            'errors': self.errors,
+        }
+
+
+class SyncPipeline:
+    '''
+    Lists, fetches and stores the mailbox like gmailApi.iter_emails and
+    EmailDatabase.store_emails, with the stages running concurrently. With a
+    rule engine the stored emails the rules have not seen yet are evaluated
+    and their actions applied while later chunks are still being fetched,
+    the rule versions are recorded like RuleEngine.process_emails does.
+    The first error of any stage stops the run and is raised by run()
+    '''
+
+    def __init__(self, gmail, db, rule_engine=None, service_factory=None, fetch_workers=FETCH_WORKERS,
+                 parse_workers=PARSE_WORKERS, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, page_size=PAGE_SIZE,
+                 with_body=True, label_cache=LABEL_CACHE_FILE):
+        self.gmail = gmail
+        self.db = db
+        self.rule_engine = rule_engine
+        # called once per fetch and act worker to build that thread's service
+        self.service_factory = service_factory or new_service
+        self.fetch_workers = fetch_workers
+        self.parse_workers = parse_workers
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.page_size = page_size
+        self.with_body = with_body
+        self.label_cache = label_cache
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.opened = []  # databases opened by the workers
+        self.stages = []
+        self.totals = {}
+
+    def _client(self):
+        # the calling thread's Gmail client
+        if getattr(self.local, 'gmail', None) is None:
+            self.local.gmail = gmailApi(service=self.service_factory(), label_cache=self.label_cache,
+                                        limiter=self.gmail.limiter, body_workers=self.gmail.body_workers)
+        return self.local.gmail
+
+    def _database(self):
+        # the calling thread's session on the database of self.db
+        if getattr(self.local, 'db', None) is None:
+            self.local.db = EmailDatabase(self.db.engine.url.database)
+            self.opened.append(self.local.db)
+        return self.local.db
+
+    def _add(self, name, value):
+        with self.lock:
+            self.totals[name] = self.totals.get(name, 0) + value
+
+    # ---- stages ----
+    def list_ids(self, query=None, limit=None):
+        # pages of message ids, split into fetch sized chunks
+        page_token = None
+        listed = 0
+        while limit is None or listed < limit:
+            size = self.page_size if limit is None else min(self.page_size, limit - listed)
+            ids, page_token = self.gmail.list_messages(query, size, page_token)
+            listed += len(ids)
+            self._add('listed', len(ids))
+            for start in range(0, len(ids), self.batch_size):
+                yield ids[start:start + self.batch_size]
+            if not page_token:
+                break
+
+    def fetch(self, ids):
+        gmail = self._client()
+        fetched = gmail.get_messages_batch(ids, batch_size=self.batch_size, **gmail.message_params(self.with_body))
+        return [fetched[msg_id] for msg_id in ids if msg_id in fetched] or None
+
+    def parse(self, messages):
+        return self.gmail.parse_messages(messages, self.with_body)
+
+    def store(self, emails):
+        stored = sum(self.db.store_emails(emails, batch_size=len(emails)))
+        if not stored:
+            # store_emails reports its error and rolls the chunk back
+            raise RuntimeError(f"Failed to store {len(emails)} email(s)")
+        self._add('stored', stored)
+        return [email['id'] for email in emails]
+
+    def evaluate(self, ids):
+        db = self._database()
+        engine = self.rule_engine
+        where = and_(Email.id.in_(ids), step_clause(('pending', self.versions), self.now))
+        evaluated = db.get_email_ids(where=where)
+        matches = {email['id']: (email, matched)
+                   for email, matched in iter_matches(db, engine.compiled, engine.rules, self.now, where=where)}
+        db.session.expunge_all()
+        self._add('evaluated', len(evaluated))
+        self._add('matched', len(matches))
+        # (email id, email dict, matched rules) for every evaluated email
+        return [(email_id, *matches.get(email_id, (None, []))) for email_id in evaluated] or None
+
+    def act(self, results):
+        matches = [(email, matched) for _, email, matched in results if matched]
+        applied = self.rule_engine.apply_matches(matches, [email_id for email_id, _, _ in results], self.now,
+                                                 gmail=self._client(), db=self._database())
+        self._add('applied', len(applied))
+        return None
+
+    # ---- running ----
+    def run(self, query=None, limit=None):
+        # Sync up to limit emails (all without) through the stages, returns
+        # the totals and a report per stage. Raises the first stage error
+        self.totals = {'listed': 0, 'stored': 0, 'evaluated': 0, 'matched': 0, 'applied': 0}
+        self.now = datetime.utcnow()
+        if self.rule_engine is not None:
+            self.db.register_rule_set(self.rule_engine.version, self.rule_engine.rule_hashes)
+            self.versions = sorted(self.db.get_rule_sets())
+
+        failed = threading.Event()
+        self.stages = [
+            Stage('list', lambda: self.list_ids(query, limit), source=True, failed=failed),
+            Stage('fetch', self.fetch, self.fetch_workers, self.queue_size, failed=failed),
+            Stage('parse', self.parse, self.parse_workers, self.queue_size, failed=failed),
+            Stage('store', self.store, 1, self.queue_size, failed=failed),
+        ]
+        if self.rule_engine is not None:
+            self.stages += [Stage('evaluate', self.evaluate, 1, self.queue_size, failed=failed),
+                            Stage('act', self.act, 1, self.queue_size, failed=failed)]
+        for stage, following in zip(self.stages, self.stages[1:]):
+            stage.next = following
+
+        start = time.perf_counter()
+        try:
+            for stage in reversed(self.stages):
+                stage.start()
+            for stage in self.stages:
+                stage.join()
+        finally:
+            for db in self.opened:
+                db.close()
+            self.opened = []
+        for stage in self.stages:
+            if stage.error is not None:
+                raise stage.error
+        return {**self.totals, 'elapsed': round(time.perf_counter() - start, 6), 'stages': self.report()}
+
+    def report(self):
+        return {stage.name: stage.report() for stage in self.stages}
+
+
+def format_report(result):
+    # The per stage report of SyncPipeline.run as a table
+    lines = [f"{'stage':<10}{'workers':>8}{'items':>10}{'items/s':>12}{'busy s':>10}{'max queue':>11}{'mean queue':>12}"
+             f"{'errors':>8}"]
+    for name, stage in result['stages'].items():
+        max_queue = '-' if stage['max_queue'] is None else stage['max_queue']
+        mean_queue = '-' if stage['mean_queue'] is None else stage['mean_queue']
+        lines.append(f"{name:<10}{stage['workers']:>8}{stage['items']:>10}{stage['rate']:>12.1f}"
+                     f"{stage['busy']:>10.2f}{max_queue:>11}{mean_queue:>12}{stage['errors']:>8}")
+    return '\n'.join(lines)
@@ -0,0 +1,303 @@
+import base64
+import binascii
+import hmac
+import ipaddress
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from src.utils.profiler import incr, span
+
+'''
+Long running sync: the Gmail client, the database engine and the compiled
+rules stay loaded between cycles, and each cycle only syncs the history since
+the stored cursor and evaluates the emails it brought in.
+A cycle starts when a change notification arrives (Gmail push through a
+Pub/Sub push subscription to WebhookServer, or notify() directly) and at the
+latest every poll_interval seconds, so polling covers lost notifications and
+setups without push. Notifications arriving during a cycle are coalesced into
+one more cycle.
+'''
+
+POLL_INTERVAL = 30
+# Gmail drops a watch after 7 days, renew it daily
+WATCH_RENEW_INTERVAL = 24 * 60 * 60
+WEBHOOK_PATH = '/gmail/push'
+
+
+class Watcher:
+    '''
+    Runs MailboxSync and the rule engine until stop() is called.
+    health() reports the state for a probe: when the last cycle finished, how
+    long the oldest unprocessed notification has waited (lag) and the last
+    error. A failing cycle is retried on the next wakeup, the cursor is only
+    moved by cycles that succeed
+    '''
+
+    def __init__(self, sync, rule_engine=None, poll_interval=POLL_INTERVAL, limit=None, workers=None,
+                 topic=None, stale_after=None):
+        self.sync = sync
+        self.rule_engine = rule_engine
+        self.poll_interval = poll_interval
+        self.limit = limit
+        self.workers = workers
+        self.topic = topic
+        # healthy while a cycle succeeded and no notification waited longer than this
+        self.stale_after = stale_after or 3 * poll_interval
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+        self.started_at = None
+        self.watch_expiration = None
+        self.watch_renewed_at = None
+        self.history_id = None  # cursor after the last successful cycle
+        self.notified_history_id = None  # newest history id announced by a notification
+        self.pending_since = None  # arrival of the oldest notification not processed yet
+        self.last_sync_at = None
+        self.last_result = None
+        self.last_error = None
+        self.cycles = 0
+        self.errors = 0
+
+    def notify(self, history_id=None):
+        # A change notification, wakes the watcher. Notifications for history
+        # it already synced (Pub/Sub redelivers) are dropped
+        history_id = int(history_id) if history_id is not None else None
+        with self.lock:
+            if history_id is not None and self.history_id is not None and history_id <= int(self.history_id):
+                return False
+            if history_id is not None:
+                self.notified_history_id = max(history_id, self.notified_history_id or 0)
+            if self.pending_since is None:
+                self.pending_since = time.time()
+        incr('watch_notifications')
+        self.wakeup.set()
+        return True
+
+    def stop(self):
+        # Finish the current cycle and return from run()
+        self.stopping.set()
+        self.wakeup.set()
+
+    def run_once(self):
+        # One sync and rule pass, returns {'sync': ..., 'rules': ...}
+        with self.lock:
+            # notifications from here on may be about changes this cycle misses
+            notified_at = self.pending_since
+            self.pending_since = None
+        try:
+            with span('watch.cycle'):
+                result = {'sync': self.sync.run(limit=self.limit), 'rules': None}
+                changed = result['sync']['added'] or result['sync']['updated'] or result['sync']['mode'] == 'full'
+                if self.rule_engine is not None and (changed or self.cycles == 0):
+                    result['rules'] = self.rule_engine.process_emails(workers=self.workers)
+            history_id = self.sync.db.get_sync_cursor(self.sync.account)
+        except Exception:
+            with self.lock:
+                self.errors += 1
+                self._still_pending(notified_at)
+            raise
+
+        with self.lock:
+            self.cycles += 1
+            self.history_id = history_id
+            self.last_sync_at = time.time()
+            self.last_result = result
+            self.last_error = None
+            if self.notified_history_id is not None and int(history_id) < self.notified_history_id:
+                # announced history the cycle did not reach yet
+                self._still_pending(notified_at)
+        return result
+
+    def _still_pending(self, notified_at):
+        if notified_at is not None and (self.pending_since is None or notified_at < self.pending_since):
+            self.pending_since = notified_at
+
+    def renew_watch(self):
+        # (Re)register the Gmail push watch on the topic when it is due
+        if not self.topic:
+            return None
+        if self.watch_renewed_at and time.time() - self.watch_renewed_at < WATCH_RENEW_INTERVAL:
+            return None
+        response = self.sync.gmail.watch(self.topic)
+        self.watch_renewed_at = time.time()
+        self.watch_expiration = int(response.get('expiration', 0)) / 1000 or None
+        return response
+
+    def run(self):
+        # Cycle until stop(): on every notification and every poll_interval
+        self.stopping.clear()
+        self.running = True
+        self.started_at = time.time()
+        try:
+            while not self.stopping.is_set():
+                self.wakeup.clear()
+                try:
+                    self.renew_watch()
+                    result = self.run_once()
+                    sync = result['sync']
+                    if sync['added'] or sync['deleted'] or sync['updated']:
+                        print(f"{sync['mode'].capitalize()} sync: {sync['added']} added, "
+                              f"{sync['deleted']} deleted, {sync['updated']} updated")
+                except Exception as e:
+                    print(f"Watch cycle failed: {e}")
+                    with self.lock:
+                        self.last_error = str(e)
+                self.wakeup.wait(self.poll_interval)
+        finally:
+            if self.watch_renewed_at:
+                try:
+                    self.sync.gmail.stop_watch()
+                except Exception as e:
+                    print(f"Error stopping the Gmail watch: {e}")
+                self.watch_renewed_at = None
+            self.running = False
+
+    def start(self):
+        # run() on a background thread
+        self.thread = threading.Thread(target=self.run, name='watcher', daemon=True)
+        self.thread.start()
+        return self
+
+    def join(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+            return not self.thread.is_alive()
+        return True
+
+    def health(self, details=True):
+        # Without details the last error and result are left out, for probes
+        # that anyone who reaches the endpoint can read
+        now = time.time()
+        with self.lock:
+            lag = now - self.pending_since if self.pending_since is not None else 0.0
+            since_sync = now - self.last_sync_at if self.last_sync_at is not None else None
+            if not self.running:
+                status = 'stopped'
+            elif self.last_error is not None:
+                status = 'failing'
+            elif self.last_sync_at is None:
+                status = 'starting'
+            elif lag > self.stale_after or since_sync > self.stale_after + self.poll_interval:
+                status = 'lagging'
+            else:
+                status = 'ok'
+            health = {
+                'status': status,
+                'healthy': status == 'ok',
+                'lag': round(lag, 3),
+                'seconds_since_sync': round(since_sync, 3) if since_sync is not None else None,
+                'history_id': self.history_id,
+                'notified_history_id': self.notified_history_id,
+                'cycles': self.cycles,
+                'errors': self.errors,
+                'last_error': self.last_error,
+                'last_result': self.last_result,
+                'watch_expiration': self.watch_expiration,
+            }
+        if not details:
+            del health['last_error'], health['last_result']
+        return health
+
+
+def parse_push(body):
+    # historyId of a Pub/Sub push message, None for a message without one.
+    # {"message": {"data": base64 of {"emailAddress": ..., "historyId": ...}}}
+    message = json.loads(body)['message']
+    data = message.get('data')
+    if not data:
+        return None
+    payload = json.loads(base64.b64decode(data + '=' * (-len(data) % 4), altchars=b'-_'))
+    return payload.get('historyId')
+
+
+def is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class WebhookServer:
+    '''
+    HTTP endpoint for a Pub/Sub push subscription of the Gmail watch topic.
+    POST <path> wakes the watcher and answers 204 at once (the cycle runs on
+    the watcher thread, Pub/Sub retries unacknowledged pushes), GET /health
+    answers the watcher health, without error details, as JSON, 200 when
+    healthy and 503 otherwise.
+    With token set pushes have to carry ?token=<token> in their url (set it
+    on the push subscription's endpoint). A token is required to listen on
+    anything but a loopback address
+    '''
+
+    def __init__(self, watcher, host='127.0.0.1', port=8080, path=WEBHOOK_PATH, token=None):
+        if not token and not is_loopback(host):
+            raise ValueError(f'A webhook token is required to listen on {host}')
+        self.watcher = watcher
+        self.host = host
+        self.port = port
+        self.path = path
+        self.token = token
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status, payload=None):
+                data = json.dumps(payload).encode('utf-8') if payload is not None else b''
+                self.send_response(status)
+                if payload is not None:
+                    self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                if url.path != webhook.path:
+                    return self._reply(404, {'error': 'not found'})
+                if webhook.token and not hmac.compare_digest(
+                        parse_qs(url.query).get('token', [''])[0].encode('utf-8'), webhook.token.encode('utf-8')):
+                    return self._reply(403, {'error': 'bad token'})
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    history_id = parse_push(self.rfile.read(length))
+                except (ValueError, KeyError, TypeError, binascii.Error):
+                    # acknowledged all the same, a malformed push would be redelivered forever
+                    print("Ignoring malformed push notification")
+                    return self._reply(204)
+                webhook.watcher.notify(history_id)
+                self._reply(204)
+
+            def do_GET(self):
+                if urlparse(self.path).path != '/health':
+                    return self._reply(404, {'error': 'not found'})
+                health = webhook.watcher.health(details=False)
+                self._reply(200 if health['healthy'] else 503, health)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name='webhook', daemon=True)
+        self.thread.start()
+        return self
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}{self.path}'
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -1,3 +1,4 @@
 from .stats import EmailStats
+from .profiler import Profiler, profiler
 
-__all__ = ['EmailStats']
\ No newline at end of file
+__all__ = ['EmailStats', 'Profiler', 'profiler']
\ No newline at end of file
@@ -0,0 +1,149 @@
+import json
+import threading
+import time
+
+'''
+Process wide timing spans and counters, off unless enabled (main.py --profile).
+    with span('db.commit'): ...           time a stage
+    incr('rows_written', len(rows))       add to a counter
+    incr('api_calls', method=method_id)   counters can carry labels
+While disabled span() hands back one shared no-op context manager and
+incr() returns at once, so instrumented code pays a function call and an
+attribute check. report() gives the totals as a dict, to_json() and
+to_prometheus() render them.
+'''
+
+PROMETHEUS_PREFIX = 'eclient_'
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Profiler:
+    '''
+    Spans are kept as count, total and max seconds per name, counters as a
+    value per (name, labels). Safe to use from several threads; spans of
+    concurrent threads add up, so a span total can exceed the wall time
+    '''
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.spans = {}  # name -> [count, total seconds, max seconds]
+            self.counters = {}  # (name, ((label, value), ...)) -> value
+            self.started = time.perf_counter()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+        if enabled:
+            self.reset()
+
+    def span(self, name):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def record(self, name, seconds):
+        with self.lock:
+            stats = self.spans.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    def incr(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def report(self):
+        with self.lock:
+            counters = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                if labels:
+                    counters.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+                else:
+                    counters[name] = value
+            return {
+                'elapsed': round(time.perf_counter() - self.started, 6),
+                'spans': {name: {'count': count, 'seconds': round(total, 6), 'max': round(longest, 6)}
+                          for name, (count, total, longest) in sorted(self.spans.items())},
+                'counters': counters,
+            }
+
+    def to_json(self):
+        return json.dumps(self.report(), indent=2)
+
+    def to_prometheus(self):
+        report = self.report()
+        lines = [f'# TYPE {PROMETHEUS_PREFIX}elapsed_seconds gauge',
+                 f'{PROMETHEUS_PREFIX}elapsed_seconds {report["elapsed"]}']
+        if report['spans']:
+            metric = f'{PROMETHEUS_PREFIX}span_seconds'
+            lines.append(f'# TYPE {metric} summary')
+            for name, stats in report['spans'].items():
+                lines.append(f'{metric}_sum{{span="{name}"}} {stats["seconds"]}')
+                lines.append(f'{metric}_count{{span="{name}"}} {stats["count"]}')
+            lines.append(f'# TYPE {PROMETHEUS_PREFIX}span_max_seconds gauge')
+            for name, stats in report['spans'].items():
+                lines.append(f'{PROMETHEUS_PREFIX}span_max_seconds{{span="{name}"}} {stats["max"]}')
+        for name, values in report['counters'].items():
+            metric = f'{PROMETHEUS_PREFIX}{name}_total'
+            lines.append(f'# TYPE {metric} counter')
+            if not isinstance(values, list):
+                values = [{'labels': {}, 'value': values}]
+            for entry in values:
+                labels = ','.join(f'{label}="{_escape(value)}"' for label, value in entry['labels'].items())
+                lines.append(f'{metric}{{{labels}}} {entry["value"]}' if labels else f'{metric} {entry["value"]}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, format='json', path=None):
+        # Write the report to path, or print it
+        text = self.to_prometheus() if format == 'prometheus' else self.to_json()
+        if path:
+            with open(path, 'w') as f:
+                f.write(text)
+        else:
+            print(text)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+profiler = Profiler()
+
+
+def span(name):
+    return profiler.span(name)
+
+
+def incr(name, value=1, **labels):
+    profiler.incr(name, value, **labels)
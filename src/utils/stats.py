@@ -1,9 +1,9 @@
-from src.database import EmailDatabase
-
 class EmailStats:
-    def __init__(self):
+    # Counters over a list of fetched emails. The database is the caller's,
+    # EmailStats does not open one of its own
+    def __init__(self, db=None):
         self.reset_stats()
-        self.db = EmailDatabase()
+        self.db = db
 
     def reset_stats(self):
         self.total_count = 0
@@ -39,6 +39,3 @@ class EmailStats:
             'read': self.read_count,
             'attachments': self.attachment_count
         }
-
-    def __del__(self):
-        self.db.close()
\ No newline at end of file
@@ -1,23 +1,84 @@
 import streamlit as st
 import json
 import os
+import threading
 from src.rules import RuleEngine
-from src.api.gmail_api import gmailApi
+from src.api.gmail_api import gmailApi, new_service
 from src.database import EmailDatabase
+from src.sync import MailboxSync
 import plotly.express as px
 from sqlalchemy import func
 from datetime import datetime
 from email.utils import parsedate_to_datetime
 from src.utils.stats import EmailStats
 
+RULES_FILE = 'config/rules.json'
+
 def load_rules():
-    with open('config/rules.json', 'r') as f:
+    with open(RULES_FILE, 'r') as f:
         return json.load(f)
 
 def save_rules(rules):
-    with open('config/rules.json', 'w') as f:
+    with open(RULES_FILE, 'w') as f:
         json.dump(rules, f, indent=4)
 
+# Long lived objects are built once per server process and reused by every
+# rerun and session. The database is safe to share, it hands every script
+# thread its own session. googleapiclient services are not, so the Gmail
+# client and the rule engine using it are only called under gmail_lock.
+# Fetched emails and stats are memoized by (count, sync cursor): a sync moves
+# the cursor, and invalidate() drops them when an action changes the mailbox
+
+@st.cache_resource
+def get_clients():
+    # Gmail client, database and the lock serializing Gmail calls
+    return gmailApi(service=new_service()), EmailDatabase(), threading.Lock()
+
+@st.cache_resource(max_entries=1)
+def get_rule_engine(rules_mtime):
+    # Compiled once per version of rules.json, keyed by its modification time
+    gmail, db, _ = get_clients()
+    return RuleEngine(RULES_FILE, gmail=gmail, db=db)
+
+def rule_engine_for_rules():
+    return get_rule_engine(os.path.getmtime(RULES_FILE))
+
+def sync_cursor():
+    _, db, _ = get_clients()
+    # a sync from the CLI moves the cursor behind this session's back
+    db.session.expire_all()
+    return db.get_sync_cursor()
+
+@st.cache_data(show_spinner=False)
+def fetch_emails(count, cursor):
+    gmail, _, gmail_lock = get_clients()
+    with gmail_lock:
+        return gmail.fetch_emails(count=count)
+
+@st.cache_data(show_spinner=False)
+def folder_stats(count, cursor):
+    _, db, _ = get_clients()
+    return [(folder, total) for folder, total in db.get_folder_stats(count=count)]
+
+@st.cache_data(show_spinner=False)
+def mailbox_stats(cursor):
+    # whole mailbox totals and emails per day, read from the stats counters
+    _, db, _ = get_clients()
+    return db.get_read_stats(), [(day, total) for day, total in db.get_receive_stats('day')]
+
+def invalidate():
+    fetch_emails.clear()
+    folder_stats.clear()
+    mailbox_stats.clear()
+
+def sync_mailbox():
+    # Bring the database up to date with Gmail, this moves the sync cursor
+    gmail, db, gmail_lock = get_clients()
+    with gmail_lock:
+        result = MailboxSync(gmail, db, with_body=rule_engine_for_rules().needs_body).run()
+    invalidate()
+    return result
+
 def main():
     # Initialize session states at the start of the app
     if 'email_stats' not in st.session_state:
@@ -131,14 +192,22 @@ def main():
             
             with col1:
                 email_count = st.number_input("Number of emails to fetch", min_value=1, max_value=100, value=10)
+            if st.button("Sync Mailbox"):
+                try:
+                    with st.spinner('Syncing mailbox...'):
+                        result = sync_mailbox()
+                    st.success(f"{result['mode'].capitalize()} sync: {result['added']} added, "
+                               f"{result['deleted']} deleted, {result['updated']} updated")
+                except Exception as e:
+                    get_clients()[1].session.rollback()
+                    st.error(f"Error: {e}")
             if st.button("Execute Action"):
-                gmail = gmailApi()
-                db = EmailDatabase()
-                rule_engine = RuleEngine()
+                gmail, db, gmail_lock = get_clients()
                 
                 try:
+                    cursor = sync_cursor()
                     with st.spinner('Fetching emails...'):
-                        emails = gmail.fetch_emails(count=email_count)
+                        emails = fetch_emails(email_count, cursor)
                     if emails:
                         # Update statistics
                         st.session_state.email_stats.update_from_emails(emails)
@@ -157,23 +226,27 @@ def main():
                                     if email.get('has_attachment'):
                                         st.write(f"**Attachments:** {', '.join(email['attachment_types'])}")
                         elif action == "Mark All as Read":
-                            with st.spinner('Marking emails as read...'):
+                            with st.spinner('Marking emails as read...'), gmail_lock:
                                 for email in emails:
                                     gmail.mark_as_read(email['id'])
+                            invalidate()
                             st.session_state.email_stats.mark_all_read(len(emails))
                             st.success(f"Marked {len(emails)} emails as read")
                         elif action == "Mark All as Unread":
-                            with st.spinner('Marking emails as unread...'):
+                            with st.spinner('Marking emails as unread...'), gmail_lock:
                                 for email in emails:
                                     gmail.mark_as_unread(email['id'])
+                            invalidate()
                             st.session_state.email_stats.mark_all_unread(len(emails))
                             st.success(f"Marked {len(emails)} emails as unread")
                          
                         elif action == "Apply Rules":
                             with st.spinner('Applying rules...'):
-                                for email in emails:
-                                    db.store_email(email)
-                                rule_engine.process_emails(count =email_count)
+                                db.store_emails(emails)
+                                rule_engine = rule_engine_for_rules()
+                                with gmail_lock:
+                                    rule_engine.process_emails(count =email_count)
+                            invalidate()
                             st.success("Rules applied successfully")
                             
                         # Show analytics
@@ -185,15 +258,28 @@ def main():
                         col2.metric("Read Emails", stats['read'])
                         col3.metric("With Attachments", stats['attachments'])
                         
+                        totals, per_day = mailbox_stats(cursor)
+                        st.write("### Stored Mailbox")
+                        col1, col2, col3, col4 = st.columns(4)
+                        col1.metric("Stored Emails", totals['total'])
+                        col2.metric("Read", totals['read'])
+                        col3.metric("Unread", totals['unread'])
+                        col4.metric("With Attachments", totals['attachments'])
+                        if per_day:
+                            days, counts = zip(*per_day)
+                            st.plotly_chart(px.bar(data_frame={"Day": days, "Count": counts}, x="Day", y="Count",
+                                                   title='Emails Received per Day (UTC)'),
+                                            use_container_width=True)
+
                         # Folder Distribution
-                        folder_stats = db.get_folder_stats(count=email_count)
-                        if folder_stats:
+                        stats_by_folder = folder_stats(email_count, cursor)
+                        if stats_by_folder:
                         # Filter out system labels
                             system_labels = {'CATEGORY_UPDATES','INBOX', 'CATEGORY_FORUMS', 
                                         'IMPORTANT', 'CATEGORY_PROMOTIONS', 'CATEGORY_PERSONAL',
                                         'CATEGORY_SOCIAL', 'SENT', 'DRAFT', 'SPAM', 'TRASH','READ','UNREAD'}
                             
-                            filtered_stats = [(folder, count) for folder, count in folder_stats 
+                            filtered_stats = [(folder, count) for folder, count in stats_by_folder 
                                             if folder not in system_labels]
                             
                             if filtered_stats:  # Only create chart if there are user labels
@@ -236,10 +322,7 @@ def main():
                         st.warning("No emails found")
                 
                 except Exception as e:
+                    db.session.rollback()
                     st.error(f"Error: {e}")
-                
-                finally:
-                    db.close()
-                    rule_engine.close()
 if __name__ == "__main__":
     main()
\ No newline at end of file
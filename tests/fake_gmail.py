@@ -0,0 +1,294 @@
+import base64
+import json
+import socket
+import threading
+import time
+from email.parser import Parser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import httplib2
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+
+'''
+Local stand-in for the parts of the Gmail REST API used by gmailApi.
+It serves plain requests and multipart batch requests over real HTTP,
+so the googleapiclient code paths are exercised end to end.
+'''
+
+
+def encode_body(text):
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+
+def make_message(msg_id, sender='sender@test.com', subject='Test Subject',
+                 body='Test email body', date='Mon, 01 Jan 2024 10:00:00 +0000',
+                 labels=None, attachments=None, mime_type='text/plain'):
+    headers = [
+        {'name': 'From', 'value': sender},
+        {'name': 'To', 'value': 'me@test.com'},
+        {'name': 'Subject', 'value': subject},
+        {'name': 'Date', 'value': date},
+    ]
+    parts = [{'partId': '0', 'mimeType': mime_type, 'filename': '',
+              'body': {'data': encode_body(body)}}]
+    for i, attachment_type in enumerate(attachments or []):
+        parts.append({'partId': str(i + 1), 'mimeType': attachment_type,
+                      'filename': f'file{i}', 'body': {'attachmentId': f'att{i}'}})
+    return {
+        'id': msg_id,
+        'threadId': msg_id,
+        'labelIds': list(labels if labels is not None else ['INBOX', 'UNREAD']),
+        'snippet': body[:50],
+        'payload': {'mimeType': 'multipart/mixed', 'headers': headers, 'parts': parts},
+    }
+
+
+class FakeGmail:
+    def __init__(self, messages=(), latency=0.0):
+        self.messages = {}  # newest first, like Gmail listings
+        self.labels = [{'id': 'INBOX', 'name': 'INBOX', 'type': 'system'},
+                       {'id': 'UNREAD', 'name': 'UNREAD', 'type': 'system'}]
+        self.history = []
+        self.history_id = 1000
+        self.latency = latency
+        self.fail_ids = {}  # message id -> HTTP status returned by messages.get
+        self.flaky_ids = {}  # message id -> number of 503 answers before messages.get succeeds
+        self.calls = {}  # "METHOD path-kind" -> count
+        self.watching = None  # body of the last users.watch call
+        self.batch_failures = 0  # number of 503 answers to whole batch requests
+        self.dropped_requests = 0  # number of requests whose connection is closed without an answer
+        self.list_failures = {}  # messages.list page token -> HTTP status returned once
+        self.in_flight = 0
+        self.max_in_flight = 0  # most requests handled at the same time
+        self.lock = threading.Lock()
+        for message in messages:
+            self.messages[message['id']] = message
+
+    # ---- server lifecycle ----
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status, payload, content_type='application/json'):
+                data = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                with fake.lock:
+                    drop = fake.dropped_requests > 0
+                    fake.dropped_requests -= drop
+                    batch_failure = self.path.startswith('/batch') and fake.batch_failures > 0
+                    fake.batch_failures -= batch_failure
+                if drop:
+                    # the connection is reset, as by a flaky network
+                    self.close_connection = True
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    return
+                if batch_failure:
+                    self._reply(503, {'error': {'code': 503, 'message': 'Backend Error'}})
+                elif self.path.startswith('/batch'):
+                    content_type, payload = fake.handle_batch(self.headers['Content-Type'], body)
+                    self._reply(200, payload, content_type)
+                else:
+                    status, payload = fake.handle(self.command, self.path, body)
+                    self._reply(status, payload)
+
+            do_GET = do_POST = do_DELETE = _handle
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/'
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def service(self):
+        # Build a real discovery-based client pointed at this server
+        doc = json.loads(get_static_doc('gmail', 'v1'))
+        doc['rootUrl'] = self.url
+        doc['baseUrl'] = self.url + doc['servicePath']
+        return build_from_document(doc, http=httplib2.Http())
+
+    def call_count(self, kind):
+        return self.calls.get(kind, 0)
+
+    # ---- mailbox mutations ----
+    def add_history(self, **record):
+        self.history_id += 1
+        record['id'] = str(self.history_id)
+        self.history.append(record)
+
+    def add_message(self, message):
+        self.messages = {message['id']: message, **self.messages}
+        self.add_history(messagesAdded=[{'message': {'id': message['id'],
+                                                     'labelIds': message['labelIds']}}])
+
+    def delete_message(self, msg_id):
+        self.messages.pop(msg_id)
+        self.add_history(messagesDeleted=[{'message': {'id': msg_id}}])
+
+    def _modify(self, msg_id, add=(), remove=()):
+        message = self.messages[msg_id]
+        labels = [label for label in message['labelIds'] if label not in remove]
+        labels += [label for label in add if label not in labels]
+        message['labelIds'] = labels
+        if add:
+            self.add_history(labelsAdded=[{'message': {'id': msg_id, 'labelIds': labels},
+                                           'labelIds': list(add)}])
+        if remove:
+            self.add_history(labelsRemoved=[{'message': {'id': msg_id, 'labelIds': labels},
+                                             'labelIds': list(remove)}])
+
+    # ---- request dispatch ----
+    def _count(self, kind):
+        with self.lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+
+    def handle(self, method, path, body=b''):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            return self._handle(method, path, body)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def _handle(self, method, path, body):
+        url = urlparse(path)
+        query = parse_qs(url.query)
+        data = json.loads(body) if body else {}
+        parts = url.path.strip('/').split('/')
+        # gmail/v1/users/me/<resource>...
+        resource = parts[4:]
+        kind = f'{method} {resource[0]}' if resource else method
+        if resource[:1] == ['messages'] and len(resource) > 1 and resource[1] not in ('batchModify',):
+            kind = f'{method} messages/{resource[2]}' if len(resource) > 2 else f'{method} messages/id'
+        elif resource[:1] == ['messages'] and len(resource) > 1:
+            kind = f'{method} messages/batchModify'
+        self._count(kind)
+
+        with self.lock:
+            return self._dispatch(method, resource, query, data)
+
+    def _dispatch(self, method, resource, query, data):
+        if resource == ['profile']:
+            return 200, {'emailAddress': 'me@test.com', 'historyId': str(self.history_id)}
+
+        if resource == ['messages'] and method == 'GET':
+            status = self.list_failures.pop(query.get('pageToken', [None])[0], None)
+            if status:
+                return status, {'error': {'code': status, 'message': 'injected failure'}}
+            ids = list(self.messages)
+            label_ids = query.get('labelIds', [])
+            if label_ids:
+                ids = [i for i in ids if all(l in self.messages[i]['labelIds'] for l in label_ids)]
+            start = int(query.get('pageToken', ['0'])[0])
+            size = int(query.get('maxResults', ['100'])[0])
+            page = ids[start:start + size]
+            result = {'messages': [{'id': i, 'threadId': i} for i in page],
+                      'resultSizeEstimate': len(ids)}
+            if start + size < len(ids):
+                result['nextPageToken'] = str(start + size)
+            return 200, result
+
+        if resource == ['messages', 'batchModify']:
+            for msg_id in data.get('ids', []):
+                if msg_id in self.messages:
+                    self._modify(msg_id, data.get('addLabelIds', []), data.get('removeLabelIds', []))
+            return 204, b''
+
+        if resource[:1] == ['messages'] and len(resource) == 2:
+            msg_id = resource[1]
+            if msg_id in self.fail_ids:
+                status = self.fail_ids[msg_id]
+                return status, {'error': {'code': status, 'message': 'injected failure'}}
+            if self.flaky_ids.get(msg_id):
+                self.flaky_ids[msg_id] -= 1
+                return 503, {'error': {'code': 503, 'message': 'Backend Error'}}
+            if msg_id not in self.messages:
+                return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+            message = json.loads(json.dumps(self.messages[msg_id]))
+            fmt = query.get('format', ['full'])[0]
+            self.calls[f'format {fmt}'] = self.calls.get(f'format {fmt}', 0) + 1
+            if fmt == 'metadata':
+                wanted = set(query.get('metadataHeaders', []))
+                headers = [h for h in message['payload']['headers'] if not wanted or h['name'] in wanted]
+                message['payload'] = {'mimeType': message['payload']['mimeType'], 'headers': headers}
+            return 200, message
+
+        if resource[:1] == ['messages'] and len(resource) == 3 and resource[2] == 'modify':
+            msg_id = resource[1]
+            if msg_id not in self.messages:
+                return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+            known = {label['id'] for label in self.labels}
+            if any(label not in known for label in data.get('addLabelIds', [])):
+                return 400, {'error': {'code': 400, 'message': 'Invalid label'}}
+            self._modify(msg_id, data.get('addLabelIds', []), data.get('removeLabelIds', []))
+            return 200, {'id': msg_id, 'labelIds': self.messages[msg_id]['labelIds']}
+
+        if resource == ['labels'] and method == 'GET':
+            return 200, {'labels': self.labels}
+
+        if resource == ['labels'] and method == 'POST':
+            label = {'id': f'Label_{len(self.labels)}', 'name': data['name'], 'type': 'user'}
+            self.labels.append(label)
+            return 200, label
+
+        if resource == ['watch'] and method == 'POST':
+            self.watching = data
+            return 200, {'historyId': str(self.history_id), 'expiration': str(int(time.time() * 1000) + 7 * 86400000)}
+
+        if resource == ['stop'] and method == 'POST':
+            self.watching = None
+            return 204, b''
+
+        if resource == ['history']:
+            start = int(query['startHistoryId'][0])
+            if start < 1000:
+                return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+            records = [r for r in self.history if int(r['id']) > start]
+            return 200, {'history': records, 'historyId': str(self.history_id)}
+
+        return 404, {'error': {'code': 404, 'message': 'Not found'}}
+
+    def handle_batch(self, content_type, body):
+        self._count('POST batch')
+        message = Parser().parsestr(f'Content-Type: {content_type}\r\n\r\n' + body.decode('utf-8'))
+        boundary = 'batch_fake_boundary'
+        out = []
+        for part in message.get_payload():
+            request_text = part.get_payload()
+            head, _, request_body = request_text.partition('\r\n\r\n') if '\r\n\r\n' in request_text \
+                else request_text.partition('\n\n')
+            method, path, _ = head.splitlines()[0].split(' ', 2)
+            status, payload = self.handle(method, path, request_body.encode('utf-8'))
+            data = payload.decode('utf-8') if isinstance(payload, bytes) else json.dumps(payload)
+            content_id = part['Content-ID']
+            out.append(
+                f'--{boundary}\r\n'
+                'Content-Type: application/http\r\n'
+                f'Content-ID: <response-{content_id[1:]}\r\n\r\n'
+                f'HTTP/1.1 {status} OK\r\n'
+                'Content-Type: application/json\r\n\r\n'
+                f'{data}\r\n'
+            )
+        out.append(f'--{boundary}--\r\n')
+        return f'multipart/mixed; boundary={boundary}', ''.join(out).encode('utf-8')
@@ -0,0 +1,93 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+from googleapiclient.errors import HttpError
+from src.api.async_gmail_api import AsyncGmailApi
+from src.api.gmail_api import gmailApi
+from src.api.quota import QuotaLimiter
+from fake_gmail import FakeGmail, make_message
+
+class TestAsyncGmailApi(unittest.TestCase):
+    def setUp(self):
+        messages = [make_message(f'm{i}', subject=f'Subject {i}') for i in range(40)]
+        self.fake = FakeGmail(messages, latency=0.05).start()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_file = os.path.join(self.tmp.name, 'labels.json')
+
+    def tearDown(self):
+        self.fake.stop()
+        self.tmp.cleanup()
+
+    def run_async(self, concurrency, func):
+        async def main():
+            async with AsyncGmailApi(concurrency, service_factory=self.fake.service, label_cache=self.cache_file,
+                                     limiter=QuotaLimiter(rate=None)) as gmail:
+                return await func(gmail)
+        return asyncio.run(main())
+
+    @patch('builtins.print')
+    def test_fetch_matches_sync_client(self, mock_print):
+        expected = gmailApi(service=self.fake.service(), label_cache=self.cache_file,
+                            limiter=QuotaLimiter(rate=None)).fetch_emails(count=40)
+        emails = self.run_async(8, lambda gmail: gmail.fetch_emails(count=40))
+        self.assertEqual(emails, expected)
+        batched = self.run_async(4, lambda gmail: gmail.fetch_emails(count=40, batch_size=10))
+        self.assertEqual(batched, expected)
+
+    def test_concurrency_is_bounded(self):
+        async def fetch(gmail):
+            return [email async for email in gmail.iter_emails(page_size=20)]
+
+        start = time.perf_counter()
+        self.run_async(1, fetch)
+        serial = time.perf_counter() - start
+        self.assertEqual(self.fake.max_in_flight, 1)
+
+        self.fake.max_in_flight = 0
+        start = time.perf_counter()
+        emails = self.run_async(8, fetch)
+        concurrent = time.perf_counter() - start
+        self.assertEqual(len(emails), 40)
+        self.assertEqual(self.fake.max_in_flight, 8)
+        self.assertLess(concurrent, serial / 3)
+
+    def test_errors_are_raised(self):
+        async def fetch(gmail, **kwargs):
+            return [email async for email in gmail.iter_emails(page_size=10, **kwargs)]
+
+        # the third page fails to list
+        self.fake.list_failures = {'20': 400}
+        with self.assertRaises(HttpError):
+            self.run_async(4, fetch)
+
+        self.fake.fail_ids = {'m15': 400}
+        with self.assertRaises(HttpError):
+            self.run_async(4, fetch)
+        with self.assertRaises(HttpError):
+            self.run_async(4, lambda gmail: fetch(gmail, batch_size=5))
+
+        # messages that no longer exist are skipped
+        self.fake.fail_ids = {'m15': 404}
+        emails = self.run_async(4, fetch)
+        self.assertEqual(len(emails), 39)
+        self.assertNotIn('m15', [email['id'] for email in emails])
+
+    def test_modify_and_labels(self):
+        async def work(gmail):
+            moved = await asyncio.gather(*[gmail.move_message(f'm{i}', 'Receipts') for i in range(10)])
+            read = await asyncio.gather(*[gmail.mark_as_read(f'm{i}') for i in range(10, 20)])
+            modified = await gmail.batch_modify([f'm{i}' for i in range(20, 40)], remove_label_ids=['UNREAD'])
+            return moved, read, modified
+
+        moved, read, modified = self.run_async(8, work)
+        self.assertTrue(all(moved) and all(read))
+        self.assertEqual(len(modified), 20)
+        # concurrent moves to a new folder create the label once
+        self.assertEqual(self.fake.call_count('POST labels'), 1)
+        self.assertTrue(all('UNREAD' not in self.fake.messages[f'm{i}']['labelIds'] for i in range(10, 40)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import io
+import unittest
+from contextlib import redirect_stdout
+from benchmarks.mailbox import SyntheticMailbox, generate_rules
+from benchmarks.suite import compare, run_suite
+from src.api.mime import extract_body
+from src.database.models import parse_email_date
+
+class TestSyntheticMailbox(unittest.TestCase):
+    def test_mailbox_is_deterministic_and_skewed(self):
+        mailbox = SyntheticMailbox(count=500, seed=1, senders=50, attachment_ratio=0.2)
+        emails = list(mailbox.emails())
+        self.assertEqual(emails, list(SyntheticMailbox(count=500, seed=1, senders=50, attachment_ratio=0.2).emails()))
+        self.assertEqual(len({email['id'] for email in emails}), 500)
+        self.assertTrue(all(parse_email_date(email['date']) for email in emails))
+        self.assertTrue(any(email['has_attachment'] for email in emails))
+        # the most frequent sender sends far more than an even share
+        top = max(sum(email['from'] == sender for email in emails) for sender in {email['from'] for email in emails})
+        self.assertGreater(top, 500 / 50 * 3)
+
+    def test_messages_decode(self):
+        mailbox = SyntheticMailbox(count=20, seed=2, html_ratio=0.5)
+        for message in mailbox.messages():
+            text = extract_body(message['payload'], cache=None)
+            self.assertTrue(text)
+            self.assertNotIn('<td', text)
+
+class TestSuite(unittest.TestCase):
+    def test_suite_runs_and_flags_regressions(self):
+        mailbox = SyntheticMailbox(count=200)
+        with redirect_stdout(io.StringIO()):
+            results = run_suite(mailbox, rule_counts=(10, 600))
+            self.assertEqual(set(results), {'ingest', 'get_all_emails', 'stats', 'rules_10', 'rules_600',
+                                            'body_decoding'})
+            baseline = {name: {'value': result['value'] * 2, 'unit': result['unit']}
+                        for name, result in results.items()}
+            baseline['rules_10']['value'] = results['rules_10']['value']
+            regressions = compare(results, baseline, threshold=0.25)
+        self.assertEqual(set(regressions), set(results) - {'rules_10'})
+        self.assertEqual(len(generate_rules(600, mailbox=mailbox)), 600)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,21 @@
+import os
+import tempfile
+import threading
 import unittest
 from unittest.mock import patch, MagicMock
 from datetime import datetime
+from sqlalchemy import create_engine, event, inspect, text
 from src.database.models import EmailDatabase, Email, Attachment
+from src.database.migrations import migrate
+from src.database.counters import rebuild_counters
+from src.database.compression import register_functions
+from src.database.engine import configure_database, dispose_engines, get_engine, get_session_factory
 
 class TestEmailDatabase(unittest.TestCase):
     def setUp(self):
+        # every test gets its own database file
+        self.tmp = tempfile.TemporaryDirectory()
+        configure_database(os.path.join(self.tmp.name, 'emails.db'))
         self.db = EmailDatabase()
         self.test_email_data = {
             'id': 'test123',
@@ -21,10 +32,39 @@ class TestEmailDatabase(unittest.TestCase):
         }
 
     def tearDown(self):
-        self.db.session.query(Email).delete()
-        self.db.session.query(Attachment).delete()
-        self.db.session.commit()
         self.db.close()
+        dispose_engines()
+        configure_database(None)
+        self.tmp.cleanup()
+
+    def test_shared_engine(self):
+        other = EmailDatabase()
+        self.assertIs(other.engine, self.db.engine)
+        self.assertIs(other.session, self.db.session)
+        with self.db.engine.connect() as conn:
+            self.assertEqual(conn.exec_driver_sql('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(conn.exec_driver_sql('PRAGMA synchronous').scalar(), 1)  # NORMAL
+            self.assertEqual(conn.exec_driver_sql('PRAGMA busy_timeout').scalar(), 5000)
+
+        # a separate path gets a separate engine
+        path = os.path.join(self.tmp.name, 'other.db')
+        self.assertIsNot(get_engine(path), self.db.engine)
+        self.assertIs(get_session_factory(path), get_session_factory(path))
+
+    def test_session_follows_the_calling_thread(self):
+        self.db.store_email(self.test_email_data)
+        sessions = []
+
+        def work():
+            sessions.append(self.db.session)
+            sessions.append(self.db.get_email_ids())
+            self.db.close()
+
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+        self.assertIsNot(sessions[0], self.db.session)
+        self.assertEqual(sessions[1], {'test123'})
 
     def test_store_email(self):
         # Test storing email with attachments
@@ -63,6 +103,54 @@ class TestEmailDatabase(unittest.TestCase):
         self.assertEqual(len(emails), 2)
         self.assertEqual(emails[0].id, 'test456')  # Should be newest first
 
+    def test_store_emails_in_chunks(self):
+        def generate():
+            for i in range(25):
+                email_data = self.test_email_data.copy()
+                email_data['id'] = f'bulk{i}'
+                yield email_data
+
+        counts = self.db.store_emails(generate(), batch_size=10)
+        self.assertEqual(counts, [10, 10, 5])
+        self.assertEqual(self.db.session.query(Email).count(), 25)
+
+    def test_store_email_again_replaces_attachments(self):
+        self.db.store_email(self.test_email_data)
+        updated = self.test_email_data.copy()
+        updated['subject'] = 'Updated Subject'
+        updated['attachment_types'] = ['text/csv']
+        self.db.store_emails([updated, self.test_email_data.copy()], batch_size=10)
+        self.db.store_email(updated)
+
+        stored_email = self.db.session.query(Email).filter_by(id='test123').one()
+        self.assertEqual(stored_email.subject, 'Updated Subject')
+        self.assertEqual([a.mime_type for a in stored_email.attachments], ['text/csv'])
+        self.assertEqual(self.db.session.query(Attachment).count(), 1)
+
+    def test_metadata_only_store_keeps_body(self):
+        self.db.store_email(self.test_email_data)
+        metadata = dict(self.test_email_data, subject='New subject', body=None,
+                        has_attachment=None, attachment_types=None)
+        self.db.store_email(metadata)
+        self.db.session.expunge_all()
+        email = self.db.get_all_emails()[0]
+        self.assertEqual(email.subject, 'New subject')
+        self.assertEqual(email.body, 'Test email body')
+        self.assertTrue(email.has_attachment)
+        self.assertEqual(len(email.attachments), 2)
+
+        # a new email stored from metadata has no body until it is fetched
+        self.db.store_email(dict(metadata, id='meta', folder_name='Receipts'))
+        self.assertEqual(self.db.get_ids_without_body(), {'meta'})
+        self.db.set_rules_version(['meta'], 'v1')
+        self.assertEqual(self.db.store_bodies([dict(self.test_email_data, id='meta', body='Fetched later')]), 1)
+        self.db.session.expunge_all()
+        email = self.db.session.get(Email, 'meta')
+        self.assertEqual((email.body, email.folder_name, email.rules_version), ('Fetched later', 'Receipts', 'v1'))
+        self.assertEqual(len(email.attachments), 2)
+        self.assertEqual([e.id for e in self.db.search('fetched later')], ['meta'])
+        self.assertEqual(self.db.get_ids_without_body(), set())
+
     def test_update_email_status(self):
         self.db.store_email(self.test_email_data)
         
@@ -80,6 +168,23 @@ class TestEmailDatabase(unittest.TestCase):
         updated_email = self.db.session.query(Email).filter_by(id='test123').first()
         self.assertEqual(updated_email.folder_name, 'ARCHIVE')
 
+    def test_update_emails_status(self):
+        email_data = self.test_email_data.copy()
+        email_data['id'] = 'test456'
+        self.db.store_email(self.test_email_data)
+        self.db.store_email(email_data)
+
+        result = self.db.update_emails_status({
+            'test123': {'is_read': True},
+            'test456': {'is_read': True, 'folder_name': 'ARCHIVE'},
+        })
+        self.assertTrue(result)
+
+        emails = {email.id: email for email in self.db.session.query(Email)}
+        self.assertTrue(emails['test123'].is_read)
+        self.assertEqual(emails['test123'].folder_name, 'INBOX')
+        self.assertEqual(emails['test456'].folder_name, 'ARCHIVE')
+
     def test_get_attachment_stats(self):
         self.db.store_email(self.test_email_data)
         
@@ -108,12 +213,129 @@ class TestEmailDatabase(unittest.TestCase):
         all_stats = self.db.get_folder_stats()
         self.assertEqual(len(all_stats), 2)
 
+    def test_counters_follow_every_write(self):
+        emails = []
+        for i in range(6):
+            email_data = self.test_email_data.copy()
+            email_data.update(id=f'c{i}', folder_name='ARCHIVE' if i % 2 else 'INBOX', is_read=i % 3 == 0,
+                              date=f'Mon, {i + 1:02d} Jan 2024 1{i}:00:00 +0000')
+            emails.append(email_data)
+        self.db.store_emails(emails)
+        # changed folders and dates, a body-less refetch keeps the attachments
+        self.db.store_emails([dict(emails[0], folder_name='ARCHIVE', date='Fri, 05 Jan 2024 12:00:00 +0000'),
+                              dict(emails[1], body=None, has_attachment=None, attachment_types=None)])
+        self.db.update_emails_status({'c2': {'is_read': True}, 'c3': {'folder_name': 'TCS'}})
+        self.db.delete_emails(['c4'])
+
+        conn = self.db.session.connection()
+        dimensions = ['total', 'folder', 'read', 'has_attachment', 'attachment', 'hour', 'day']
+        maintained = {dimension: self.db.get_counters(dimension) for dimension in dimensions}
+        rebuild_counters(conn)
+        self.assertEqual(maintained, {dimension: self.db.get_counters(dimension) for dimension in dimensions})
+
+        self.assertEqual(self.db.get_read_stats(), {'total': 5, 'read': 3, 'unread': 2, 'attachments': 5})
+        self.assertEqual(dict(self.db.get_folder_stats()), {'ARCHIVE': 3, 'INBOX': 1, 'TCS': 1})
+        self.assertEqual(dict(self.db.get_attachment_stats()), {'application/pdf': 5, 'image/jpeg': 5})
+        self.assertEqual(self.db.get_receive_stats('day')[0], ('2024-01-02', 1))
+        self.assertEqual(len(self.db.get_receive_stats('hour')), 5)
+
     def test_get_email_timing(self):
         self.db.store_email(self.test_email_data)
         
-        timing = self.db.get_email_timing()
-        self.assertEqual(len(timing), 1)
-        self.assertEqual(timing[0][0], self.test_email_data['date'])
+        later = dict(self.test_email_data, id='later', date='Mon, 01 Jan 2024 10:45:00 +0000')
+        self.db.store_email(later)
+
+        # emails per hour, read from the counters
+        self.assertEqual(self.db.get_email_timing(), [(datetime(2024, 1, 1, 10, 0), 2)])
+
+    def test_received_at_ordering(self):
+        # lexicographic order of the raw headers would put Thu before Mon
+        older = self.test_email_data.copy()
+        older['id'] = 'older'
+        older['date'] = 'Thu, 4 Jan 2024 10:00:00 +0000'
+        newer = self.test_email_data.copy()
+        newer['id'] = 'newer'
+        newer['date'] = 'Mon, 8 Jan 2024 09:00:00 +0530'
+        self.db.store_email(older)
+        self.db.store_email(newer)
+
+        emails = self.db.get_all_emails()
+        self.assertEqual([email.id for email in emails], ['newer', 'older'])
+        self.assertEqual(emails[0].received_at, datetime(2024, 1, 8, 3, 30))
+
+    def test_migrate_adds_received_at(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_engine(f"sqlite:///{os.path.join(tmp, 'old.db')}")
+            event.listen(engine, 'connect', register_functions)
+            with engine.begin() as conn:
+                conn.execute(text('CREATE TABLE emails (id VARCHAR PRIMARY KEY, subject VARCHAR, '
+                                  'sender VARCHAR, body VARCHAR, date VARCHAR)'))
+                conn.execute(text("INSERT INTO emails VALUES ('a', 'Old', 'x@y.com', 'hello', 'Tue, 2 Jan 2024 12:00:00 +0100'), "
+                                  "('b', 'Older', 'x@y.com', 'world', 'garbage')"))
+
+            with patch('builtins.print'):
+                migrate(engine)
+            columns = {column['name'] for column in inspect(engine).get_columns('emails')}
+            self.assertIn('received_at', columns)
+            indexes = {index['name'] for index in inspect(engine).get_indexes('emails')}
+            self.assertIn('ix_emails_received_at', indexes)
+            with engine.connect() as conn:
+                rows = dict(conn.execute(text('SELECT id, received_at FROM emails')).fetchall())
+            self.assertEqual(rows['a'], '2024-01-02 11:00:00.000000')
+            self.assertIsNone(rows['b'])
+            # existing rows are added to the full-text index
+            with engine.connect() as conn:
+                found = conn.execute(text("SELECT rowid FROM emails_fts WHERE emails_fts MATCH 'older'")).fetchall()
+                self.assertEqual(len(found), 1)
+                # bodies moved to compressed storage and still searchable
+                self.assertNotIn('body', {column['name'] for column in inspect(engine).get_columns('emails')})
+                bodies = dict(conn.execute(text('SELECT email_id, body_text(body) FROM email_bodies')).fetchall())
+                self.assertEqual(bodies, {'a': 'hello', 'b': 'world'})
+                found = conn.execute(text("SELECT rowid FROM emails_fts WHERE emails_fts MATCH 'world'")).fetchall()
+                self.assertEqual(len(found), 1)
+            engine.dispose()
+
+    def test_bodies_are_compressed_and_loaded_on_access(self):
+        email_data = self.test_email_data.copy()
+        email_data['body'] = 'Quarterly report attached. ' * 200
+        self.db.store_email(email_data)
+
+        stored = self.db.session.connection().execute(
+            text("SELECT length(body) FROM email_bodies WHERE email_id = 'test123'")).scalar()
+        self.assertLess(stored, len(email_data['body']) // 10)
+
+        self.db.session.expunge_all()
+        email = self.db.get_all_emails()[0]
+        self.assertNotIn('content', email.__dict__)  # not loaded with the email
+        self.assertEqual(email.body, email_data['body'])
+        loaded = list(self.db.get_emails(with_body=True))
+        self.assertIn('content', loaded[0].__dict__)
+        # the body is still visible to SQL through the hybrid expression
+        self.assertEqual(self.db.session.query(Email.id).filter(Email.body.contains('report')).all(), [('test123',)])
+
+        self.assertTrue(self.db.delete_emails(['test123']))
+        self.assertEqual(self.db.session.connection().execute(text('SELECT count(*) FROM email_bodies')).scalar(), 0)
+
+    def test_search(self):
+        email_data = self.test_email_data.copy()
+        email_data['id'] = 'test456'
+        email_data['subject'] = 'Quarterly invoice'
+        email_data['body'] = 'Please find the INVOICE attached'
+        self.db.store_email(self.test_email_data)
+        self.db.store_email(email_data)
+
+        results = self.db.search('invoice')
+        self.assertEqual([email.id for email in results], ['test456'])
+        self.assertEqual(self.db.search('invoice', fields=['from']), [])
+        self.assertEqual(len(self.db.search('sender@test')), 2)
+
+        # the index follows updates and deletes
+        email_data['subject'] = 'Receipt'
+        email_data['body'] = 'Thanks'
+        self.db.store_email(email_data)
+        self.assertEqual(self.db.search('invoice'), [])
+        self.db.delete_emails(['test123'])
+        self.assertEqual([email.id for email in self.db.search('test')], ['test456'])
 
     def test_error_handling(self):
         # Test with invalid email data
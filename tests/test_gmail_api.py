@@ -0,0 +1,128 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from googleapiclient.errors import HttpError
+from src.api.gmail_api import gmailApi
+from src.api.quota import QuotaLimiter
+from fake_gmail import FakeGmail, make_message
+
+class TestGmailApiBatchFetch(unittest.TestCase):
+    def setUp(self):
+        messages = [make_message(f'm{i}', subject=f'Subject {i}', attachments=['application/pdf'] if i == 3 else None)
+                    for i in range(120)]
+        self.fake = FakeGmail(messages).start()
+        self.tmp = tempfile.TemporaryDirectory()
+        # unthrottled, these tests are about the requests not their pace
+        self.gmail = gmailApi(service=self.fake.service(), label_cache=os.path.join(self.tmp.name, 'labels.json'),
+                              limiter=QuotaLimiter(rate=None))
+
+    def tearDown(self):
+        self.fake.stop()
+        self.tmp.cleanup()
+
+    def test_batch_fetch_matches_serial(self):
+        batched = self.gmail.fetch_emails(count=120)
+        serial = self.gmail.fetch_emails(count=120, batch_size=None)
+        self.assertEqual(len(batched), 120)
+        self.assertEqual(batched, serial)
+        self.assertEqual(batched[3]['attachment_types'], ['application/pdf'])
+        self.assertEqual(batched[0]['id'], 'm0')  # listing order is kept
+
+    def test_batch_size_is_capped(self):
+        self.gmail.fetch_emails(count=120, batch_size=500)
+        # 120 gets at no more than 100 per batch
+        self.assertEqual(self.fake.call_count('POST batch'), 2)
+        self.assertEqual(self.fake.call_count('GET messages/id'), 120)
+
+    @patch('src.api.gmail_api.time.sleep')
+    def test_failed_sub_requests(self, mock_sleep):
+        self.fake.fail_ids = {'m5': 404, 'm7': 503}
+        # retryable failures are retried, then raised instead of dropped
+        with self.assertRaises(HttpError):
+            self.gmail.fetch_emails(count=10)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+        # messages that no longer exist are skipped
+        self.fake.fail_ids = {'m5': 404}
+        ids = [email['id'] for email in self.gmail.fetch_emails(count=10)]
+        self.assertEqual(len(ids), 9)
+        self.assertNotIn('m5', ids)
+
+    @patch('src.api.quota.time.sleep')
+    def test_failed_batch_requests_are_retried(self, mock_sleep):
+        self.fake.batch_failures = 2
+        self.assertEqual(len(self.gmail.fetch_emails(count=10)), 10)
+        self.fake.dropped_requests = 3
+        self.assertEqual(len(self.gmail.fetch_emails(count=10)), 10)
+        self.assertGreaterEqual(mock_sleep.call_count, 3)
+
+    @patch('src.api.quota.time.sleep')
+    def test_listing_errors_are_raised(self, mock_sleep):
+        self.fake.list_failures = {'25': 400}
+        emails = self.gmail.iter_emails(page_size=25)
+        with self.assertRaises(HttpError):
+            list(emails)
+
+    def test_metadata_fetch(self):
+        full = self.gmail.fetch_emails(count=10)
+        emails = self.gmail.fetch_emails(count=10, with_body=False)
+        self.assertEqual(self.fake.call_count('format metadata'), 10)
+        self.assertEqual([email['subject'] for email in emails], [email['subject'] for email in full])
+        self.assertEqual(emails[0]['from'], 'sender@test.com')
+        # the body and attachments are unknown, not empty
+        self.assertIsNone(emails[3]['body'])
+        self.assertIsNone(emails[3]['has_attachment'])
+        self.assertTrue(full[3]['has_attachment'])
+
+    def test_iter_emails_follows_page_tokens(self):
+        emails = self.gmail.iter_emails(page_size=25)
+        first = next(emails)
+        self.assertEqual(first['id'], 'm0')
+        # only the first page has been listed so far
+        self.assertEqual(self.fake.call_count('GET messages'), 1)
+
+        rest = list(emails)
+        self.assertEqual(len(rest), 119)
+        self.assertEqual(self.fake.call_count('GET messages'), 5)
+
+    def test_iter_emails_limit(self):
+        emails = list(self.gmail.iter_emails(page_size=25, limit=60))
+        self.assertEqual([email['id'] for email in emails], [f'm{i}' for i in range(60)])
+        self.assertEqual(self.fake.call_count('GET messages'), 3)
+
+class TestGmailApiLabels(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeGmail([make_message('m1'), make_message('m2')]).start()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_file = os.path.join(self.tmp.name, 'labels.json')
+        self.gmail = gmailApi(service=self.fake.service(), label_cache=self.cache_file)
+
+    def tearDown(self):
+        self.fake.stop()
+        self.tmp.cleanup()
+
+    def test_move_resolves_label_once(self):
+        self.assertTrue(self.gmail.move_message('m1', 'Receipts'))
+        self.assertTrue(self.gmail.move_message('m2', 'receipts'))
+        self.assertEqual(self.fake.call_count('GET labels'), 1)
+        self.assertEqual(self.fake.call_count('POST labels'), 1)
+        self.assertEqual(self.fake.call_count('POST messages/modify'), 2)
+        self.assertNotIn('INBOX', self.fake.messages['m2']['labelIds'])
+
+    def test_label_cache_is_shared_through_disk(self):
+        self.gmail.move_message('m1', 'Receipts')
+        other = gmailApi(service=self.fake.service(), label_cache=self.cache_file)
+        self.assertTrue(other.move_message('m2', 'Receipts'))
+        # the second client never lists labels
+        self.assertEqual(self.fake.call_count('GET labels'), 1)
+
+    def test_deleted_label_is_invalidated(self):
+        self.gmail.move_message('m1', 'Receipts')
+        self.fake.labels = [label for label in self.fake.labels if label['name'] != 'Receipts']
+        self.assertTrue(self.gmail.move_message('m2', 'Receipts'))
+        self.assertEqual(self.fake.call_count('POST labels'), 2)
+        self.assertIn(self.gmail.labels.resolve('Receipts'), self.fake.messages['m2']['labelIds'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,5 @@
 import unittest
-from unittest.mock import patch
+from unittest.mock import patch, AsyncMock
 import sys
 from main import main
 
@@ -11,30 +11,54 @@ class TestMainArguments(unittest.TestCase):
         # Test default count
         with patch('sys.argv', ['main.py']):
             main()
-            mock_gmail.return_value.fetch_emails.assert_called_with(count=10)
+            mock_gmail.return_value.iter_emails.assert_called_with(query=None, limit=10, with_body=mock_rule_engine.return_value.needs_body)
 
         # Test custom count
         with patch('sys.argv', ['main.py', '-c', '5']):
             main()
-            mock_gmail.return_value.fetch_emails.assert_called_with(count=5)
+            mock_gmail.return_value.iter_emails.assert_called_with(query=None, limit=5, with_body=mock_rule_engine.return_value.needs_body)
 
         # Test long form argument
         with patch('sys.argv', ['main.py', '--count', '15']):
             main()
-            mock_gmail.return_value.fetch_emails.assert_called_with(count=15)
+            mock_gmail.return_value.iter_emails.assert_called_with(query=None, limit=15, with_body=mock_rule_engine.return_value.needs_body)
+
+    @patch('main.gmailApi')
+    @patch('main.EmailDatabase')
+    @patch('main.RuleEngine')
+    def test_all_and_query_arguments(self, mock_rule_engine, mock_db, mock_gmail):
+        with patch('sys.argv', ['main.py', '--refresh', '--all', '-q', 'from:me']):
+            main()
+            mock_gmail.return_value.iter_emails.assert_called_with(query='from:me', limit=None, with_body=mock_rule_engine.return_value.needs_body)
+            # the generator is handed to the database which stores it in chunks
+            emails = mock_gmail.return_value.iter_emails.return_value
+            mock_db.return_value.store_emails.assert_called_once_with(emails, batch_size=100)
 
     @patch('main.gmailApi')
     @patch('main.EmailDatabase')
     @patch('main.RuleEngine')
     def test_refresh_argument(self, mock_rule_engine, mock_db, mock_gmail):
-        mock_gmail.return_value.fetch_emails.return_value = [
+        mock_gmail.return_value.iter_emails.return_value = iter([
             {'subject': 'Test Email', 'id': '123'}
-        ]
+        ])
+        mock_db.return_value.store_emails.return_value = [1]
 
         with patch('sys.argv', ['main.py', '--refresh']):
             main()
-            mock_gmail.return_value.fetch_emails.assert_called_once()
-            mock_db.return_value.store_email.assert_called_once()
+            mock_gmail.return_value.iter_emails.assert_called_once()
+            mock_db.return_value.store_emails.assert_called_once()
+
+    @patch('main.gmailApi')
+    @patch('main.EmailDatabase')
+    @patch('main.RuleEngine')
+    @patch('main.sync_emails_async', new_callable=AsyncMock)
+    def test_concurrency_argument(self, mock_sync_async, mock_rule_engine, mock_db, mock_gmail):
+        mock_sync_async.return_value = 3
+        with patch('sys.argv', ['main.py', '--refresh', '--concurrency', '4']):
+            main()
+            mock_sync_async.assert_awaited_once_with(mock_db.return_value, None, 10, 4, mock_rule_engine.return_value.needs_body, None)
+            # the serial client is not used for fetching
+            mock_gmail.return_value.iter_emails.assert_not_called()
 
     @patch('main.gmailApi')
     @patch('main.EmailDatabase')
@@ -43,6 +67,42 @@ class TestMainArguments(unittest.TestCase):
         with patch('sys.argv', ['main.py', '--rules']):
             main()
             mock_rule_engine.return_value.process_emails.assert_called_once()
+            # one client and one database for the whole run
+            mock_gmail.assert_called_once()
+            mock_rule_engine.assert_called_once_with(gmail=mock_gmail.return_value, db=mock_db.return_value)
+
+    @patch('main.gmailApi')
+    @patch('main.EmailDatabase')
+    @patch('main.RuleEngine')
+    @patch('main.profiler')
+    def test_profile_argument(self, mock_profiler, mock_rule_engine, mock_db, mock_gmail):
+        with patch('sys.argv', ['main.py', '--rules', '--profile', 'prometheus', '--profile-file', 'out.prom']):
+            main()
+            mock_profiler.enable.assert_any_call(True)
+            mock_profiler.dump.assert_called_once_with('prometheus', 'out.prom')
+
+        mock_profiler.reset_mock()
+        with patch('sys.argv', ['main.py', '--rules']):
+            main()
+            mock_profiler.enable.assert_called_once_with(False)
+            mock_profiler.dump.assert_not_called()
+
+    @patch('main.gmailApi')
+    @patch('main.EmailDatabase')
+    @patch('main.RuleEngine')
+    @patch('main.format_report', return_value='')
+    @patch('main.SyncPipeline')
+    def test_pipeline_argument(self, mock_pipeline, mock_format, mock_rule_engine, mock_db, mock_gmail):
+        mock_pipeline.return_value.run.return_value = {'stored': 5, 'stages': {}}
+        with patch('sys.argv', ['main.py', '--pipeline', '--fetch-workers', '6', '--queue-size', '3']):
+            main()
+            mock_pipeline.assert_called_once_with(
+                mock_gmail.return_value, mock_db.return_value, rule_engine=mock_rule_engine.return_value,
+                fetch_workers=6, parse_workers=2, queue_size=3, with_body=mock_rule_engine.return_value.needs_body)
+            mock_pipeline.return_value.run.assert_called_once_with(query=None, limit=10)
+            # the serial fetch is not used, the rules still run for what the pipeline left
+            mock_gmail.return_value.iter_emails.assert_not_called()
+            mock_rule_engine.return_value.process_emails.assert_called_once()
 
     @patch('main.gmailApi')
     @patch('main.EmailDatabase')
@@ -86,27 +146,29 @@ class TestMainArguments(unittest.TestCase):
     @patch('main.EmailDatabase')
     @patch('main.RuleEngine')
     def test_multiple_arguments(self, mock_rule_engine, mock_db, mock_gmail):
-        mock_gmail.return_value.fetch_emails.return_value = [
+        mock_gmail.return_value.iter_emails.return_value = iter([
             {'subject': 'Test Email', 'id': '123'}
-        ]
+        ])
+        mock_db.return_value.store_emails.return_value = [1]
 
         with patch('sys.argv', ['main.py', '--refresh', '--rules', '-c', '5']):
             main()
-            mock_gmail.return_value.fetch_emails.assert_called_with(count=5)
-            mock_db.return_value.store_email.assert_called_once()
+            mock_gmail.return_value.iter_emails.assert_called_with(query=None, limit=5, with_body=mock_rule_engine.return_value.needs_body)
+            mock_db.return_value.store_emails.assert_called_once()
             mock_rule_engine.return_value.process_emails.assert_called_once()
 
     @patch('main.gmailApi')
     @patch('main.EmailDatabase')
     @patch('main.RuleEngine')
     def test_no_emails_found(self, mock_rule_engine, mock_db, mock_gmail):
-        mock_gmail.return_value.fetch_emails.return_value = []
+        mock_gmail.return_value.iter_emails.return_value = iter([])
+        mock_db.return_value.store_emails.return_value = []
 
         with patch('sys.argv', ['main.py', '--refresh']):
             with patch('builtins.print') as mock_print:
                 main()
                 mock_print.assert_any_call("No emails found")
-                mock_db.return_value.store_email.assert_not_called()
+                mock_rule_engine.return_value.process_emails.assert_not_called()
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,83 @@
+import base64
+import random
+import unittest
+from bs4 import BeautifulSoup
+from src.api.mime import BodyCache, extract_body, extract_bodies, html_to_text, POOL_MIN_SIZE
+
+def encode(text, charset='utf-8'):
+    return base64.urlsafe_b64encode(text.encode(charset)).decode('ascii')
+
+def part(mime_type, text=None, parts=None, filename='', charset=None):
+    result = {'mimeType': mime_type, 'filename': filename, 'body': {'data': encode(text, charset or 'utf-8')} if text else {}}
+    if charset:
+        result['headers'] = [{'name': 'Content-Type', 'value': f'{mime_type}; charset="{charset}"'}]
+    if parts:
+        result['parts'] = parts
+    return result
+
+class TestHtmlToText(unittest.TestCase):
+    WORDS = ['Hello', 'offer', 'letter', 'Straße', '  spaced  ', '&amp;', '&lt;b&gt;', '&nbsp;', '&#39;quoted&#39;', '\n']
+
+    def random_html(self, rng, depth=0):
+        out = []
+        for _ in range(rng.randint(1, 5)):
+            kind = rng.random()
+            if kind < 0.4 or depth > 3:
+                out.append(' '.join(rng.choice(self.WORDS) for _ in range(rng.randint(1, 4))))
+            elif kind < 0.75:
+                tag = rng.choice(['p', 'div', 'b', 'a', 'td', 'span'])
+                attrs = rng.choice(['', ' class="x"', ' title="a>b"', " data-x='1'", ' href="https://x.com/?a=1&amp;b=2"'])
+                out.append(f'<{tag}{attrs}>{self.random_html(rng, depth + 1)}</{tag}>')
+            elif kind < 0.85:
+                out.append(rng.choice(['<br>', '<br/>', '<img src="a.png" alt="x">', '<hr />']))
+            elif kind < 0.95:
+                out.append(rng.choice(['<!-- hidden <b>comment</b> -->', '<style>p { color: red; }</style>',
+                                       '<script type="text/javascript">var a = "<b>";</script>']))
+            else:
+                out.append('<![CDATA[ raw text ]]>')
+        return ''.join(out)
+
+    def test_matches_beautifulsoup(self):
+        rng = random.Random(17)
+        for _ in range(300):
+            markup = '<html><head><title>T</title></head><body>' + self.random_html(rng) + '</body></html>'
+            expected = BeautifulSoup(markup, 'html.parser').get_text(separator='\n', strip=True)
+            self.assertEqual(html_to_text(markup), expected, markup)
+
+class TestExtractBody(unittest.TestCase):
+    def test_walks_nested_parts_and_prefers_plain_text(self):
+        payload = part('multipart/mixed', parts=[
+            part('multipart/alternative', parts=[
+                part('text/html', '<div><p>Hello <b>there</b></p></div>'),
+                part('text/plain', 'Hello there'),
+            ]),
+            part('text/plain', 'attached notes', filename='notes.txt'),
+        ])
+        self.assertEqual(extract_body(payload, cache=None), 'Hello there')
+
+        html_only = part('multipart/mixed', parts=[part('multipart/related', parts=[part('text/html', '<p>Only <i>html</i></p>')])])
+        self.assertEqual(extract_body(html_only, cache=None), 'Only\nhtml')
+        self.assertEqual(extract_body(part('text/plain', 'Café', charset='iso-8859-1'), cache=None), 'Café')
+        self.assertEqual(extract_body(part('multipart/mixed', parts=[part('image/png', filename='a.png')]), cache=None), '')
+
+    def test_cache(self):
+        cache = BodyCache(maxsize=2)
+        payloads = [part('text/html', f'<p>message {i}</p>') for i in range(3)]
+        self.assertEqual(extract_body(payloads[0], cache), 'message 0')
+        self.assertEqual(extract_body(payloads[0], cache), 'message 0')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        extract_body(payloads[1], cache)
+        extract_body(payloads[2], cache)
+        self.assertEqual(len(cache.entries), 2)  # least recently used entry dropped
+
+    def test_pool_matches_serial(self):
+        filler = '<p>' + 'lorem ipsum &amp; dolor ' * (POOL_MIN_SIZE // 16) + '</p>'
+        payloads = [part('text/html', f'<div>{i}{filler}</div>') for i in range(6)] + [part('text/plain', 'plain')]
+        serial = extract_bodies(payloads, cache=None)
+        cache = BodyCache()
+        self.assertEqual(extract_bodies(payloads, workers=2, cache=cache), serial)
+        # the pool filled the cache so every large body was a hit
+        self.assertEqual(len(cache.entries), 7)
+
+if __name__ == '__main__':
+    unittest.main()
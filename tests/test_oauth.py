@@ -0,0 +1,74 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch, MagicMock
+from src.api import oauth
+from src.api.discovery import DiscoveryCache
+
+URL = 'https://gmail.googleapis.com/$discovery/rest?version=v1'
+DOCUMENT = json.dumps({'name': 'gmail', 'version': 'v1', 'revision': '20260101'})
+
+class TestDiscoveryCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = DiscoveryCache(cache_dir=os.path.join(self.tmp.name, 'discovery'), ttl=60)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_document_is_served_from_disk(self):
+        self.assertIsNone(self.cache.get(URL))
+        self.cache.set(URL, DOCUMENT)
+        self.assertEqual(self.cache.get(URL), DOCUMENT)
+        self.assertEqual(DiscoveryCache(self.cache.cache_dir).get(URL), DOCUMENT)
+
+    def test_stale_or_mismatched_documents_are_refetched(self):
+        self.cache.set(URL, DOCUMENT)
+        old = time.time() - 120
+        os.utime(self.cache._path(URL), (old, old))
+        self.assertIsNone(self.cache.get(URL))
+
+        other = 'https://gmail.googleapis.com/$discovery/rest?version=v2'
+        self.cache.set(other, DOCUMENT)
+        self.assertIsNone(self.cache.get(other))
+        self.cache.set(URL, 'not json')
+        self.assertIsNone(self.cache.get(URL))
+
+class TestSharedService(unittest.TestCase):
+    def setUp(self):
+        oauth.clear_services()
+        self.addCleanup(oauth.clear_services)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.tmp.name)
+        self.addCleanup(os.chdir, cwd)
+
+        self.creds = MagicMock(valid=False, expired=True, refresh_token='refresh')
+        self.creds.to_json.return_value = '{}'
+        self.creds.refresh.side_effect = lambda request: setattr(self.creds, 'valid', True)
+        os.makedirs(oauth.TOKEN_DIR)
+        with open(oauth.token_path('gmail', 'v1'), 'w') as f:
+            f.write('{}')
+
+    @patch('src.api.oauth.build')
+    @patch('src.api.oauth.Credentials')
+    def test_service_and_credentials_are_built_once(self, mock_credentials, mock_build):
+        mock_credentials.from_authorized_user_file.return_value = self.creds
+        mock_build.side_effect = lambda *args, **kwargs: MagicMock()
+
+        service = oauth.get_service('secret.json', 'gmail', 'v1', ['scope'])
+        self.assertIs(oauth.get_service('secret.json', 'gmail', 'v1', ['scope']), service)
+        # a per thread service is new but reuses the refreshed credentials
+        self.assertIsNot(oauth.create_service('secret.json', 'gmail', 'v1', ['scope']), service)
+
+        mock_credentials.from_authorized_user_file.assert_called_once()
+        self.creds.refresh.assert_called_once()
+        self.assertEqual(mock_build.call_count, 2)
+        self.assertIs(mock_build.call_args.kwargs['credentials'], self.creds)
+        self.assertIs(mock_build.call_args.kwargs['cache'], oauth.discovery_cache)
+
+if __name__ == '__main__':
+    unittest.main()
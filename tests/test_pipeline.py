@@ -0,0 +1,109 @@
+import os
+import tempfile
+import unittest
+from googleapiclient.errors import HttpError
+from src.api.gmail_api import gmailApi
+from src.api.quota import QuotaLimiter
+from src.database.models import EmailDatabase, Email
+from src.database.engine import configure_database, dispose_engines
+from src.rules import RuleEngine
+from src.sync import SyncPipeline
+from src.sync.pipeline import format_report
+from fake_gmail import FakeGmail, make_message
+
+RULES = [{'name': 'Read news', 'predicate_type': 'all',
+          'conditions': [{'field': 'subject', 'predicate': 'contains', 'value': 'news'}],
+          'actions': [{'type': 'mark_as_read'}]}]
+
+
+class TestSyncPipeline(unittest.TestCase):
+    def setUp(self):
+        messages = [make_message(f'm{i}', subject='Daily news' if i % 3 == 0 else f'Hello {i}',
+                                 body=f'<p>Body {i}</p>', mime_type='text/html') for i in range(250)]
+        self.fake = FakeGmail(messages, latency=0.002).start()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.label_cache = os.path.join(self.tmp.name, 'labels.json')
+        self.gmail = gmailApi(service=self.fake.service(), label_cache=self.label_cache, limiter=QuotaLimiter(rate=None))
+        configure_database(os.path.join(self.tmp.name, 'emails.db'))
+        self.db = EmailDatabase()
+        self.services = 0
+
+    def tearDown(self):
+        self.fake.stop()
+        self.db.close()
+        dispose_engines()
+        configure_database(None)
+        self.tmp.cleanup()
+
+    def service(self):
+        self.services += 1
+        return self.fake.service()
+
+    def pipeline(self, **kwargs):
+        return SyncPipeline(self.gmail, self.db, service_factory=self.service, label_cache=self.label_cache,
+                            batch_size=20, page_size=50, **kwargs)
+
+    def test_stores_the_mailbox_through_bounded_queues(self):
+        result = self.pipeline(fetch_workers=3, parse_workers=2, queue_size=2).run()
+        self.assertEqual(result['listed'], 250)
+        self.assertEqual(result['stored'], 250)
+        self.assertEqual(len(self.db.get_email_ids()), 250)
+        self.assertEqual(self.db.session.get(Email, 'm7').body, 'Body 7')
+        stages = result['stages']
+        self.assertEqual(list(stages), ['list', 'fetch', 'parse', 'store'])
+        self.assertTrue(all(stage['items'] == 250 and stage['errors'] == 0 for stage in stages.values()))
+        self.assertTrue(all(stages[name]['max_queue'] <= 2 for name in ('fetch', 'parse', 'store')))
+        # one service per fetch worker
+        self.assertEqual(self.services, 3)
+        self.assertIn('fetch', format_report(result))
+
+    def test_limit_and_headers_only(self):
+        result = self.pipeline(with_body=False).run(limit=60)
+        self.assertEqual(result['stored'], 60)
+        self.assertIsNone(self.db.session.get(Email, 'm0').body)
+        self.assertEqual(self.fake.call_count('format full'), 0)
+
+    def test_rules_are_applied_as_emails_are_stored(self):
+        engine = RuleEngine(gmail=self.gmail, db=self.db)
+        engine.set_rules(list(RULES))
+        result = self.pipeline(rule_engine=engine).run()
+        self.assertEqual(result['evaluated'], 250)
+        self.assertEqual(result['matched'], 84)
+        self.assertEqual(result['applied'], 84)
+        self.assertNotIn('UNREAD', self.fake.messages['m3']['labelIds'])
+        self.assertIn('UNREAD', self.fake.messages['m4']['labelIds'])
+        self.db.session.expire_all()
+        self.assertTrue(self.db.session.get(Email, 'm3').is_read)
+
+        # nothing is left for the rule engine, and the next sync does not act again
+        self.assertEqual(engine.process_emails()['evaluated'], 0)
+        again = self.pipeline(rule_engine=engine).run()
+        self.assertEqual((again['evaluated'], again['applied']), (0, 0))
+
+    def test_a_failing_stage_fails_the_run(self):
+        self.fake.fail_ids = {'m5': 400}
+        pipeline = self.pipeline(fetch_workers=2)
+        with self.assertRaises(HttpError):
+            pipeline.run()
+        report = pipeline.report()
+        self.assertEqual(report['fetch']['errors'], 1)
+        self.assertLess(report['store']['items'], 250)
+        self.assertRegex(format_report({'stages': report}).splitlines()[2], r'^fetch .* 1$')
+
+    def test_workers_use_the_given_database(self):
+        # not the configured database, the one the pipeline was handed
+        configure_database(os.path.join(self.tmp.name, 'other.db'))
+        other = EmailDatabase()
+        db = EmailDatabase(os.path.join(self.tmp.name, 'emails.db'))
+        engine = RuleEngine(gmail=self.gmail, db=db)
+        engine.set_rules(list(RULES))
+        result = SyncPipeline(self.gmail, db, rule_engine=engine, service_factory=self.service,
+                              label_cache=self.label_cache, batch_size=20, page_size=50).run(limit=30)
+        self.assertEqual((result['stored'], result['evaluated'], result['applied']), (30, 30, 10))
+        self.assertEqual(db.get_email_ids(where=Email.rules_version.is_(None)), set())
+        self.assertEqual(other.get_email_ids(), set())
+        other.close()
+        db.close()
+
+if __name__ == '__main__':
+    unittest.main()
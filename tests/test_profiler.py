@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+from src.database import EmailDatabase
+from src.database.engine import configure_database, dispose_engines
+from src.utils.profiler import Profiler, profiler
+
+class TestProfiler(unittest.TestCase):
+    def test_disabled_profiler_records_nothing(self):
+        p = Profiler()
+        with p.span('stage'):
+            p.incr('rows', 5)
+        self.assertEqual(p.report()['spans'], {})
+        self.assertEqual(p.report()['counters'], {})
+
+    def test_spans_and_counters(self):
+        p = Profiler(enabled=True)
+        for _ in range(3):
+            with p.span('stage'):
+                pass
+        p.incr('rows', 5)
+        p.incr('api_calls', 2, method='gmail.users.messages.get')
+        p.incr('api_calls', 1, method='gmail.users.messages.list')
+        report = p.report()
+        self.assertEqual(report['spans']['stage']['count'], 3)
+        self.assertEqual(report['counters']['rows'], 5)
+        self.assertEqual(report['counters']['api_calls'], [
+            {'labels': {'method': 'gmail.users.messages.get'}, 'value': 2},
+            {'labels': {'method': 'gmail.users.messages.list'}, 'value': 1},
+        ])
+        text = p.to_prometheus()
+        self.assertIn('eclient_span_seconds_count{span="stage"} 3', text)
+        self.assertIn('eclient_rows_total 5', text)
+        self.assertIn('eclient_api_calls_total{method="gmail.users.messages.get"} 2', text)
+
+    def test_database_writes_are_counted(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            configure_database(os.path.join(tmp, 'emails.db'))
+            db = EmailDatabase()
+            profiler.enable()
+            try:
+                db.store_emails([{'id': f'e{i}', 'subject': 'Hi', 'snippet': '', 'from': 'a@b.com', 'to': 'me',
+                                  'date': 'Mon, 01 Jan 2024 10:00:00 +0000', 'body': 'body',
+                                  'has_attachment': False} for i in range(3)])
+                report = profiler.report()
+            finally:
+                profiler.enable(False)
+                db.close()
+                dispose_engines()
+                configure_database(None)
+        self.assertEqual(report['counters']['rows_written'], [{'labels': {'table': 'emails'}, 'value': 3}])
+        self.assertEqual(report['spans']['db.commit']['count'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
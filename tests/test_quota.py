@@ -0,0 +1,88 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from googleapiclient.errors import HttpError
+from src.api.gmail_api import gmailApi
+from src.api.quota import QuotaLimiter
+from fake_gmail import FakeGmail, make_message
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+class TestQuotaLimiter(unittest.TestCase):
+    def test_token_bucket(self):
+        clock = FakeClock()
+        limiter = QuotaLimiter(rate=100, burst=100, clock=clock, sleep=clock.sleep)
+        # the burst is spent without waiting
+        for _ in range(20):
+            limiter.acquire('gmail.users.messages.get')
+        self.assertEqual(clock.slept, [])
+        # then calls are paced at 100 units per second
+        limiter.acquire('gmail.users.messages.batchModify')
+        self.assertAlmostEqual(clock.slept[-1], 0.5)
+        limiter.acquire('gmail.users.messages.get', calls=10)
+        self.assertAlmostEqual(clock.slept[-1], 0.5)
+        clock.now += 10
+        limiter.acquire('gmail.users.messages.get')
+        self.assertEqual(len(clock.slept), 2)
+
+        usage = limiter.usage()
+        self.assertEqual(usage['units'], 100 + 50 + 50 + 5)
+        self.assertEqual(usage['by_method']['gmail.users.messages.batchModify'], 50)
+        self.assertAlmostEqual(usage['waited'], 1.0)
+        limiter.reset()
+        self.assertEqual(limiter.total, 0)
+
+class TestQuotaRetries(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeGmail([make_message(f'm{i}') for i in range(10)]).start()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.limiter = QuotaLimiter(rate=None)
+        self.gmail = gmailApi(service=self.fake.service(), label_cache=os.path.join(self.tmp.name, 'labels.json'),
+                              limiter=self.limiter)
+
+    def tearDown(self):
+        self.fake.stop()
+        self.tmp.cleanup()
+
+    @patch('src.api.quota.time.sleep')
+    def test_transient_errors_are_retried_with_backoff(self, mock_sleep):
+        self.fake.flaky_ids = {'m1': 2}
+        message = self.gmail.get_message('m1')
+        self.assertEqual(message['id'], 'm1')
+        self.assertEqual(mock_sleep.call_count, 2)
+        # jittered delays stay under the exponential bound
+        self.assertLessEqual(mock_sleep.call_args_list[0].args[0], 1)
+        self.assertLessEqual(mock_sleep.call_args_list[1].args[0], 2)
+        usage = self.limiter.usage()
+        self.assertEqual(usage['retries'], 2)
+        self.assertEqual(usage['units'], 15)  # every attempt is charged
+
+    @patch('src.api.quota.time.sleep')
+    def test_permanent_errors_are_not_retried(self, mock_sleep):
+        self.fake.fail_ids = {'m1': 404}
+        with self.assertRaises(HttpError):
+            self.gmail.get_message('m1')
+        mock_sleep.assert_not_called()
+
+    def test_meter_counts_batched_calls(self):
+        self.gmail.fetch_emails(count=10)
+        self.gmail.batch_modify([f'm{i}' for i in range(10)], remove_label_ids=['UNREAD'])
+        self.assertEqual(self.limiter.usage()['by_method'], {
+            'gmail.users.messages.list': 5,
+            'gmail.users.messages.get': 50,
+            'gmail.users.messages.batchModify': 50,
+        })
+
+if __name__ == '__main__':
+    unittest.main()
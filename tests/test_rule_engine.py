@@ -0,0 +1,322 @@
+import os
+import random
+import tempfile
+from datetime import datetime, timedelta
+import unittest
+from unittest.mock import patch, MagicMock
+from src.api.gmail_api import gmailApi
+from src.rules import RuleEngine
+from src.rules.actions import ActionPlan
+from src.rules.compiler import AhoCorasick, CompiledRuleSet
+from src.rules.evaluation import ShardedEvaluator
+from src.rules.sql import rules_clause
+from src.database.models import EmailDatabase
+from src.database.engine import configure_database, dispose_engines
+from fake_gmail import FakeGmail, make_message
+
+class TestRuleEngineActions(unittest.TestCase):
+    @patch('src.rules.rule_engine.EmailDatabase')
+    @patch('src.rules.rule_engine.gmailApi')
+    def test_move_action_moves_once(self, mock_gmail, mock_db):
+        mock_gmail.return_value.labels.resolve.return_value = 'Label_1'
+        mock_gmail.return_value.batch_modify.return_value = ['123']
+
+        engine = RuleEngine()
+        engine.execute_actions([{'type': 'move_message', 'folder': 'NPTEL'}], {'id': '123'})
+        engine.apply_actions()
+        mock_gmail.return_value.batch_modify.assert_called_once_with(
+            ['123'], add_label_ids=['Label_1'], remove_label_ids=['INBOX'])
+        mock_db.return_value.update_emails_status.assert_called_once_with({'123': {'folder_name': 'NPTEL'}})
+
+class TestActionPlan(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeGmail([make_message(f'm{i}') for i in range(2500)]).start()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.gmail = gmailApi(service=self.fake.service(), label_cache=os.path.join(self.tmp.name, 'labels.json'))
+        self.db = MagicMock()
+
+    def tearDown(self):
+        self.fake.stop()
+        self.tmp.cleanup()
+
+    def test_actions_are_merged_per_email(self):
+        plan = ActionPlan()
+        plan.add('m1', [{'type': 'mark_as_unread'}, {'type': 'mark_as_read'}, {'type': 'move_message', 'folder': 'TCS'}])
+        change = plan.changes['m1']
+        self.assertEqual(change['add'], set())
+        self.assertEqual(change['remove'], {'UNREAD', 'INBOX'})
+        self.assertEqual(change['status'], {'is_read': True, 'folder_name': 'TCS'})
+
+    def test_flush_groups_into_batch_modify(self):
+        plan = ActionPlan()
+        for i in range(2500):
+            if i % 2:
+                plan.add(f'm{i}', [{'type': 'mark_as_read'}])
+            else:
+                plan.add(f'm{i}', [{'type': 'move_message', 'folder': 'Placement'}, {'type': 'mark_as_unread'}])
+
+        applied = plan.flush(self.gmail, self.db)
+        self.assertEqual(len(applied), 2500)
+        # 1250 ids per label set, at most 1000 ids per call
+        self.assertEqual(self.fake.call_count('POST messages/batchModify'), 4)
+        self.assertEqual(self.fake.call_count('POST messages/modify'), 0)
+        self.assertEqual(self.fake.messages['m1']['labelIds'], ['INBOX'])
+        self.assertEqual(self.fake.messages['m2']['labelIds'], ['UNREAD', self.gmail.labels.resolve('Placement')])
+
+        updates = self.db.update_emails_status.call_args[0][0]
+        self.assertEqual(updates['m1'], {'is_read': True})
+        self.assertEqual(updates['m2'], {'folder_name': 'Placement', 'is_read': False})
+        self.assertEqual(len(plan), 0)
+
+class RandomRules:
+    WORDS = ['nptel', 'tcs', 'placement', 'offer', 'Invoice', 'news', 'letter', 'newsletter', 'ab', 'ba', '']
+
+    def random_text(self, rng):
+        return ' '.join(rng.choice(self.WORDS) for _ in range(rng.randint(0, 6)))
+
+    def random_rules(self, rng, count):
+        rules = []
+        for i in range(count):
+            conditions = []
+            for _ in range(rng.randint(1, 3)):
+                field = rng.choice(['from', 'subject', 'message', 'date_received'])
+                if field == 'date_received':
+                    conditions.append({'field': field, 'predicate': rng.choice(['less_than', 'greater_than']),
+                                       'value': str(rng.randint(1, 30))})
+                else:
+                    predicate = rng.choice(['contains', 'does_not_contain', 'equals', 'does_not_equal'])
+                    value = rng.choice(self.WORDS) if predicate.endswith('contain') else self.random_text(rng)
+                    conditions.append({'field': field, 'predicate': predicate, 'value': value})
+            rules.append({'name': f'rule{i}', 'predicate_type': rng.choice(['any', 'all']),
+                          'conditions': conditions, 'actions': []})
+        return rules
+
+class TestCompiledRuleSet(RandomRules, unittest.TestCase):
+    def test_aho_corasick_matches_substring_search(self):
+        rng = random.Random(1)
+        patterns = ['he', 'she', 'his', 'hers', 'a', 'aa', 'abcab', 'bca', 'c']
+        automaton = AhoCorasick(patterns)
+        for _ in range(200):
+            text = ''.join(rng.choice('abcehirs') for _ in range(rng.randint(0, 30)))
+            expected = {i for i, pattern in enumerate(patterns) if pattern in text}
+            self.assertEqual(automaton.search(text), expected)
+
+    @patch('builtins.print')
+    @patch('src.rules.rule_engine.EmailDatabase')
+    @patch('src.rules.rule_engine.gmailApi')
+    def test_same_matches_as_rule_engine(self, mock_gmail, mock_db, mock_print):
+        rng = random.Random(7)
+        engine = RuleEngine()
+        for rule_count in (3, 40):
+            rules = self.random_rules(rng, rule_count)
+            compiled = CompiledRuleSet(rules)
+            for _ in range(300):
+                email = {
+                    'id': 'x',
+                    'from': self.random_text(rng).upper(),
+                    'subject': self.random_text(rng),
+                    'message': self.random_text(rng) if rng.random() > 0.1 else None,
+                    'date': f'Mon, {rng.randint(1, 28):02d} Oct 2026 10:00:00 +0530',
+                }
+                expected = [rule['name'] for rule in rules if engine.evaluate_rule(rule, email)]
+                self.assertEqual([rule['name'] for rule in compiled.match(email)], expected)
+
+class TestRulePushdown(RandomRules, unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        configure_database(os.path.join(self.tmp.name, 'emails.db'))
+        self.db = EmailDatabase()
+        rng = random.Random(3)
+        self.emails = []
+        for i in range(300):
+            email_data = {
+                'id': f'e{i}', 'snippet': '', 'to': 'me@test.com', 'has_attachment': False,
+                'from': self.random_text(rng).title() + ' <x@y.com>',
+                'subject': self.random_text(rng) if rng.random() > 0.1 else None,
+                'body': self.random_text(rng) + ' Straße',
+                'date': f'Mon, {rng.randint(1, 28):02d} Sep 2026 {rng.randint(0, 23):02d}:00:00 +0000',
+            }
+            self.emails.append(email_data)
+        self.db.store_emails(self.emails)
+
+    def tearDown(self):
+        self.db.close()
+        dispose_engines()
+        configure_database(None)
+        self.tmp.cleanup()
+
+    @patch('builtins.print')
+    @patch('src.rules.rule_engine.gmailApi')
+    def test_pushdown_matches_full_scan(self, mock_gmail, mock_print):
+        rng = random.Random(11)
+        engine = RuleEngine()
+        for _ in range(5):
+            engine.rules = self.random_rules(rng, 6)
+            engine.rules.append({'name': 'unicode', 'predicate_type': 'any', 'actions': [],
+                                 'conditions': [{'field': 'message', 'predicate': 'contains', 'value': 'STRASSE'}]})
+            engine.compiled = CompiledRuleSet(engine.rules)
+            for count in (None, 50):
+                pushed = {email['id']: [rule['name'] for rule in rules] for email, rules in engine.match_emails(count)}
+                expected = {}
+                for email in engine.db.get_all_emails()[:count]:
+                    email_dict = {'from': email.sender, 'subject': email.subject, 'message': email.body,
+                                  'date': email.date, 'received_at': email.received_at}
+                    names = [rule['name'] for rule in engine.rules if engine.evaluate_rule(rule, email_dict)]
+                    if names:
+                        expected[email.id] = names
+                self.assertEqual(pushed, expected)
+        engine.close()
+
+    @patch('builtins.print')
+    @patch('src.rules.rule_engine.gmailApi')
+    def test_sharded_evaluation_matches_serial(self, mock_gmail, mock_print):
+        rules = self.random_rules(random.Random(5), 8)
+        engine = RuleEngine()
+        engine.set_rules(rules)
+        now = datetime.utcnow()
+        with ShardedEvaluator(engine.db, 2) as sharded:
+            for count in (None, 50):
+                expected = {email['id']: [rule['name'] for rule in matched]
+                            for email, matched in engine.match_emails(count, now)}
+                parallel = {email['id']: [rule['name'] for rule in matched]
+                            for email, matched in sharded.matches(rules, None, count, now)}
+                self.assertTrue(expected)
+                self.assertEqual(parallel, expected)
+        engine.close()
+
+    def test_clause_narrows_candidates(self):
+        rules = [{'name': 'tcs', 'predicate_type': 'all', 'actions': [],
+                  'conditions': [{'field': 'from', 'predicate': 'contains', 'value': 'TCS'}]}]
+        candidates = list(self.db.get_emails(where=rules_clause(rules, datetime.utcnow())))
+        self.assertTrue(candidates)
+        self.assertLess(len(candidates), len(self.emails))
+        self.assertTrue(all('tcs' in email.sender.lower() for email in candidates))
+
+    def test_large_rule_sets_are_not_pushed_down(self):
+        rules = [{'name': f'r{i}', 'predicate_type': 'any', 'actions': [],
+                  'conditions': [{'field': 'from', 'predicate': 'contains', 'value': f'sender{i}'}]}
+                 for i in range(1000)]
+        candidates = list(self.db.get_emails(where=rules_clause(rules, datetime.utcnow())))
+        self.assertEqual(len(candidates), len(self.emails))
+
+class TestIncrementalRules(unittest.TestCase):
+    RULES = [
+        {'name': 'TCS', 'predicate_type': 'any', 'actions': [{'type': 'move_message', 'folder': 'TCS'}],
+         'conditions': [{'field': 'from', 'predicate': 'contains', 'value': 'tcs'}]},
+    ]
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        configure_database(os.path.join(self.tmp.name, 'emails.db'))
+        patcher = patch('src.rules.rule_engine.gmailApi')
+        self.gmail = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.gmail.labels.resolve.side_effect = lambda name: f'Label_{name}'
+        self.gmail.batch_modify.side_effect = lambda ids, **kwargs: list(ids)
+
+        self.engine = RuleEngine()
+        self.engine.set_rules(list(self.RULES))
+        self.db = self.engine.db
+        self.emails = [self.email(f'e{i}', 'hr@tcs.com' if i % 2 else 'news@site.com') for i in range(10)]
+        self.db.store_emails(self.emails)
+
+    def tearDown(self):
+        self.db.close()
+        dispose_engines()
+        configure_database(None)
+        self.tmp.cleanup()
+
+    def email(self, email_id, sender, date='Mon, 01 Jan 2024 10:00:00 +0000', subject='Hello'):
+        return {'id': email_id, 'subject': subject, 'snippet': '', 'from': sender, 'to': 'me',
+                'date': date, 'body': 'body', 'has_attachment': False}
+
+    def moved_ids(self):
+        return sorted(email_id for call in self.gmail.batch_modify.call_args_list for email_id in call.args[0])
+
+    @patch('builtins.print')
+    def test_only_new_and_changed_emails_are_evaluated(self, mock_print):
+        self.assertEqual(self.engine.process_emails(), {'evaluated': 10, 'matched': 5, 'applied': 5})
+        self.gmail.batch_modify.reset_mock()
+
+        # nothing changed, nothing to do
+        self.assertEqual(self.engine.process_emails(), {'evaluated': 0, 'matched': 0, 'applied': 0})
+
+        # a new email and an edited one, re-storing an unchanged email keeps its version
+        self.db.store_emails([self.email('e10', 'jobs@tcs.com'), self.email('e2', 'x@tcs.com', subject='Edited'),
+                              self.emails[3]])
+        self.assertEqual(self.engine.process_emails(), {'evaluated': 2, 'matched': 2, 'applied': 2})
+        self.assertEqual(self.moved_ids(), ['e10', 'e2'])
+
+    @patch('builtins.print')
+    def test_rules_edit_evaluates_only_added_rules(self, mock_print):
+        self.engine.process_emails()
+        self.gmail.batch_modify.reset_mock()
+
+        renamed = dict(self.RULES[0], name='Renamed')
+        self.engine.set_rules([renamed])
+        self.assertEqual(self.engine.process_emails()['evaluated'], 0)
+
+        news = {'name': 'News', 'predicate_type': 'any', 'actions': [{'type': 'mark_as_read'}],
+                'conditions': [{'field': 'from', 'predicate': 'contains', 'value': 'news'}]}
+        self.engine.set_rules([renamed, news])
+        result = self.engine.process_emails()
+        self.assertEqual(result['evaluated'], 10)
+        # the TCS move is not sent again, only the new rule's action
+        self.assertEqual(self.moved_ids(), ['e0', 'e2', 'e4', 'e6', 'e8'])
+        self.assertEqual(self.gmail.batch_modify.call_args.kwargs['remove_label_ids'], ['UNREAD'])
+
+    @patch('builtins.print')
+    def test_workers_apply_the_same_actions(self, mock_print):
+        self.assertEqual(self.engine.process_emails(workers=2), {'evaluated': 10, 'matched': 5, 'applied': 5})
+        self.assertEqual(self.moved_ids(), ['e1', 'e3', 'e5', 'e7', 'e9'])
+        self.assertEqual(self.engine.process_emails(workers=2)['evaluated'], 0)
+
+    @patch('builtins.print')
+    def test_failed_actions_stay_pending(self, mock_print):
+        self.gmail.batch_modify.side_effect = lambda ids, **kwargs: []
+        self.assertEqual(self.engine.process_emails()['applied'], 0)
+        self.gmail.batch_modify.side_effect = lambda ids, **kwargs: list(ids)
+        result = self.engine.process_emails()
+        self.assertEqual(result, {'evaluated': 5, 'matched': 5, 'applied': 5})
+
+    @patch('builtins.print')
+    def test_bodies_are_fetched_for_message_rules(self, mock_print):
+        self.assertFalse(self.engine.needs_body)
+        self.db.store_emails([dict(self.email('meta', 'a@b.com'), body=None, has_attachment=None)])
+        self.engine.process_emails()
+        self.gmail.get_emails.assert_not_called()
+        self.gmail.batch_modify.reset_mock()
+
+        offer = {'name': 'Offer', 'predicate_type': 'any', 'actions': [{'type': 'mark_as_read'}],
+                 'conditions': [{'field': 'message', 'predicate': 'contains', 'value': 'offer letter'}]}
+        self.engine.set_rules([offer])
+        self.assertTrue(self.engine.needs_body)
+        self.gmail.get_emails.side_effect = lambda ids: [dict(self.email(i, 'a@b.com'), body='Your offer letter')
+                                                         for i in ids]
+        result = self.engine.process_emails()
+        self.gmail.get_emails.assert_called_once_with(['meta'])
+        self.assertEqual(result['matched'], 1)
+        self.assertEqual(self.moved_ids(), ['meta'])
+
+    @patch('builtins.print')
+    def test_time_dependent_rules_catch_emails_crossing_the_threshold(self, mock_print):
+        now = datetime.utcnow()
+        old = {'name': 'Old', 'predicate_type': 'all', 'actions': [{'type': 'mark_as_read'}],
+               'conditions': [{'field': 'date_received', 'predicate': 'greater_than', 'value': '30'}]}
+        self.engine.set_rules([old])
+        fresh = (now - timedelta(days=29, hours=12)).strftime('%a, %d %b %Y %H:%M:%S +0000')
+        self.db.store_emails([self.email('aging', 'a@b.com', date=fresh)])
+        self.engine.process_emails()
+        self.gmail.batch_modify.reset_mock()
+
+        # pretend the last run was two days ago, 'aging' crossed 30 days since
+        self.db.set_rules_version([], self.engine.version, run_at=now - timedelta(days=2))
+        self.db.store_emails([self.email('aging', 'a@b.com', date=(now - timedelta(days=31)).strftime(
+            '%a, %d %b %Y %H:%M:%S +0000'))])
+        self.db.set_rules_version(['aging'], self.engine.version)
+        result = self.engine.process_emails()
+        self.assertEqual(result['matched'], 1)
+        self.assertEqual(self.moved_ids(), ['aging'])
+
+if __name__ == '__main__':
+    unittest.main()
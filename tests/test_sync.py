@@ -0,0 +1,118 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from googleapiclient.errors import HttpError
+from src.api.gmail_api import gmailApi
+from src.api.quota import QuotaLimiter
+from src.database.models import EmailDatabase, Email
+from src.database.engine import configure_database, dispose_engines
+from src.sync import MailboxSync
+from fake_gmail import FakeGmail, make_message
+
+class TestMailboxSync(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeGmail([make_message(f'm{i}') for i in range(5)]).start()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.gmail = gmailApi(service=self.fake.service(), label_cache=os.path.join(self.tmp.name, 'labels.json'),
+                              limiter=QuotaLimiter(rate=None))
+        configure_database(os.path.join(self.tmp.name, 'emails.db'))
+        self.db = EmailDatabase()
+        self.sync = MailboxSync(self.gmail, self.db)
+
+    def tearDown(self):
+        self.fake.stop()
+        self.db.close()
+        dispose_engines()
+        configure_database(None)
+        self.tmp.cleanup()
+
+    def test_first_run_is_full_sync(self):
+        result = self.sync.run()
+        self.assertEqual(result['mode'], 'full')
+        self.assertEqual(result['added'], 5)
+        self.assertEqual(self.db.get_sync_cursor(), '1000')
+
+    def test_incremental_sync_applies_history(self):
+        self.sync.run()
+        self.fake.add_message(make_message('new1', subject='Fresh'))
+        self.fake.delete_message('m0')
+        self.fake._modify('m1', remove=['UNREAD'])
+
+        result = self.sync.run()
+        self.assertEqual(result, {'mode': 'incremental', 'added': 1, 'deleted': 1, 'updated': 1})
+        self.assertEqual(self.db.get_email_ids(), {'new1', 'm1', 'm2', 'm3', 'm4'})
+        self.assertTrue(self.db.session.get(Email, 'm1').is_read)
+        self.assertEqual(self.db.get_sync_cursor(), str(self.fake.history_id))
+        # no messages are listed or fetched one by one on the incremental path
+        self.assertEqual(self.fake.call_count('GET messages'), 1)
+
+    def test_quiet_mailbox_is_a_no_op(self):
+        self.sync.run()
+        calls = dict(self.fake.calls)
+        result = self.sync.run()
+        self.assertEqual(result, {'mode': 'incremental', 'added': 0, 'deleted': 0, 'updated': 0})
+        self.assertEqual(self.fake.call_count('GET history'), 1)
+        self.assertEqual(self.fake.call_count('POST batch'), calls.get('POST batch', 0))
+
+    def test_expired_cursor_falls_back_to_full_sync(self):
+        self.sync.run()
+        self.db.set_sync_cursor('5')
+        self.fake.messages.pop('m4')  # deleted outside the history window
+
+        result = self.sync.run()
+        self.assertEqual(result['mode'], 'full')
+        self.assertEqual(result['deleted'], 1)
+        self.assertNotIn('m4', self.db.get_email_ids())
+        self.assertEqual(self.db.get_sync_cursor(), '1000')
+
+    @patch('src.api.quota.time.sleep')
+    def test_failed_listing_keeps_emails_and_cursor(self, mock_sleep):
+        for i in range(5, 250):
+            self.fake.messages[f'm{i}'] = make_message(f'm{i}')
+        self.sync.run()
+        self.db.set_sync_cursor('5')  # expired, the next run is a full sync
+        self.fake.list_failures = {'100': 400}  # the second page
+
+        with self.assertRaises(HttpError):
+            self.sync.run()
+        self.assertEqual(len(self.db.get_email_ids()), 250)
+        self.assertEqual(self.db.get_sync_cursor(), '5')
+
+    def test_full_sync_keeps_emails_moved_out_of_the_inbox(self):
+        self.sync.run()
+        self.gmail.labels.resolve('NPTEL')
+        self.fake._modify('m1', add=['Label_2'], remove=['INBOX'])
+        self.fake._modify('m2', remove=['INBOX'])
+        self.fake.messages.pop('m3')  # deleted outside the history window
+        self.db.set_sync_cursor('5')
+
+        result = self.sync.run()
+        self.assertEqual(result, {'mode': 'full', 'added': 2, 'deleted': 1, 'updated': 2})
+        self.assertEqual(self.db.get_email_ids(), {'m0', 'm1', 'm2', 'm4'})
+        self.assertEqual(self.db.session.get(Email, 'm1').folder_name, 'NPTEL')
+        self.assertEqual(self.db.session.get(Email, 'm2').folder_name, 'ARCHIVE')
+
+    def test_incremental_sync_follows_label_changes(self):
+        self.sync.run()
+        self.gmail.labels.resolve('NPTEL')
+        self.fake._modify('m1', add=['Label_2'], remove=['INBOX'])
+        # a message that was never in the inbox is moved into it
+        self.fake.messages['old'] = make_message('old', labels=['Label_2'])
+        self.fake._modify('old', add=['INBOX'])
+
+        result = self.sync.run()
+        self.assertEqual(result, {'mode': 'incremental', 'added': 1, 'deleted': 0, 'updated': 1})
+        self.db.session.expire_all()
+        self.assertEqual(self.db.session.get(Email, 'm1').folder_name, 'NPTEL')
+        self.assertEqual(self.db.session.get(Email, 'old').folder_name, 'INBOX')
+
+        # both modes end up with the same rows
+        incremental = {(email.id, email.folder_name, email.is_read) for email in self.db.session.query(Email)}
+        self.sync.run(full=True)
+        self.db.session.expire_all()
+        full = {(email.id, email.folder_name, email.is_read) for email in self.db.session.query(Email)}
+        self.assertEqual(full, incremental)
+
+if __name__ == '__main__':
+    unittest.main()
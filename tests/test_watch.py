@@ -0,0 +1,143 @@
+import base64
+import json
+import os
+import tempfile
+import time
+import unittest
+import urllib.error
+import urllib.request
+from unittest.mock import patch
+from src.api.gmail_api import gmailApi
+from src.database.models import EmailDatabase, Email
+from src.database.engine import configure_database, dispose_engines
+from src.rules import RuleEngine
+from src.sync import MailboxSync, Watcher, WebhookServer
+from fake_gmail import FakeGmail, make_message
+
+RULES = [{'name': 'Read news', 'predicate_type': 'all',
+          'conditions': [{'field': 'subject', 'predicate': 'contains', 'value': 'news'}],
+          'actions': [{'type': 'mark_as_read'}]}]
+
+
+def push_body(history_id):
+    data = base64.b64encode(json.dumps({'emailAddress': 'me@test.com', 'historyId': history_id}).encode())
+    return json.dumps({'message': {'data': data.decode(), 'messageId': '1'}, 'subscription': 'sub'}).encode()
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class TestWatcher(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeGmail([make_message(f'm{i}') for i in range(3)]).start()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.gmail = gmailApi(service=self.fake.service(), label_cache=os.path.join(self.tmp.name, 'labels.json'))
+        configure_database(os.path.join(self.tmp.name, 'emails.db'))
+        self.db = EmailDatabase()
+        self.engine = RuleEngine(gmail=self.gmail, db=self.db)
+        self.engine.set_rules(list(RULES))
+        self.webhook = None
+        self.watch = None
+
+    def tearDown(self):
+        if self.watch is not None:
+            # before the fake goes away, a cycle would be retrying connection errors
+            self.watch.stop()
+            self.watch.join(5)
+        if self.webhook is not None:
+            self.webhook.stop()
+        self.fake.stop()
+        self.db.close()
+        dispose_engines()
+        configure_database(None)
+        self.tmp.cleanup()
+
+    def watcher(self, poll_interval=60, **kwargs):
+        self.watch = Watcher(MailboxSync(self.gmail, self.db), self.engine, poll_interval=poll_interval, **kwargs)
+        return self.watch.start()
+
+    def test_push_notification_processes_new_mail(self):
+        watcher = self.watcher()
+        self.assertTrue(wait_for(lambda: watcher.health()['status'] == 'ok'))
+        self.webhook = WebhookServer(watcher, port=0).start()
+
+        self.fake.add_message(make_message('n1', subject='Daily news'))
+        notified = self.fake.history_id
+        request = urllib.request.Request(self.webhook.url, data=push_body(notified), method='POST')
+        self.assertEqual(urllib.request.urlopen(request).status, 204)
+
+        # picked up long before the next poll
+        self.assertTrue(wait_for(lambda: 'UNREAD' not in self.fake.messages['n1']['labelIds']))
+        self.assertTrue(wait_for(lambda: watcher.health()['history_id'] == str(notified)))
+        health = json.loads(urllib.request.urlopen(self.webhook.url.replace('/gmail/push', '/health')).read())
+        self.assertEqual(health['status'], 'ok')
+        self.assertEqual(health['lag'], 0.0)
+        self.assertEqual(health['notified_history_id'], notified)
+        self.assertTrue(self.db.session.get(Email, 'n1').is_read)
+
+    def test_polling_picks_up_mail_without_notifications(self):
+        watcher = self.watcher(poll_interval=0.05)
+        self.assertTrue(wait_for(lambda: watcher.health()['cycles'] > 0))
+        self.fake.add_message(make_message('n2', subject='More news'))
+        self.assertTrue(wait_for(lambda: 'UNREAD' not in self.fake.messages['n2']['labelIds']))
+
+    def test_stale_notification_is_dropped(self):
+        watcher = self.watcher()
+        self.assertTrue(wait_for(lambda: watcher.health()['cycles'] == 1))
+        self.assertFalse(watcher.notify(self.fake.history_id))
+        self.assertTrue(watcher.notify(self.fake.history_id + 1))
+        self.assertTrue(wait_for(lambda: watcher.health()['cycles'] == 2))
+        # a history id Gmail has not reached yet stays pending
+        self.assertGreater(watcher.health()['lag'], 0.0)
+        self.assertEqual(self.fake.call_count('GET history'), 1)
+
+    def test_stop_finishes_and_releases_the_watch(self):
+        watcher = self.watcher(topic='projects/p/topics/gmail')
+        self.assertTrue(wait_for(lambda: watcher.health()['cycles'] == 1))
+        self.assertEqual(self.fake.watching['topicName'], 'projects/p/topics/gmail')
+        watcher.stop()
+        self.assertTrue(watcher.join(5))
+        self.assertIsNone(self.fake.watching)
+        self.assertEqual(watcher.health()['status'], 'stopped')
+
+    def test_webhook_token(self):
+        watcher = self.watcher()
+        self.assertTrue(wait_for(lambda: watcher.health()['cycles'] == 1))
+        with self.assertRaises(ValueError):
+            WebhookServer(watcher, host='0.0.0.0', port=0)
+        self.webhook = WebhookServer(watcher, host='127.0.0.1', port=0, token='s3cret').start()
+
+        for url, status in ((self.webhook.url, 403), (self.webhook.url + '?token=guess', 403),
+                            (self.webhook.url + '?token=s3cret', 204)):
+            request = urllib.request.Request(url, data=push_body(self.fake.history_id + 1), method='POST')
+            try:
+                code = urllib.request.urlopen(request).status
+            except urllib.error.HTTPError as e:
+                code = e.code
+            self.assertEqual(code, status)
+        self.assertEqual(watcher.health()['notified_history_id'], self.fake.history_id + 1)
+
+    @patch('src.api.quota.time.sleep')
+    def test_failing_cycle_is_reported_unhealthy(self, mock_sleep):
+        self.webhook = WebhookServer(self.watcher(poll_interval=0.05), port=0).start()
+        self.assertTrue(wait_for(lambda: self.watch.health()['cycles'] > 0))
+        self.fake.stop()
+        self.assertTrue(wait_for(lambda: self.watch.health()['status'] == 'failing'))
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            urllib.request.urlopen(self.webhook.url.replace('/gmail/push', '/health'))
+        self.assertEqual(raised.exception.code, 503)
+        # the error stays out of the public probe
+        health = json.loads(raised.exception.read())
+        self.assertEqual(health['status'], 'failing')
+        self.assertNotIn('last_error', health)
+        self.assertIn('Connection refused', self.watch.health()['last_error'])
+        self.fake.start()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,13 @@
+from src.database import EmailDatabase
+from src.database.search import rebuild_search_index
+
+def rebuild():
+    # Re-index every stored email, e.g. after editing the database by hand
+    db = EmailDatabase()
+    with db.engine.begin() as conn:
+        indexed = rebuild_search_index(conn)
+    print(f"Search index rebuilt for {indexed} email(s)")
+    db.close()
+
+if __name__ == "__main__":
+    rebuild()
@@ -1,10 +1,15 @@
 from src.database import EmailDatabase
+from src.database.engine import get_db_path, dispose_engines
 import os
 
 def recreate_database():
-    if os.path.exists('src/database/emails.db'):
-        os.remove('src/database/emails.db')
-        print("Old database removed")
+    db_path = get_db_path()
+    dispose_engines()
+    # WAL mode keeps two side files next to the database
+    for path in (db_path, db_path + '-wal', db_path + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+            print(f"Removed {path}")
     
     # Create new database with updated schema
     db = EmailDatabase()
@@ -12,4 +17,4 @@ def recreate_database():
     db.close()
 
 if __name__ == "__main__":
-    recreate_database()
\ No newline at end of file
+    recreate_database()